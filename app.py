@@ -34,72 +34,622 @@ def handle_ranking(df, metric_en, metric_jp, location_type, locations, ranking_c
 # ・市町村別: all_years_long.csv (cat1==total)
 # -------------------------------------------------------------
 
+import bisect
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
 # Streamlitページ設定（最初に実行する必要がある）
 st.set_page_config(page_title="沖縄県宿泊施設データ可視化", page_icon="🏨", layout="wide")
 
-RAW_DIR = Path("data/raw")
-ALL_DIR = Path("data/processed/all")
+# データディレクトリ（環境変数 OKINAWA_DATA_DIR で差し替え可能。ベンチマーク・合成データ用）
+DATA_DIR = Path(os.environ.get("OKINAWA_DATA_DIR", "data"))
+RAW_DIR = DATA_DIR / "raw"
+ALL_DIR = DATA_DIR / "processed" / "all"
 TRANSITION_XLSX = RAW_DIR / "Transition.xlsx"
 CSV_LONG = ALL_DIR / "all_years_long.csv"
 
 # by_yearディレクトリのCSVファイルも統合して読み込む
-BY_YEAR_DIR = Path("data/processed/by_year")
+BY_YEAR_DIR = DATA_DIR / "processed" / "by_year"
+
+
+def set_data_dir(data_dir):
+    """データディレクトリを切り替える（CLIツールから別のデータツリーを読み込む場合に使用）"""
+    global DATA_DIR, RAW_DIR, ALL_DIR, TRANSITION_XLSX, CSV_LONG, BY_YEAR_DIR
+    DATA_DIR = Path(data_dir)
+    RAW_DIR = DATA_DIR / "raw"
+    ALL_DIR = DATA_DIR / "processed" / "all"
+    TRANSITION_XLSX = RAW_DIR / "Transition.xlsx"
+    CSV_LONG = ALL_DIR / "all_years_long.csv"
+    BY_YEAR_DIR = DATA_DIR / "processed" / "by_year"
+    load_region_master()
+
+# ---------------- 処理時間計測 ----------------
+# 各処理段階（CSV読み込み・整形・抽出・ピボット・グラフ作成・表描画）の所要時間を記録する。
+# ・段階名は入れ子になる（例: "tab2/build_city_pivot"）
+# ・プロセス全体で段階ごとに直近 TIMING_HISTORY 件を保持し（_timing_store）、p50/p95 を集計する
+# ・1回の再実行（スクリプト実行）分は threading.local に記録し、計測パネルに表示する
+# ・ログはロガー "okinawa_dashboard.timing" に JSON 形式で出力する
+#   （環境変数 OKINAWA_TIMING_LOG=1 で標準エラー出力へのハンドラを追加）
+TIMING_HISTORY = 500
+TIMING_LOG = logging.getLogger("okinawa_dashboard.timing")
+if os.environ.get("OKINAWA_TIMING_LOG") and not TIMING_LOG.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    TIMING_LOG.addHandler(_handler)
+    TIMING_LOG.setLevel(logging.DEBUG if os.environ["OKINAWA_TIMING_LOG"].lower() == "debug" else logging.INFO)
+
+_TIMING_RUN = threading.local()
+
+
+@st.cache_resource
+def _timing_store():
+    """段階ごとの計測値の保存先（Streamlit の再実行でモジュールが再評価されても保持されるようプロセス共有にする）"""
+    return defaultdict(lambda: deque(maxlen=TIMING_HISTORY)), threading.Lock()
+
+
+def _percentile(samples, q):
+    """最近傍順位法によるパーセンタイル（samples はソート済み）"""
+    if not samples:
+        return float("nan")
+    return samples[max(0, math.ceil(q * len(samples)) - 1)]
+
+
+def _stage_stats(stage):
+    store, lock = _timing_store()
+    with lock:
+        samples = sorted(store.get(stage, ()))
+    return {
+        "n": len(samples),
+        "p50_ms": round(_percentile(samples, 0.50), 2),
+        "p95_ms": round(_percentile(samples, 0.95), 2),
+    }
+
+
+@contextmanager
+def timed_stage(stage):
+    """with ブロックの所要時間を段階 stage として記録する（入れ子の段階名は "/" で連結）"""
+    stack = getattr(_TIMING_RUN, "stack", None)
+    if stack is None:
+        stack = _TIMING_RUN.stack = []
+    name = "/".join(stack + [stage])
+    stack.append(stage)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        stack.pop()
+        store, lock = _timing_store()
+        with lock:
+            store[name].append(ms)
+        records = getattr(_TIMING_RUN, "records", None)
+        if records is not None:
+            records.append((name, ms))
+        if TIMING_LOG.isEnabledFor(logging.DEBUG):
+            TIMING_LOG.debug(json.dumps({"event": "stage", "stage": name, "ms": round(ms, 2)}, ensure_ascii=False))
+
+
+def timed(stage=None):
+    """関数の実行時間を記録するデコレータ（段階名の既定値は関数名）"""
+    def decorator(func):
+        name = stage or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_timing_run():
+    """1回のスクリプト実行分の計測記録を開始する（main の先頭で呼ぶ）"""
+    _TIMING_RUN.records = []
+    _TIMING_RUN.stack = []
+    _TIMING_RUN.started = time.perf_counter()
+
+
+def finish_timing_run():
+    """
+    1回のスクリプト実行分の計測結果を段階ごとに集計して返し、p50/p95 付きでログに出力する。
+    列: 段階, 回数, 合計(ms), 最大(ms), p50(ms), p95(ms), 計測数（p50/p95 はプロセス全体の直近値から算出）
+    """
+    records = getattr(_TIMING_RUN, "records", None) or []
+    run_ms = (time.perf_counter() - getattr(_TIMING_RUN, "started", time.perf_counter())) * 1000
+    if not records:
+        return pd.DataFrame(columns=["段階", "回数", "合計(ms)", "最大(ms)", "p50(ms)", "p95(ms)", "計測数"])
+
+    run = (
+        pd.DataFrame(records, columns=["段階", "ms"])
+        .groupby("段階", sort=False)["ms"]
+        .agg(回数="count", **{"合計(ms)": "sum", "最大(ms)": "max"})
+        .reset_index()
+    )
+    stats = {stage: _stage_stats(stage) for stage in run["段階"]}
+    run["p50(ms)"] = run["段階"].map(lambda s: stats[s]["p50_ms"])
+    run["p95(ms)"] = run["段階"].map(lambda s: stats[s]["p95_ms"])
+    run["計測数"] = run["段階"].map(lambda s: stats[s]["n"])
+    run[["合計(ms)", "最大(ms)"]] = run[["合計(ms)", "最大(ms)"]].round(2)
+
+    if TIMING_LOG.isEnabledFor(logging.INFO):
+        for stage, total, calls in zip(run["段階"], run["合計(ms)"], run["回数"]):
+            TIMING_LOG.info(json.dumps(
+                {"event": "run_stage", "stage": stage, "calls": int(calls), "total_ms": float(total), **stats[stage]},
+                ensure_ascii=False,
+            ))
+        TIMING_LOG.info(json.dumps({"event": "run", "ms": round(run_ms, 2), "stages": len(run)}))
+    _TIMING_RUN.records = None
+    _TIMING_RUN.run_ms = run_ms
+    return run
+
+
+def timing_summary():
+    """プロセス全体で記録した段階ごとの集計（回数・p50・p95・最大）を返す。ベンチマークやログ確認用"""
+    store, lock = _timing_store()
+    with lock:
+        samples = {stage: sorted(values) for stage, values in store.items()}
+    rows = [
+        {"stage": stage, "n": len(values), "p50_ms": _percentile(values, 0.50),
+         "p95_ms": _percentile(values, 0.95), "max_ms": values[-1]}
+        for stage, values in samples.items() if values
+    ]
+    return pd.DataFrame(rows, columns=["stage", "n", "p50_ms", "p95_ms", "max_ms"])
+
+
+def reset_timings():
+    """記録済みの計測値をすべて破棄する"""
+    store, lock = _timing_store()
+    with lock:
+        store.clear()
+
+
+def render_timing_panel(run):
+    """finish_timing_run() の結果をサイドバーの計測パネルとして表示する"""
+    with st.sidebar.expander("⏱️ 処理時間", expanded=True):
+        st.caption(f"今回の実行: {getattr(_TIMING_RUN, 'run_ms', 0):,.0f} ms（p50/p95 は直近{TIMING_HISTORY}回の計測から算出）")
+        if run.empty:
+            st.write("計測データがありません")
+            return
+        top = run[~run["段階"].str.contains("/")]["合計(ms)"].sum()
+        st.caption(f"計測済みの最上位段階の合計: {top:,.0f} ms")
+        st.dataframe(run, use_container_width=True, hide_index=True)
+
+
+# ---------------- メモリ使用量 ----------------
+# 1回の実行で保持しているデータフレーム・図・キャッシュを track_memory() で登録し、
+# memory_report() で使用量（deep）と元データとのバッファ共有を集計する。
+# 共有分は元データ側で計上済みなので「実質」には含めない。
+_MEMORY_RUN = threading.local()
+
+
+def _buffer_ranges(series):
+    """列（Series / Index）が参照しているメモリ領域（先頭アドレス, 終端アドレス）の一覧。コピーせずに取得できるものだけを対象とする"""
+    if isinstance(series.dtype, np.dtype):
+        values = series.values
+        if values.nbytes == 0:
+            return []
+        start = values.__array_interface__["data"][0]
+        return [(start, start + values.nbytes)]
+    # pyarrow バックエンドの列（pandas 2系以降の文字列型など）
+    pa_array = getattr(series.array, "_pa_array", None)
+    if pa_array is None:
+        return []
+    chunks = getattr(pa_array, "chunks", [pa_array])
+    return [(buf.address, buf.address + buf.size) for chunk in chunks for buf in chunk.buffers() if buf is not None and buf.size]
+
+
+def _shares_buffer(series, base_series):
+    ranges = _buffer_ranges(base_series)
+    return any(start < b_end and b_start < end for start, end in _buffer_ranges(series) for b_start, b_end in ranges)
+
+
+def object_nbytes(obj):
+    """データフレーム・Series・図・コンテナのおおよその使用量（バイト）。図は JSON にした大きさで見積もる"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True, index=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, go.Figure):
+        return len(obj.to_json().encode("utf-8"))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(object_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple, set, deque)):
+        return sys.getsizeof(obj) + sum(object_nbytes(v) for v in obj)
+    return sys.getsizeof(obj)
+
+
+def shared_nbytes(frame, base):
+    """frame の列・インデックスのうち base とバッファを共有している部分の使用量（バイト）"""
+    if not isinstance(frame, pd.DataFrame) or not isinstance(base, pd.DataFrame):
+        return 0
+    usage = frame.memory_usage(deep=True, index=True)
+    shared = 0
+    for col in frame.columns:
+        if col in base.columns and _shares_buffer(frame[col], base[col]):
+            shared += int(usage[col])
+    if _shares_buffer(frame.index, base.index):
+        shared += int(usage["Index"])
+    return shared
+
+
+def start_memory_run():
+    """1回のスクリプト実行分のメモリ登録を開始する"""
+    _MEMORY_RUN.items = []
+
+
+def track_memory(name, obj, base=None, kind="フレーム"):
+    """
+    保持しているオブジェクトを登録し、そのまま返す。
+    base を指定するとその分の共有バッファを差し引いて計上する（ビュー・スライスの場合）。
+    """
+    items = getattr(_MEMORY_RUN, "items", None)
+    if items is not None:
+        items.append((name, kind, obj, base))
+    return obj
+
+
+def memory_report(items=None, session_state=None):
+    """
+    登録済みオブジェクトの使用量を集計する。
+    列: 名前, 種類, 行数, 使用量(KB), 共有(KB), 実質(KB)
+    session_state を渡すとセッション変数（ウィジェットの値など）の合計も1行として加える。
+    """
+    if items is None:
+        items = getattr(_MEMORY_RUN, "items", None) or []
+    rows = []
+    for name, kind, obj, base in items:
+        nbytes = object_nbytes(obj)
+        shared = shared_nbytes(obj, base) if base is not None else 0
+        rows.append({
+            "名前": name,
+            "種類": kind,
+            "行数": len(obj) if isinstance(obj, (pd.DataFrame, pd.Series)) else None,
+            "使用量(KB)": nbytes / 1024,
+            "共有(KB)": shared / 1024,
+            "実質(KB)": (nbytes - shared) / 1024,
+        })
+    store, _ = _timing_store()
+    rows.append({"名前": "処理時間の計測値", "種類": "キャッシュ", "行数": sum(len(v) for v in store.values()),
+                 "使用量(KB)": object_nbytes(dict(store)) / 1024, "共有(KB)": 0.0})
+    if session_state is not None:
+        values = {key: session_state[key] for key in session_state.keys()}
+        rows.append({"名前": "セッション変数", "種類": "セッション", "行数": len(values),
+                     "使用量(KB)": object_nbytes(values) / 1024, "共有(KB)": 0.0})
+    report = pd.DataFrame(rows, columns=["名前", "種類", "行数", "使用量(KB)", "共有(KB)", "実質(KB)"])
+    report["実質(KB)"] = report["使用量(KB)"] - report["共有(KB)"]
+    report["行数"] = report["行数"].astype("Int64")
+    return report.round({"使用量(KB)": 1, "共有(KB)": 1, "実質(KB)": 1})
+
+
+def process_peak_rss_mb():
+    """プロセスの最大常駐メモリ（MB）。取得できない環境では None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def release_free_memory():
+    """
+    解放済みのヒープを OS に返す（glibc の malloc_trim。使えない環境では何もしない）。
+    読み込み・カタログ作成の一時配列で伸びたヒープは、解放後もプロセスに残り続けるため、読み込みの最後に呼ぶ。
+    """
+    try:
+        import ctypes
+
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def render_memory_panel(report):
+    """memory_report() の結果をサイドバーのメモリパネルとして表示する"""
+    with st.sidebar.expander("🧮 メモリ使用量", expanded=True):
+        session_kb = report.loc[report["種類"] != "キャッシュ", "実質(KB)"].sum()
+        cache_kb = report.loc[report["種類"] == "キャッシュ", "実質(KB)"].sum()
+        st.caption(f"このセッション: {session_kb / 1024:,.1f} MB（共有分を除く） / キャッシュ: {cache_kb / 1024:,.1f} MB")
+        peak = process_peak_rss_mb()
+        if peak is not None:
+            st.caption(f"プロセス最大常駐メモリ: {peak:,.0f} MB（全セッション合計）")
+        st.dataframe(report, use_container_width=True, hide_index=True)
+
+
+# ---------------- データソースの読み込み ----------------
+# ファイルの系統ごとに、読み込む列・型を宣言しておき、必要な列だけを型を指定して読み込む。
+# ・by_year の long_YYYY.csv は BOM 付き・市町村列が municipality で、cat1/metric の写しの列 "0"・"1" を含む
+# ・アプリで使うのは SOURCE_COLUMNS の列だけ（area・cat2・"0"・"1" は読み込まない）
+# ・文字列の列は文字列型（pandas 3 では Arrow 文字列）を指定する。カテゴリ型での読み込みも試したが、
+#   Arrow 文字列への読み込みより遅く（by_year 全体で約 140 ms 対 120 ms）、結合時のカテゴリ統合も要るため採らない
+# ・value は数値以外（見出しの行）が混入するファイルがあるため、ファイルごとに数値化する（数値以外は欠損）。
+#   結合後の列が数値型になり、上書きの比較・整形で行ごとの型判定が要らなくなる
+# ・hotel_breakdown 系は読み込み後に process_hotel_breakdown_data_fixed で整形する
+# ・CSV の解析エンジンは CSV_ENGINE（環境変数 OKINAWA_CSV_ENGINE）で選ぶ
+#     pandas : pandas の C パーサー（既定）
+#     pyarrow: pyarrow.csv のマルチスレッド読み込み。Arrow の表から DataFrame にする際、文字列の列は
+#              Arrow のバッファのまま渡る（pandas 3 の文字列型）。pyarrow が無い環境では pandas を使う
+# ・読み込みの問題（読めないファイル・想定外の列構造）は report_load_problem で報告する。監視スレッドからの
+#   読み込み直しでは画面に出せないため、TIMING_LOG に記録し、collect_load_problems の中では一覧に集める
+SOURCE_COLUMNS = ["city", "value", "cat1", "metric", "table", "year"]
+CSV_ENGINES = ("pandas", "pyarrow")
+CSV_ENGINE = os.environ.get("OKINAWA_CSV_ENGINE", "pandas")
+_SOURCE_DTYPES = {"city": "str", "table": "str", "cat1": "str", "metric": "str", "year": "int64"}
+SOURCE_SCHEMAS = {
+    "long_YYYY_hotel_breakdown.csv": {
+        "pattern": r"long_\d{4}_hotel_breakdown\.csv",
+        "columns": {"year": "year", "city": "city", "metric": "metric", "cat1": "cat1", "table": "table", "value": "value"},
+        "dtype": _SOURCE_DTYPES,
+        "hotel_breakdown": True,
+    },
+    "long_YYYY.csv": {
+        "pattern": r"long_\d{4}\.csv",
+        "columns": {"municipality": "city", "city": "city", "value": "value", "cat1": "cat1",
+                    "metric": "metric", "table": "table", "year": "year"},
+        "dtype": dict(_SOURCE_DTYPES, municipality="str"),
+        "encoding": "utf-8-sig",
+    },
+    "all_years_long.csv": {
+        "pattern": r"all_years_long\.csv",
+        "columns": {"year": "year", "city": "city", "table": "table", "cat1": "cat1", "metric": "metric", "value": "value"},
+        "dtype": _SOURCE_DTYPES,
+    },
+    "hotel_breakdown_*.csv": {
+        "pattern": r"hotel_breakdown_.*\.csv",
+        "columns": {"year": "year", "city": "city", "metric": "metric", "cat1": "cat1", "table": "table", "value": "value"},
+        "dtype": _SOURCE_DTYPES,
+        "hotel_breakdown": True,
+    },
+}
+
+
+def source_schema(path):
+    """ファイル名から SOURCE_SCHEMAS の系統を選ぶ。戻り値: (系統名, スキーマ)（該当なしは (None, None)）"""
+    import re
+
+    for family, schema in SOURCE_SCHEMAS.items():
+        if re.fullmatch(schema["pattern"], Path(path).name):
+            return family, schema
+    return None, None
+
+
+def csv_engine(engine=None):
+    """使用する CSV 解析エンジン（engine 省略時は CSV_ENGINE。pyarrow を import できなければ pandas）"""
+    engine = engine or CSV_ENGINE
+    if engine not in CSV_ENGINES:
+        raise ValueError(f"CSV エンジンは {CSV_ENGINES} のいずれかを指定してください: {engine}")
+    if engine == "pyarrow":
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            return "pandas"
+    return engine
+
+
+def _read_csv_pyarrow(path, columns, dtype):
+    """pyarrow.csv で columns に含まれる列だけを dtype の型で読み込む（BOM・空欄の扱いは pandas と同じ）"""
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    with open(path, encoding="utf-8-sig") as handle:
+        header = handle.readline().rstrip("\r\n").split(",")
+    include = [column for column in header if column in columns]
+    types = {"str": pa.string(), "int64": pa.int64()}
+    table = pv.read_csv(
+        path,
+        read_options=pv.ReadOptions(use_threads=True),
+        convert_options=pv.ConvertOptions(
+            include_columns=include,
+            column_types={column: types[dtype[column]] for column in include if column in dtype},
+            strings_can_be_null=True,
+        ),
+    )
+    return table.to_pandas()
+
+
+def read_source(path, engine=None):
+    """
+    データファイルを系統のスキーマに従って読み込み、SOURCE_COLUMNS の列にそろえる。
+    どの系統にも当たらないファイルは全列を読み込み、列名だけそろえる。engine: csv_engine()
+    """
+    family, schema = source_schema(path)
+    if schema is None:
+        df = pd.read_csv(path, dtype={"year": int}, encoding="utf-8-sig")
+        return df.rename(columns={"municipality": "city"})
+    columns = schema["columns"]
+    if csv_engine(engine) == "pyarrow":
+        df = _read_csv_pyarrow(path, columns, schema["dtype"])
+    else:
+        df = pd.read_csv(
+            path,
+            usecols=lambda column: column in columns,
+            dtype=schema["dtype"],
+            encoding=schema.get("encoding", "utf-8"),
+            low_memory=False,  # value の型をファイル全体で推定する（大きなファイルで塊ごとに型が混ざらないように）
+        )
+    df = df.rename(columns=columns)
+    if schema.get("hotel_breakdown"):
+        df = process_hotel_breakdown_data_fixed(df)
+    elif not pd.api.types.is_numeric_dtype(df["value"].dtype):
+        df["value"] = pd.to_numeric(df["value"], errors="coerce")
+    return df[[column for column in SOURCE_COLUMNS if column in df.columns]]
+
+
+# ---------------- データソースの統合 ----------------
+# by_year の long_*.csv と統合ファイル all_years_long.csv には同じキーの行が含まれる。
+# キーごとに優先順位の高いソースの行を採用し、値（数値に変換した value）が異なる上書きを報告する。
+# ・MERGE_PRECEDENCE（環境変数 OKINAWA_MERGE_PRECEDENCE）
+#     all_years: all_years_long.csv が by_year のファイルより優先（従来の結合順と同じ。既定）
+#     by_year  : by_year のファイルが all_years_long.csv より優先
+# ・同じ優先順位のソース同士（by_year のファイル間・同じファイル内）は後の行を採用する
+# ・OKINAWA_CONFLICT_REPORT を指定すると、上書きがあった場合に一覧を CSV で書き出す
+MERGE_KEY = ["year", "city", "cat1", "metric", "table"]
+MERGE_PRECEDENCE = os.environ.get("OKINAWA_MERGE_PRECEDENCE", "all_years")
+MERGE_CONFLICT_COLUMNS = MERGE_KEY + ["採用ソース", "採用値", "上書きされたソース", "上書きされた値"]
+
+
+def source_rank(source):
+    """ソースの優先順位（大きいほど優先）"""
+    combined = source == CSV_LONG.name
+    if MERGE_PRECEDENCE == "by_year":
+        return 0 if combined else 1
+    return 1 if combined else 0
+
+
+def empty_merge_conflicts():
+    return pd.DataFrame(columns=MERGE_CONFLICT_COLUMNS)
+
+
+@timed()
+def merge_sources(frames, sources):
+    """
+    ソースごとの long 形式データ frames（sources はそれぞれのファイル名）を結合し、
+    MERGE_KEY が同じ行は優先順位の最も高い行だけを残す（残す行の並びは結合順のまま）。
+    戻り値: (結合したデータ, 値が異なる上書きの一覧)
+    """
+    df = pd.concat(frames, ignore_index=True)
+    source_id = np.repeat(np.arange(len(frames)), [len(frame) for frame in frames])
+    rank = np.array([source_rank(source) for source in sources])[source_id]
+
+    # キーを1回のハッシュ結合（groupby の因数分解）で番号付けし、2行以上あるキーだけを比べる
+    group = df.groupby(MERGE_KEY, sort=False, dropna=False).ngroup().to_numpy()
+    candidates = np.flatnonzero(np.bincount(group)[group] > 1)
+    if not len(candidates):
+        return df, empty_merge_conflicts()
+    group = group[candidates]
+
+    # グループ内で (優先順位, 結合順) が最大の行を採用する
+    order = np.lexsort((candidates, rank[candidates], group))
+    last = np.r_[group[order][1:] != group[order][:-1], True]
+    winner_of_group = np.empty(group.max() + 1, dtype=np.int64)
+    winner_of_group[group[order][last]] = candidates[order][last]
+    winner = winner_of_group[group]
+
+    keep = np.ones(len(df), dtype=bool)
+    keep[candidates] = candidates == winner
+
+    # 値が異なる上書き（数値に変換して比較。ともに欠損なら同じとみなす）
+    values = pd.to_numeric(df["value"], errors="coerce").to_numpy(dtype=float)
+    lost, won = values[candidates], values[winner]
+    differs = (candidates != winner) & ~((lost == won) | (np.isnan(lost) & np.isnan(won)))
+    conflicts = df.iloc[candidates[differs]][MERGE_KEY].reset_index(drop=True)
+    conflicts["採用ソース"] = np.asarray(sources, dtype=object)[source_id[winner[differs]]]
+    conflicts["採用値"] = won[differs]
+    conflicts["上書きされたソース"] = np.asarray(sources, dtype=object)[source_id[candidates[differs]]]
+    conflicts["上書きされた値"] = lost[differs]
+    return df[keep], conflicts[MERGE_CONFLICT_COLUMNS]
+
+
+def write_merge_conflicts(path, conflicts):
+    """上書きの一覧を CSV で書き出す"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conflicts.to_csv(path, index=False, encoding="utf-8-sig")
+
+
+_load_problems = threading.local()
+
+
+@contextmanager
+def collect_load_problems():
+    """この中で報告された読み込みの問題（report_load_problem）を一覧に集める。yield: [{level, message}, ...]"""
+    problems, outer = [], getattr(_load_problems, "active", None)
+    _load_problems.active = problems
+    try:
+        yield problems
+    finally:
+        _load_problems.active = outer
+
+
+def report_load_problem(level, message):
+    """
+    読み込みの問題を TIMING_LOG に記録する。level: "warning" / "error"
+    collect_load_problems の中では一覧に加え（表示は呼び出し側が行う）、それ以外でスクリプト実行中なら画面に表示する
+    """
+    TIMING_LOG.warning(json.dumps({"event": "load_problem", "level": level, "message": message}, ensure_ascii=False))
+    problems = getattr(_load_problems, "active", None)
+    if problems is not None:
+        problems.append({"level": level, "message": message})
+    elif get_script_run_ctx(suppress_warning=True) is not None:
+        (st.error if level == "error" else st.warning)(message)
+
 
-def load_all_data():
+@timed()
+def load_all_data(with_conflicts=False, engine=None):
     """
     すべてのデータを統合して読み込む。
     アプリが利用できる整形済みの「long_」で始まるファイルのみを対象とする。
+    with_conflicts=True のときは (データ, 値が異なる上書きの一覧) を返す（merge_sources）。
+    engine: CSV の解析エンジン（csv_engine。省略時は CSV_ENGINE）
     """
     dfs = []
+    sources = []
     
     # by_year ディレクトリから 'long_' で始まるCSVを読み込む
     if BY_YEAR_DIR.exists():
         # sortedでファイル読み込み順を固定し、一貫性を担保
         for csv_file in sorted(BY_YEAR_DIR.glob("long_*.csv")):
             try:
-                df = pd.read_csv(csv_file, dtype={"year": int})
-                
-                # 列名の統一
-                if "municipality" in df.columns:
-                    df = df.rename(columns={"municipality": "city"})
-                
-                # hotel_breakdownデータの特別処理
-                if "hotel_breakdown" in str(csv_file):
-                    df = process_hotel_breakdown_data_fixed(df)
+                # 系統ごとのスキーマで必要な列だけを読み込む（列名の統一・hotel_breakdown の整形を含む）
+                with timed_stage("read_csv"):
+                    df = read_source(csv_file, engine)
                 
                 if not df.empty:
                     dfs.append(df)
+                    sources.append(csv_file.name)
                     
             except Exception as e:
-                st.warning(f"ファイル {csv_file} の読み込みでエラー: {e}")
+                report_load_problem("warning", f"ファイル {csv_file} の読み込みでエラー: {e}")
 
     # 既存の統合ファイル(all_years_long.csv)も読み込む
     if CSV_LONG.exists():
         try:
-            df_existing = pd.read_csv(CSV_LONG, dtype={"year": int})
+            with timed_stage("read_csv"):
+                df_existing = read_source(CSV_LONG, engine)
             if not df_existing.empty:
                 dfs.append(df_existing)
+                sources.append(CSV_LONG.name)
         except Exception as e:
-            st.warning(f"統合ファイル読み込みエラー: {e}")
+            report_load_problem("warning", f"統合ファイル読み込みエラー: {e}")
 
     if not dfs:
-        return pd.DataFrame()
+        return (pd.DataFrame(), empty_merge_conflicts()) if with_conflicts else pd.DataFrame()
 
-    # すべてのデータを結合
-    df_combined = pd.concat(dfs, ignore_index=True)
-    
-    # 重複除去：'last'を保持することで、新しい年のデータ（例：long_2024.csv）が古い統合データ（all_years_long.csv）を上書きするようにする
-    df_combined = df_combined.drop_duplicates(subset=["year", "city", "cat1", "metric", "table"], keep='last')
-    
-    return df_combined
+    with timed_stage("concat_dedup"):
+        # すべてのデータを結合し、同じキーの行は MERGE_PRECEDENCE の優先順位で1行にする
+        df_combined, conflicts = merge_sources(dfs, sources)
+
+    if len(conflicts):
+        TIMING_LOG.warning(json.dumps({
+            "event": "merge_conflicts",
+            "precedence": MERGE_PRECEDENCE,
+            "conflicts": conflicts.groupby("上書きされたソース", sort=False).size().to_dict(),
+        }, ensure_ascii=False))
+        if os.environ.get("OKINAWA_CONFLICT_REPORT"):
+            write_merge_conflicts(os.environ["OKINAWA_CONFLICT_REPORT"], conflicts)
+    return (df_combined, conflicts) if with_conflicts else df_combined
 
 
+@timed()
 def process_hotel_breakdown_data_fixed(df):
     """
     hotel_breakdownデータの修正版処理関数
@@ -129,11 +679,11 @@ def process_hotel_breakdown_data_fixed(df):
             
             return df
         else:
-            st.warning(f"hotel_breakdownデータの列構造が期待と異なります。期待: {required_cols}, 実際: {list(df.columns)}")
+            report_load_problem("warning", f"hotel_breakdownデータの列構造が期待と異なります。期待: {required_cols}, 実際: {list(df.columns)}")
             return df
             
     except Exception as e:
-        st.error(f"hotel_breakdownデータの処理でエラー: {e}")
+        report_load_problem("error", f"hotel_breakdownデータの処理でエラー: {e}")
         return df
 
 
@@ -175,6 +725,35 @@ REGION_MAP = {
     ],
 }
 
+# 同梱データ用の既定値（load_region_master で差し替えた後に戻せるよう保持）
+_DEFAULT_CITY_CODE = dict(CITY_CODE)
+_DEFAULT_REGION_MAP = {area: list(cities) for area, cities in REGION_MAP.items()}
+
+
+def load_region_master(path=None):
+    """
+    市町村コード・地域マスター（region_master.json）を読み込み、CITY_CODE / REGION_MAP を差し替える。
+    合成データなど同梱データ以外の市町村構成を使う場合に、データディレクトリの raw/ に置く。
+    ファイルが無い場合は同梱データの既定値に戻す。
+    """
+    import json
+
+    path = Path(path) if path is not None else RAW_DIR / "region_master.json"
+    if path.exists():
+        master = json.loads(path.read_text(encoding="utf-8"))
+        city_code, region_map = master["city_code"], master["region_map"]
+    else:
+        city_code, region_map = _DEFAULT_CITY_CODE, _DEFAULT_REGION_MAP
+
+    # 他モジュールが参照を保持していても反映されるよう、辞書はその場で更新する
+    CITY_CODE.clear()
+    CITY_CODE.update({city: int(code) for city, code in city_code.items()})
+    REGION_MAP.clear()
+    REGION_MAP.update({area: list(cities) for area, cities in region_map.items()})
+
+
+load_region_master()
+
 # ---------------- 宿泊形態の日本語ラベル ----------------
 CAT1_JP2EN = {
     "ホテル・旅館":          "hotel_ryokan",
@@ -194,6 +773,7 @@ ALIASES = {
 }
 
 # ---------------- 県全体データ読み込み ----------------
+@timed()
 def load_transition_total(path: Path) -> pd.DataFrame:
     """県全体 total (Transition.xlsx) を tidy 形式で返す"""
     if not path.exists():
@@ -212,7 +792,7 @@ def load_transition_total(path: Path) -> pd.DataFrame:
                 hdr_idx = i
                 break
         if hdr_idx is None:
-            st.error("Transition.xlsx → 必須列が見つかりません")
+            report_load_problem("error", "Transition.xlsx → 必須列が見つかりません")
             return pd.DataFrame()
 
         header = df_raw.iloc[hdr_idx].fillna("").astype(str).str.strip().str.lower().tolist()
@@ -232,7 +812,7 @@ def load_transition_total(path: Path) -> pd.DataFrame:
                     break
         data = data.rename(columns=ren)
         if not {"facilities", "rooms", "capacity"}.issubset(data.columns):
-            st.error("Transition.xlsx → facilities/rooms/capacity 列不足")
+            report_load_problem("error", "Transition.xlsx → facilities/rooms/capacity 列不足")
             return pd.DataFrame()
 
         # 数値化
@@ -263,9 +843,1454 @@ def load_transition_total(path: Path) -> pd.DataFrame:
         tidy[["city", "table", "cat1", "cat2"]] = ["沖縄県", "pref_transition", "total", ""]
         return tidy
     except Exception as e:
-        st.error(f"Transition.xlsx読み込みエラー: {e}")
+        report_load_problem("error", f"Transition.xlsx読み込みエラー: {e}")
         return pd.DataFrame()
 
+# ---------------- 市町村データ整形・集計キューブ ----------------
+METRICS = ["facilities", "rooms", "capacity"]
+METRIC_JP = {"facilities": "軒数", "rooms": "客室数", "capacity": "収容人数"}
+
+# 派生指標（読み込み時に build_derived_metrics で全 (table, cat1, city, year) について計算しておく）
+#   numerator / denominator : 分子・分母の指標
+#   share                   : True なら同じ (table, city, year) の total に対する構成比（%）
+DERIVED_METRICS = {
+    "rooms_per_facility": {"label": "1軒あたり客室数", "unit": "室/軒", "numerator": "rooms", "denominator": "facilities", "share": False},
+    "capacity_per_room": {"label": "1室あたり収容人数", "unit": "人/室", "numerator": "capacity", "denominator": "rooms", "share": False},
+    "facilities_share": {"label": "軒数構成比", "unit": "%", "numerator": "facilities", "denominator": "facilities", "share": True},
+    "rooms_share": {"label": "客室数構成比", "unit": "%", "numerator": "rooms", "denominator": "rooms", "share": True},
+    "capacity_share": {"label": "収容人数構成比", "unit": "%", "numerator": "capacity", "denominator": "capacity", "share": True},
+}
+DERIVED_DECIMALS = 2  # 派生指標の小数点以下の桁数
+METRIC_LABELS = {**METRIC_JP, **{metric: spec["label"] for metric, spec in DERIVED_METRICS.items()}}
+METRIC_OPTIONS = {label: metric for metric, label in METRIC_LABELS.items()}  # 画面の指標名 → 指標
+# 質問で選べる指標（質問は total で集計するため、total では常に 100% になる構成比は除く）
+QUESTION_METRICS = [label for metric, label in METRIC_LABELS.items() if not DERIVED_METRICS.get(metric, {}).get("share")]
+
+# 分析に使うテーブルの優先順位（get_analysis_dataframe と同じ）
+ANALYSIS_TABLE_PRIORITY = ["accommodation_type", "scale_class", "hotel_breakdown"]
+
+
+@timed()
+def normalize_long_table(df_long):
+    """load_all_data() の結果をアプリで使う形に整形する（空白・大小文字・数値型の統一）"""
+    df_long = df_long.assign(
+        city=lambda d: d["city"].str.strip(),
+        cat1=lambda d: d["cat1"].fillna("").str.lower().str.strip(),
+        metric=lambda d: d["metric"].str.lower().str.strip(),
+        value=lambda d: pd.to_numeric(d["value"], errors="coerce").fillna(0).astype(int)
+    )
+    return df_long.query("metric in ['facilities','rooms','capacity']")
+
+
+# ---------------- 並べ替え済みキー索引 ----------------
+# long 形式データを (table, metric, cat1, year) の順に安定ソートしておき、
+# 各行のキーを1つの整数にまとめた昇順配列を二分探索して該当行の連続区間を求める。
+# city はソートキーに含めず元ファイルの並び（市町村コード順）のまま残す（同値の順位の並びを変えないため）。
+LONG_SORT_KEYS = ["table", "metric", "cat1", "year"]
+
+
+def build_key_index(df_long):
+    """
+    LONG_SORT_KEYS の各列を辞書順の整数コードにし、行ごとの複合キー配列を作る。
+    戻り値: {"levels": 列名 → 値の一覧（昇順）, "codes": 列名 → {値: コード}, "sizes": 各列のコード数, "keys": 複合キー（int64）}
+    """
+    levels, codes = {}, []
+    for col in LONG_SORT_KEYS:
+        col_codes, values = pd.factorize(df_long[col], sort=True)
+        levels[col] = values.tolist()
+        codes.append(col_codes.astype(np.int64))
+    sizes = [len(levels[col]) + 1 for col in LONG_SORT_KEYS]  # 欠損（コード -1）を末尾に置くため +1
+    keys = np.zeros(len(df_long), dtype=np.int64)
+    for col_codes, size in zip(codes, sizes):
+        keys = keys * size + np.where(col_codes < 0, size - 1, col_codes)
+    return key_index_from_levels(levels, keys)
+
+
+def key_index_from_levels(levels, keys):
+    """各列の値の一覧 levels と複合キー配列 keys から build_key_index と同じ形の索引を作る（共有ディレクトリからの復元に使う）"""
+    return {
+        "levels": levels,
+        "codes": {col: {value: i for i, value in enumerate(levels[col])} for col in LONG_SORT_KEYS},
+        "sizes": [len(levels[col]) + 1 for col in LONG_SORT_KEYS],
+        "keys": keys,
+    }
+
+
+def key_range(key_index, table, metric=None, cat1=None, start=None, end=None):
+    """
+    (table[, metric[, cat1[, start〜end年]]]) に一致する行の位置範囲 (lo, hi) を二分探索で求める。
+    年の範囲は cat1 まで指定した場合のみ使う。該当なしは lo == hi。
+    """
+    prefix = [table, metric, cat1]
+    depth = next((i for i, value in enumerate(prefix) if value is None), len(prefix))
+    base = 0
+    for col, value, size in zip(LONG_SORT_KEYS[:depth], prefix[:depth], key_index["sizes"]):
+        code = key_index["codes"][col].get(value)
+        if code is None:
+            return 0, 0
+        base = base * size + code
+    span = 1
+    for size in key_index["sizes"][depth:]:
+        span *= size
+    lo_key, hi_key = base * span, (base + 1) * span
+    if depth == 3 and (start is not None or end is not None):
+        years = key_index["levels"]["year"]
+        if start is not None:
+            lo_key = base * span + bisect.bisect_left(years, start)
+        if end is not None:
+            hi_key = base * span + bisect.bisect_right(years, end)
+    keys = key_index["keys"]
+    return int(keys.searchsorted(lo_key, side="left")), int(keys.searchsorted(hi_key, side="left"))
+
+
+@st.cache_resource
+def _key_index_registry():
+    """build_dataset で索引付けしたフレームの登録先（id → (弱参照, 索引, 先頭位置, テーブル名)）。再実行をまたいで共有する"""
+    return {}
+
+
+def register_key_index(frame, key_index, offset=0, table=None):
+    """frame を索引付きとして登録する（offset: 索引上の先頭位置、table: テーブル単位のビューならテーブル名）"""
+    registry = _key_index_registry()
+    frame_id = id(frame)
+
+    def forget(ref):
+        if registry.get(frame_id, (None,))[0] is ref:
+            registry.pop(frame_id, None)
+
+    registry[frame_id] = (weakref.ref(frame, forget), key_index, offset, table)
+
+
+@st.cache_resource
+def _derived_frame_registry():
+    """生の指標のフレーム → 同じ範囲の派生指標のフレーム の登録先（id → (弱参照, 派生指標のフレーム)）"""
+    return {}
+
+
+def register_derived_frame(frame, derived):
+    """frame（生の指標）に対応する派生指標のフレームを登録する。select_rows は派生指標をこちらから取り出す"""
+    registry = _derived_frame_registry()
+    frame_id = id(frame)
+
+    def forget(ref):
+        if registry.get(frame_id, (None,))[0] is ref:
+            registry.pop(frame_id, None)
+
+    registry[frame_id] = (weakref.ref(frame, forget), derived)
+
+
+def metric_frame(df, metric):
+    """
+    metric の行を持つフレーム（派生指標で df に派生指標のフレームが登録されていればそのフレーム、それ以外は df）。
+    派生指標を、登録の無い生の指標のフレーム（build_dataset のビューのコピー・reset_index の結果など）に求めると、
+    黙って空の結果を返さないよう ValueError にする（df 自体が派生指標の行を持つ場合・空の場合は df を使う）。
+    """
+    if metric not in DERIVED_METRICS:
+        return df
+    entry = _derived_frame_registry().get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    if len(df) and not (df["metric"] == metric).any():
+        raise ValueError(
+            f"派生指標 {metric} を求めたフレームに派生指標のフレームが登録されていません"
+            "（build_dataset のデータセットの long・tables のビューを渡してください）"
+        )
+    return df
+
+
+def select_rows(df, metric=None, cat1=None, start=None, end=None, table=None, cities=None, exclude_cities=None):
+    """
+    df から条件（metric・cat1・年の範囲・table）に一致する行を取り出す。
+    build_dataset で索引付けしたフレームなら二分探索で求めた連続区間のスライス、
+    それ以外は boolean mask で抽出する（どちらも df.query と同じ行・順序）。
+    cities / exclude_cities を指定すると、さらに市町村で絞り込む・除外する。
+    派生指標（DERIVED_METRICS）は df に登録された派生指標のフレーム（metric_frame）から取り出す。
+    """
+    rows = _select_key_rows(metric_frame(df, metric), metric, cat1, start, end, table)
+    if cities is not None:
+        rows = rows[rows["city"].isin(list(cities))]
+    if exclude_cities is not None:
+        rows = rows[~rows["city"].isin(list(exclude_cities))]
+    return rows
+
+
+def _select_key_rows(df, metric, cat1, start, end, table):
+    entry = _key_index_registry().get(id(df))
+    if entry is not None and entry[0]() is df:
+        _, key_index, offset, frame_table = entry
+        table = table if table is not None else frame_table
+        if table is not None and (metric is not None or (cat1 is None and start is None and end is None)):
+            lo, hi = key_range(key_index, table, metric, cat1, start, end)
+            rows = df.iloc[max(lo - offset, 0):max(hi - offset, 0)]
+            if cat1 is None and (start is not None or end is not None):
+                rows = rows[rows["year"].between(start if start is not None else -np.inf, end if end is not None else np.inf)]
+            return rows
+
+    mask = np.ones(len(df), dtype=bool)
+    if table is not None:
+        mask &= (df["table"] == table).to_numpy()
+    if metric is not None:
+        mask &= (df["metric"] == metric).to_numpy()
+    if cat1 is not None:
+        mask &= (df["cat1"] == cat1).to_numpy()
+    if start is not None:
+        mask &= (df["year"] >= start).to_numpy()
+    if end is not None:
+        mask &= (df["year"] <= end).to_numpy()
+    return df[mask]
+
+
+@timed()
+def split_tables(df_long):
+    """
+    normalize_long_table() の結果をテーブルごとの iloc スライスに分割する。
+    各スライスは df_long とバッファを共有するビューで、df_long.query("table == ...") と同じ行・順序になる。
+    テーブル順に並んでいない場合はソートしたコピーから切り出す。
+    """
+    codes, tables = pd.factorize(df_long["table"])
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    if len(codes) and len(bounds) + 1 > len(tables) + int((codes < 0).any()):
+        # テーブル順に並んでいない場合は安定ソートしてから分割する
+        return split_tables(df_long.sort_values("table", kind="stable"))
+    starts = np.concatenate([[0], bounds])
+    stops = np.concatenate([bounds, [len(codes)]])
+    return {
+        tables[codes[start]]: df_long.iloc[start:stop]
+        for start, stop in zip(starts, stops) if len(codes) and codes[start] >= 0
+    }
+
+
+def table_frame(tables, table, df_long):
+    """split_tables() の結果から table のビューを取り出す（存在しない場合は空のDataFrame）"""
+    return tables.get(table, df_long.iloc[0:0])
+
+
+@timed()
+def build_availability_catalog(df_long):
+    """
+    どの (table, metric, cat1, year, city) の組み合わせにデータがあるかをまとめたカタログを作る。
+    データの有無・選択肢の年度・「データなし」の案内をデータフレームを走査せずに返すために使う。
+
+    キー:
+      index       : (table, metric, cat1, year, city) の MultiIndex（存在確認用）
+      years       : (table, metric, cat1) → 存在する年（昇順タプル）
+      rows        : (table, metric) → 行数
+      cat1        : (table, metric) → cat1 の一覧
+      metrics     : table → metric の一覧
+      table_years : table → 存在する年
+      all_years   : 全テーブルの年（昇順）
+      coverage    : (table, year) ごとの行数・市町村数・cat1数（データのない年は 0）
+      gaps        : coverage のうち、データがない・市町村やカテゴリが欠けている年
+    """
+    # 文字列の比較を避けるため、各列を整数コードにしてから numpy で集計する
+    cols = ["table", "metric", "cat1", "year", "city"]
+    factorized = {col: pd.factorize(df_long[col], sort=True) for col in cols}
+    levels = {col: factorized[col][1] for col in cols}
+    label = {col: np.asarray(levels[col], dtype=object) for col in cols}
+    label["year"] = np.asarray(levels["year"]).astype(int)
+    sizes = {col: max(len(levels[col]), 1) for col in cols}
+    valid = np.logical_and.reduce([factorized[col][0] >= 0 for col in cols])
+    t, m, c, y, city = (factorized[col][0][valid].astype(np.int64) for col in cols)
+
+    # (table, metric, cat1, year) の組み合わせ
+    tmc = (t * sizes["metric"] + m) * sizes["cat1"] + c
+    combos = np.unique(tmc * sizes["year"] + y)
+    combo_tmc, combo_y = np.divmod(combos, sizes["year"])
+    combo_tm, combo_c = np.divmod(combo_tmc, sizes["cat1"])
+    combo_t, combo_m = np.divmod(combo_tm, sizes["metric"])
+
+    years = {}
+    starts = np.flatnonzero(np.r_[True, combo_tmc[1:] != combo_tmc[:-1]])
+    for start, stop in zip(starts, np.r_[starts[1:], len(combos)]):
+        key = (label["table"][combo_t[start]], label["metric"][combo_m[start]], label["cat1"][combo_c[start]])
+        years[key] = tuple(label["year"][combo_y[start:stop]].tolist())
+
+    tm_rows = np.bincount(t * sizes["metric"] + m, minlength=sizes["table"] * sizes["metric"])
+    rows, cat1, metrics, table_years = {}, {}, {}, {}
+    for ti, table in enumerate(label["table"]):
+        in_table = combo_t == ti
+        if not in_table.any():
+            continue
+        metrics[table] = tuple(sorted(label["metric"][np.unique(combo_m[in_table])]))
+        table_years[table] = tuple(label["year"][np.unique(combo_y[in_table])].tolist())
+        for mi in np.unique(combo_m[in_table]):
+            rows[(table, label["metric"][mi])] = int(tm_rows[ti * sizes["metric"] + mi])
+            cat1[(table, label["metric"][mi])] = tuple(sorted(label["cat1"][np.unique(combo_c[in_table & (combo_m == mi)])]))
+    all_years = tuple(label["year"].tolist())
+
+    # (table, year) ごとの行数・市町村数・cat1数
+    ty = t * sizes["year"] + y
+    n_ty = sizes["table"] * sizes["year"]
+    coverage = pd.DataFrame({
+        "rows": np.bincount(ty, minlength=n_ty),
+        "cities": np.bincount(np.unique(ty * sizes["city"] + city) // sizes["city"], minlength=n_ty),
+        "cat1": np.bincount(np.unique(ty * sizes["cat1"] + c) // sizes["cat1"], minlength=n_ty),
+    }, index=pd.MultiIndex.from_product([label["table"], label["year"]], names=["table", "year"]))
+    coverage = coverage.loc[list(table_years)]
+    full = coverage.groupby(level="table").transform("max")
+    reasons = pd.Series("", index=coverage.index)
+    reasons[coverage["cities"] < full["cities"]] = "市町村の欠落"
+    reasons[coverage["cat1"] < full["cat1"]] = "カテゴリの欠落"
+    reasons[coverage["rows"] == 0] = "データなし"
+
+    return {
+        "index": pd.MultiIndex(
+            levels=[levels[col] for col in cols], codes=[factorized[col][0] for col in cols],
+            names=cols, verify_integrity=False,
+        ),
+        "years": years,
+        "rows": rows,
+        "cat1": cat1,
+        "metrics": metrics,
+        "table_years": table_years,
+        "all_years": all_years,
+        "coverage": coverage,
+        "gaps": coverage.assign(reason=reasons)[reasons != ""],
+    }
+
+
+def available_years(catalog, table=None, metric=None, cat1="total", start=None, end=None, descending=False):
+    """
+    カタログから存在する年の一覧を返す。
+    table を省略すると全テーブル、metric を省略するとテーブル全体の年を返す。start / end で範囲を絞れる。
+    """
+    if table is None:
+        years = catalog["all_years"]
+    elif metric is None:
+        years = catalog["table_years"].get(table, ())
+    else:
+        years = catalog["years"].get((table, metric, cat1), ())
+    years = [y for y in years if (start is None or y >= start) and (end is None or y <= end)]
+    return years[::-1] if descending else years
+
+
+def available_categories(catalog, table, metric=None):
+    """カタログから table（metric を省略するとテーブル全体）の cat1 の一覧を返す（空欄・total を除き昇順）"""
+    metrics = [metric] if metric is not None else catalog["metrics"].get(table, ())
+    categories = set().union(*(catalog["cat1"].get((table, m), ()) for m in metrics))
+    return sorted(c for c in categories if c and c != "total")
+
+
+def catalog_count(catalog, table, level, start=None, end=None):
+    """カタログの索引から、table の start〜end 年の行に現れる level（"city" / "cat1" など）の値の数を返す"""
+    index = catalog["index"]
+    if table not in index.levels[0]:
+        return 0
+    codes = dict(zip(index.names, index.codes))
+    mask = codes["table"] == index.levels[0].get_loc(table)
+    if start is not None or end is not None:
+        years = index.levels[index.names.index("year")]
+        lo = years.searchsorted(start, side="left") if start is not None else 0
+        hi = years.searchsorted(end, side="right") if end is not None else len(years)
+        mask &= (codes["year"] >= lo) & (codes["year"] < hi)
+    values = codes[level][mask]
+    return int(np.unique(values[values >= 0]).size)
+
+
+def has_data(catalog, table, metric, cat1="total", year=None, city=None):
+    """(table, metric, cat1[, year[, city]]) のデータが存在するかをカタログで判定する"""
+    if year is None:
+        return (table, metric, cat1) in catalog["years"]
+    if city is None:
+        return year in catalog["years"].get((table, metric, cat1), ())
+    return (table, metric, cat1, year, city) in catalog["index"]
+
+
+# ---------------- 派生指標 ----------------
+# 1軒あたり客室数・1室あたり収容人数・構成比（DERIVED_METRICS）は、読み込み時に全 (table, cat1, city, year) の値を
+# 列単位の演算でまとめて計算し、生の指標と同じ列の long 形式フレームとして保持する。build_dataset で同じ索引に登録するため、
+# select_rows・版ごとのピボット・期間増減マトリクスは生の指標と同じ経路で派生指標を返す。
+# 分母が0・分母のない組み合わせは行を作らない（画面では欠損）。
+# 市町村を合算した値（エリア・県・ホテル種別の合計）は派生指標の合計ではなく、分子・分母それぞれの合計の比にする。
+
+
+def derived_ratio(metric, numerator, denominator):
+    """
+    派生指標 metric の値（numerator / denominator、構成比は ×100）を DERIVED_DECIMALS 桁に丸めて返す。
+    Series・DataFrame は要素ごとに計算して numerator の形に揃え、分母が0・欠損の要素は NaN にする。
+    """
+    scale = 100 if DERIVED_METRICS[metric]["share"] else 1
+    if isinstance(numerator, (pd.Series, pd.DataFrame)):
+        ratio = numerator * scale / denominator.where(denominator != 0)
+        return ratio.reindex_like(numerator).round(DERIVED_DECIMALS)
+    if pd.isna(denominator) or denominator == 0:
+        return np.nan
+    return round(float(numerator) * scale / float(denominator), DERIVED_DECIMALS)
+
+
+@timed()
+def build_derived_metrics(df_long):
+    """
+    生の指標の long 形式データから DERIVED_METRICS の long 形式フレームを作る（列は df_long と同じ、value は float）。
+    分子の指標の行をそのまま土台にし、分母は (table, metric, cat1, city, year) の索引から一括で引く。
+    行の並び（市町村の順序を含む）は分子の指標と同じになる。
+    """
+    keys = ["table", "metric", "cat1", "city", "year"]
+    lookup = df_long.groupby(keys, sort=False)["value"].sum()
+    frames = []
+    for metric, spec in DERIVED_METRICS.items():
+        base = df_long[(df_long["metric"] == spec["numerator"]).to_numpy()]
+        denominator_keys = pd.MultiIndex.from_arrays([
+            base["table"], np.full(len(base), spec["denominator"], dtype=object),
+            np.full(len(base), "total", dtype=object) if spec["share"] else base["cat1"],
+            base["city"], base["year"],
+        ], names=keys)
+        denominator = pd.Series(lookup.reindex(denominator_keys).to_numpy(dtype=float), index=base.index)
+        value = derived_ratio(metric, base["value"], denominator)
+        present = value.notna().to_numpy()
+        frames.append(base[present].assign(metric=metric, value=value[present]))
+    if not frames:
+        return df_long.iloc[0:0].astype({"value": float})
+    derived = pd.concat(frames, ignore_index=True)
+    return derived.astype({"metric": df_long["metric"].dtype})
+
+
+def location_total(df, metric, year, cities=None, exclude_cities=None):
+    """
+    year の (metric, total) の合計（cities / exclude_cities は select_rows と同じ絞り込み）。
+    派生指標は分子・分母それぞれの合計の比（構成比の分母は total なので分子と同じ行になる）。
+    """
+    spec = DERIVED_METRICS.get(metric)
+    if spec is None:
+        return select_rows(df, metric, "total", year, year, cities=cities, exclude_cities=exclude_cities)['value'].sum()
+    return derived_ratio(
+        metric,
+        location_total(df, spec["numerator"], year, cities, exclude_cities),
+        location_total(df, spec["denominator"], year, cities, exclude_cities),
+    )
+
+
+def pick_analysis_table(table_names):
+    """存在するテーブル名から分析用テーブルを ANALYSIS_TABLE_PRIORITY の順に選ぶ（該当なしは None）"""
+    table_names = set(table_names)
+    return next((t for t in ANALYSIS_TABLE_PRIORITY if t in table_names), None)
+
+
+@timed()
+def build_dataset(df_long, prebuilt=None):
+    """
+    整形済みの long 形式データから、アプリ全体で共有するデータセットを構築する。
+    テーブル分割と分析用テーブルの選択をここで1回だけ行い、質問ごとの全件検索をなくす。
+    行は (table, metric, cat1, year) 順に並べ替え、long と各テーブルのビューを select_rows の索引に登録する。
+    prebuilt: 共有ディレクトリの構築済みの部品 {"key_index", "derived", "derived_index"}（attach_shared）。
+              渡した場合は df_long が並べ替え済みとして、索引の作成と派生指標の計算を省く。
+
+    キー:
+      long           : df_long（(table, metric, cat1, year) 順）
+      tables         : テーブル名 → df_long のビュー（split_tables）
+      table_rows     : 存在するテーブルのカタログ（テーブル名 → 行数）
+      analysis_table : 分析用テーブル名（ANALYSIS_TABLE_PRIORITY 順。該当なしは "全テーブル"）
+      analysis       : 分析用テーブルのビュー（該当なしは df_long 全体）
+      catalog        : データ有無カタログ（build_availability_catalog）
+      key_index      : 並べ替え済みキー索引（build_key_index）
+      derived        : 派生指標の long 形式データ（build_derived_metrics。long と同じ順に並べ替え・索引付け済み）
+      derived_tables : テーブル名 → derived のビュー（tables の各ビューに対応付けて登録する）
+      derived_index  : derived のキー索引（build_key_index）
+      version        : データ内容の版（dataset_version）。派生データのキャッシュキーに使う
+    """
+    key_index = prebuilt["key_index"] if prebuilt is not None else build_key_index(df_long)
+    if len(df_long) and (np.diff(key_index["keys"]) < 0).any():
+        # (table, metric, cat1, year) 順に安定ソートした正規の並びにする
+        order = np.argsort(key_index["keys"], kind="stable")
+        df_long = df_long.take(order)
+        key_index["keys"] = key_index["keys"][order]
+    tables = split_tables(df_long)
+    table_rows = {table: len(frame) for table, frame in tables.items() if len(frame)}
+    analysis_table = pick_analysis_table(table_rows)
+
+    register_key_index(df_long, key_index)
+    offset = 0
+    for table, frame in tables.items():
+        register_key_index(frame, key_index, offset, table)
+        offset += len(frame)
+
+    if prebuilt is not None:
+        derived, derived_index = prebuilt["derived"], prebuilt["derived_index"]
+    else:
+        derived = build_derived_metrics(df_long)
+        derived_index = build_key_index(derived)
+        order = np.argsort(derived_index["keys"], kind="stable")
+        derived = derived.take(order).reset_index(drop=True)
+        derived_index["keys"] = derived_index["keys"][order]
+    derived_tables = split_tables(derived)
+    register_key_index(derived, derived_index)
+    register_derived_frame(df_long, derived)
+    offset = 0
+    for table, frame in derived_tables.items():
+        register_key_index(frame, derived_index, offset, table)
+        offset += len(frame)
+    for table, frame in tables.items():
+        register_derived_frame(frame, table_frame(derived_tables, table, derived))
+    return {
+        "long": df_long,
+        "tables": tables,
+        "table_rows": table_rows,
+        "analysis_table": analysis_table or "全テーブル",
+        "analysis": tables[analysis_table] if analysis_table else df_long,
+        "catalog": build_availability_catalog(df_long),
+        "key_index": key_index,
+        "derived": derived,
+        "derived_tables": derived_tables,
+        "derived_index": derived_index,
+        "version": dataset_version(df_long, key_index),
+    }
+
+
+# ---------------- 版ごとの派生データ ----------------
+# Streamlit は操作のたびにスクリプトを再実行するため、データセットの辞書は毎回作り直される。
+# ピボットや期間増減マトリクスのような派生データはデータ内容の版をキーにして再実行をまたいで保持し、
+# スライダー操作などでは保持済みの派生データを切り出すだけにする。
+# 破棄は最後に使われた順（古い版を表示し続けるセッションが使っても、現在の版は破棄しない）。
+DERIVED_VERSIONS = 2  # 保持する版の数（最も長く使われていない版から破棄）
+
+
+def dataset_version(df_long, key_index):
+    """(table, metric, cat1, year) の複合キー・市町村・値から、データ内容の版を表す短いハッシュを作る"""
+    city_codes, cities = pd.factorize(df_long["city"], sort=False)
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(json.dumps([key_index["levels"][col] for col in LONG_SORT_KEYS], ensure_ascii=False, default=str).encode())
+    digest.update(json.dumps(cities.tolist(), ensure_ascii=False).encode())
+    for array in (key_index["keys"], city_codes, df_long["value"].to_numpy()):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+@st.cache_resource
+def _derived_store():
+    """版 → 種類 → 派生データ の保持先（最後に使われた順）と、更新用のロック。再実行・セッションをまたいで共有する"""
+    return OrderedDict(), threading.Lock()
+
+
+def _current_version():
+    """現在の版（_loaded_store）のデータセットの版。未読み込みなら None"""
+    current = _loaded_store()[0]["current"]
+    return current["dataset"]["version"] if current is not None and current["dataset"] is not None else None
+
+
+def _release_version(entry):
+    """破棄する版の派生データが持つ外部資源を閉じる（SQL 用 DB の接続。実行中の問い合わせは自分の接続で最後まで動く）"""
+    database = entry.get("sql", {}).get("database")
+    if database is not None:
+        database["anchor"].close()
+
+
+def derived_cache(dataset, kind):
+    """
+    dataset の版に対応する kind の派生データ辞書。
+    新しい版を登録すると、現在の版を除き最も長く使われていない版から破棄する。
+    """
+    store, lock = _derived_store()
+    version = dataset["version"]
+    with lock:
+        if version in store:
+            store.move_to_end(version)
+        else:
+            pinned = _current_version()
+            for old in [old for old in store if old != pinned][:max(0, len(store) - DERIVED_VERSIONS + 1)]:
+                _release_version(store.pop(old))
+            store[version] = {}
+        return store[version].setdefault(kind, {})
+
+
+# ---------------- 表間の整合性チェック ----------------
+# 同じ量を複数のテーブルが報告しているため、(市町村, 年, 指標) ごとに次の恒等式が成り立つ。
+# 読み込み時に long 形式データ全体を1回集計し、式ごとに左右を突き合わせて不一致を報告する。
+# 両辺のテーブルがそろっているキーだけを比較する（例: hotel_breakdown は 2014 年以降）。
+# ※ scale_class（規模別）はホテル・旅館の内訳であり、宿泊施設全体の合計とは一致しない。
+HOTEL_BREAKDOWN_PARTS = [
+    f"{kind}_{size}"
+    for kind in ["resort_hotel", "business_hotel", "city_hotel", "ryokan"]
+    for size in ["large", "medium", "small"]
+]
+CONSISTENCY_RULES = [
+    ("宿泊形態: 合計 = 各形態の和", ("accommodation_type", ["total"]),
+     ("accommodation_type", ["hotel_ryokan", "minshuku", "pension_villa", "dormitory_guesthouse",
+                             "weekly_mansion", "group_facilities", "youth_hostel"])),
+    ("規模別: 合計 = 大規模 + 中規模 + 小規模", ("scale_class", ["total"]), ("scale_class", ["large", "medium", "small"])),
+    ("規模別の合計 = 宿泊形態のホテル・旅館", ("scale_class", ["total"]), ("accommodation_type", ["hotel_ryokan"])),
+    ("ホテル内訳: 合計 = 各内訳の和", ("hotel_breakdown", ["total"]), ("hotel_breakdown", HOTEL_BREAKDOWN_PARTS)),
+    ("ホテル内訳の合計 = 宿泊形態のホテル・旅館", ("hotel_breakdown", ["total"]), ("accommodation_type", ["hotel_ryokan"])),
+]
+CONSISTENCY_COLUMNS = ["検査", "指標", "年", "市町村", "左辺", "右辺", "差"]
+CONSISTENCY_MODE = os.environ.get("OKINAWA_CONSISTENCY", "warn")  # warn: 報告のみ / block: 不一致が増える再読み込みを止める
+
+
+@timed()
+def check_consistency(df_long):
+    """
+    CONSISTENCY_RULES の恒等式を (市町村, 年, 指標) ごとに検査する。
+    戻り値: 不一致の一覧（CONSISTENCY_COLUMNS。すべて一致すれば空）
+    """
+    # (table, cat1) ごとの列に (metric, year, city) の値を並べた表（集計1回・並べ替えなし）
+    wide = (
+        df_long[df_long["cat1"].notna()]
+        .groupby(["metric", "year", "city", "table", "cat1"], sort=False)["value"].sum()
+        .unstack(["table", "cat1"])
+    )
+    values = wide.to_numpy(dtype=float)
+    position = {column: i for i, column in enumerate(wide.columns)}
+
+    def side(table, cats):
+        columns = [position[(table, cat)] for cat in cats if (table, cat) in position]
+        if not columns:
+            return None
+        # 列がすべて欠けているキーは NaN（比較しない）
+        part = values[:, columns]
+        return np.where(np.isnan(part).all(axis=1), np.nan, np.nansum(part, axis=1))
+
+    reports = []
+    for name, left_spec, right_spec in CONSISTENCY_RULES:
+        left, right = side(*left_spec), side(*right_spec)
+        if left is None or right is None:
+            continue
+        mask = ~np.isnan(left) & ~np.isnan(right) & (left != right)
+        if not mask.any():
+            continue
+        report = wide.index[mask].to_frame(index=False)
+        report.insert(0, "検査", name)
+        report["左辺"] = left[mask]
+        report["右辺"] = right[mask]
+        reports.append(report)
+    if not reports:
+        return pd.DataFrame(columns=CONSISTENCY_COLUMNS)
+    report = pd.concat(reports, ignore_index=True).rename(columns={"metric": "指標", "year": "年", "city": "市町村"})
+    report["指標"] = report["指標"].map(METRIC_JP).fillna(report["指標"])
+    report["差"] = report["左辺"] - report["右辺"]
+    return report[CONSISTENCY_COLUMNS]
+
+
+def new_inconsistencies(report, baseline):
+    """report のうち baseline に無い不一致（検査・指標・年・市町村が同じで差も同じものは既知として除く）"""
+    keys = ["検査", "指標", "年", "市町村", "差"]
+    if baseline is None or baseline.empty:
+        return report
+    merged = report.merge(baseline[keys].drop_duplicates(), on=keys, how="left", indicator=True)
+    return report[(merged["_merge"] == "left_only").to_numpy()]
+
+
+def render_data_check_panel(loaded):
+    """読み込み時の検査結果（表間の整合性・ソース間の上書き）をサイドバーのパネルとして表示する"""
+    with st.sidebar.expander("🧾 データ検査", expanded=True):
+        report = loaded.get("consistency")
+        if report is None:
+            st.write("データが読み込まれていません")
+            return
+        st.caption(f"表間の整合性: 検査式 {len(CONSISTENCY_RULES)} 件 / 不一致 {len(report):,} 件")
+        if report.empty:
+            st.write("すべての検査式が一致しています")
+        else:
+            st.dataframe(report.groupby("検査", sort=False).size().rename("件数").reset_index(), hide_index=True)
+            show_table(report, hide_index=True)
+
+        conflicts = loaded.get("merge_conflicts")
+        if conflicts is None:
+            return
+        st.caption(f"ソース間の上書き（優先: {MERGE_PRECEDENCE}）: 値が異なるもの {len(conflicts):,} 件")
+        if not conflicts.empty:
+            show_table(conflicts, hide_index=True)
+
+
+# ---------------- 読み込み済みデータの保持 ----------------
+# CSV・Transition.xlsx の読み込みとデータセット構築はプロセスで1回だけ行い、再実行・セッションをまたいで共有する。
+# 読み込み済みデータは版ごとの辞書（作成後は変更しない）として保持し、新しい版は丸ごと差し替える（二重バッファ）。
+# ・サーバー実行時: バックグラウンドの監視スレッドが data/raw・data/processed の読み込み対象ファイルの
+#   サイズ・更新時刻を定期的に調べ、変化が落ち着いたら（2回続けて同じ状態なら）リクエストとは別に
+#   読み込み・派生データの作成を行ってから現在の版を差し替える。読み手はロックを取らずに現在の版を参照し、
+#   実行中のスクリプトは取得済みの古い版のまま最後まで表示する。
+# ・監視スレッドが無い場合（CLI・bare モード、OKINAWA_RELOAD_INTERVAL=0）: 参照のたびにファイルを調べ、
+#   変化していればその場で読み込み直す。
+RELOAD_INTERVAL = float(os.environ.get("OKINAWA_RELOAD_INTERVAL", "2"))  # 監視間隔（秒）。0 以下で監視しない
+
+
+def data_signature():
+    """読み込み対象ファイル（パス・サイズ・更新時刻）の一覧。データディレクトリの内容が変わったかどうかの判定に使う"""
+    files = sorted(BY_YEAR_DIR.glob("long_*.csv")) if BY_YEAR_DIR.exists() else []
+    files += [CSV_LONG, TRANSITION_XLSX, RAW_DIR / "region_master.json"]
+    signature = []
+    for path in files:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        signature.append((str(path), stat.st_size, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+@st.cache_resource
+def _loaded_store():
+    """読み込み済みデータの保持先（current: 現在の版 / previous: 直前の版）と、読み込み用のロック"""
+    return {"current": None, "previous": None}, threading.Lock()
+
+
+def _load_local(signature):
+    """データディレクトリの CSV・Transition.xlsx を読み込んでデータセットを構築する"""
+    df_long, merge_conflicts = load_all_data(with_conflicts=True)
+    return {
+        "signature": signature,
+        "prefecture": load_transition_total(TRANSITION_XLSX),
+        "dataset": build_dataset(normalize_long_table(df_long)) if not df_long.empty else None,
+        "shared_version": None,
+        "merge_conflicts": merge_conflicts,
+    }
+
+
+def _load_data(signature):
+    with collect_load_problems() as problems:
+        shared = bool(SHARED_DIR)
+        if shared and not shared_dir_supported():
+            report_load_problem("warning", f"共有ディレクトリ {SHARED_DIR} には pyarrow が必要です。共有せずに読み込みます")
+            shared = False
+        loaded = _load_shared(Path(SHARED_DIR), signature) if shared else _load_local(signature)
+    loaded["problems"] = problems
+    dataset = loaded["dataset"]
+    loaded["consistency"] = check_consistency(dataset["long"]) if dataset is not None else None
+    if loaded["consistency"] is not None and not loaded["consistency"].empty:
+        counts = loaded["consistency"].groupby("検査", sort=False).size()
+        TIMING_LOG.warning(json.dumps({"event": "consistency", "version": dataset["version"],
+                                       "mismatches": counts.to_dict()}, ensure_ascii=False))
+    release_free_memory()
+    return loaded
+
+
+def _swap_in(store, loaded):
+    """loaded を現在の版にする（直前の版は previous に残し、参照中の実行はそのまま使い続ける）"""
+    store["previous"], store["current"] = store["current"], loaded
+    return loaded
+
+
+def _loaded_data():
+    """
+    現在の版の読み込み済みデータ {signature, prefecture, dataset, shared_version, merge_conflicts, consistency, problems}。
+    未読み込みならその場で読み込む。監視スレッドが無い場合はファイルの変化もここで反映する。
+    """
+    store, lock = _loaded_store()
+    watcher = _reload_watcher() if st.runtime.exists() else None
+    loaded = store["current"]
+    if loaded is not None and (watcher is not None or loaded["signature"] == data_signature()):
+        return loaded
+    with lock:
+        signature = data_signature()
+        loaded = store["current"]
+        if loaded is None or loaded["signature"] != signature:
+            loaded = _swap_in(store, _load_data(signature))
+        return loaded
+
+
+def get_loaded_data():
+    """このスクリプト実行で使う読み込み済みデータ（1回の実行の中では同じ版を使い続けるため、先頭で1回だけ取得する）"""
+    return _loaded_data()
+
+
+def get_prefecture_data():
+    """県全体データ（load_transition_total）。ファイルに変化がなければ読み込み済みのものを返す"""
+    return _loaded_data()["prefecture"]
+
+
+def get_dataset():
+    """データセット（build_dataset）。ファイルに変化がなければ読み込み済みのものを返す。データファイルが無い場合は None"""
+    return _loaded_data()["dataset"]
+
+
+def reload_data(signature=None):
+    """
+    データを読み込み直し、派生データ（ウォームアップと同じもの）を作ってから現在の版を差し替える。
+    読み込みに失敗した場合・読み込みの問題（report_load_problem）が増えた場合・データファイルが無くなった場合は
+    現在の版を残す（監視スレッドが例外を TIMING_LOG に記録する）。
+    戻り値: 差し替えた版の読み込み済みデータ（差し替えなかった場合は None）
+    """
+    store, lock = _loaded_store()
+    with lock:
+        signature = signature or data_signature()
+        current = store["current"]
+        if current is not None and current["signature"] == signature:
+            return None
+        started = time.perf_counter()
+        with timed_stage("reload/データ読み込み"):
+            loaded = _load_data(signature)
+        # 現在の版にも同じ問題がある場合（pyarrow が無いなど）は、差し替えても悪くならないため止めない
+        added = [problem for problem in loaded["problems"] if current is not None and problem not in current.get("problems", ())]
+        if added:
+            raise RuntimeError(f"データファイルの読み込みで問題が {len(added)} 件増えたため、"
+                               f"現在の版を使い続けます（{added[0]['message']}）")
+        if loaded["dataset"] is None and current is not None and current["dataset"] is not None:
+            raise RuntimeError("データファイルが見つからないため、現在の版を使い続けます")
+        if CONSISTENCY_MODE == "block" and loaded["consistency"] is not None and current is not None:
+            added = new_inconsistencies(loaded["consistency"], current.get("consistency"))
+            if not added.empty:
+                raise RuntimeError(f"表間の不一致が {len(added)} 件増えたため、現在の版を使い続けます")
+        if loaded["dataset"] is not None:
+            for name, build in warm_up_stages(loaded):
+                with timed_stage(f"reload/{name}"):
+                    build()
+        _swap_in(store, loaded)
+    dataset = loaded["dataset"]
+    warmup, _ = _warmup_state()
+    if warmup["ready"] and dataset is not None:
+        # 差し替えた版の派生データは作成済みのため、準備状況も新しい版に更新する
+        warmup.update(version=dataset["version"], signature=loaded["signature"])
+        if os.environ.get("OKINAWA_READY_FILE"):
+            write_ready_file(os.environ["OKINAWA_READY_FILE"], warmup_status())
+    TIMING_LOG.info(json.dumps({
+        "event": "reload",
+        "version": dataset["version"] if dataset is not None else None,
+        "previous": current["dataset"]["version"] if current is not None and current["dataset"] is not None else None,
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+    }, ensure_ascii=False))
+    return loaded
+
+
+@st.cache_resource
+def _reload_watcher():
+    """データファイルの監視スレッドを起動する（プロセスで1つ）。戻り値: 監視状況の辞書（監視しない設定なら None）"""
+    if RELOAD_INTERVAL <= 0:
+        return None
+    state = {"checks": 0, "reloads": 0, "last_reload": None, "error": None}
+    threading.Thread(target=_watch_data, args=(state,), name="okinawa-data-watcher", daemon=True).start()
+    return state
+
+
+def _watch_data(state):
+    store, _ = _loaded_store()
+    pending = failed = None
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            signature = data_signature()
+            state["checks"] += 1
+            current = store["current"]
+            if current is None or current["signature"] == signature or signature == failed:
+                pending = None
+                continue
+            if pending != signature:
+                pending = signature  # 書き込み途中のファイルを読まないよう、次の確認まで待つ
+                continue
+            pending, failed = None, signature  # 失敗した場合はファイルが再び変わるまで読み込み直さない
+            if reload_data(signature) is not None:
+                state.update(reloads=state["reloads"] + 1, last_reload=time.strftime("%Y-%m-%dT%H:%M:%S"), error=None)
+            failed = None
+        except Exception as e:
+            state["error"] = f"{type(e).__name__}: {e}"
+            TIMING_LOG.warning(json.dumps({"event": "reload", "error": state["error"]}, ensure_ascii=False))
+
+
+# ---------------- 共有データセット（メモリマップ Arrow） ----------------
+# 同じホストで複数の Streamlit プロセスを動かす場合、整形・並べ替え済みの long 形式データ・派生指標・県全体データと
+# キー索引を版ごとのファイル（Arrow IPC・.npy）に1回だけ書き出し、各プロセスは読み取り専用でメモリマップして共有する。
+# ・有効化: 環境変数 OKINAWA_SHARED_DIR に共有ディレクトリを指定する（pyarrow が必要。import できなければ
+#   読み込みの問題として報告し、共有せずにプロセスごとに読み込む）
+# ・<共有ディレクトリ>/<版>/ に long.arrow・derived.arrow・prefecture.arrow・long_keys.npy・derived_keys.npy・
+#   manifest.json（キー索引の値の一覧を含む）を書き終えてから、
+#   CURRENT（現在の版を指す JSON）を os.replace で置き換える（読み手は常に書き終えた版だけを見る）
+# ・CURRENT のデータシグネチャが自プロセスの data_signature() と一致すれば CSV を読まずにその版を使う
+# ・一致しなければプロセス間ロックを取って1プロセスだけが読み込み・書き出しを行う
+# ・古い版は SHARED_KEEP_VERSIONS を超えた分から削除する（マップ済みのプロセスは削除後も読み続けられる）
+# 数値列・文字列列（pandas の Arrow 文字列型）とキー配列はマップした領域をそのまま参照するため、
+# プロセスごとに持つのは、テーブル別ビュー・カタログ・小さな辞書と、表示中に作る版ごとの派生データ
+# （ピボット・キューブ・期間増減マトリクス。derived_cache）だけになる。
+# 読み込みの一時配列で伸びたヒープは release_free_memory で OS に返す。
+# ※ プロセスの大半（1プロセス約 140 MB）は Python・pandas・Streamlit・plotly の読み込み分で、共有できない。
+SHARED_DIR = os.environ.get("OKINAWA_SHARED_DIR")
+SHARED_KEEP_VERSIONS = 2
+SHARED_INDEX_COLUMN = "__index__"
+
+
+def shared_dir_supported():
+    """共有ディレクトリの読み書き（Arrow IPC）に使う pyarrow を import できるか"""
+    try:
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _arrow_table(frame, index=False):
+    """frame を Arrow の表にする（数値列は NaN を値のまま保持し、読み込み時にコピーなしで参照できる形にする）"""
+    import pyarrow as pa
+
+    columns = {SHARED_INDEX_COLUMN: pa.array(frame.index.to_numpy())} if index else {}
+    for name, series in frame.items():
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            columns[str(name)] = pa.array(series.to_numpy())
+        else:
+            columns[str(name)] = pa.array(series.astype(object), type=pa.large_string(), from_pandas=True)
+    return pa.table(columns)
+
+
+def _write_arrow(path, table):
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    with pa.OSFile(str(path), "wb") as sink, ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_arrow(path):
+    """Arrow IPC ファイルをメモリマップして DataFrame にする（マップした領域を参照し、可能な列はコピーしない）"""
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+
+    table = ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    frame = table.to_pandas(split_blocks=True)
+    if SHARED_INDEX_COLUMN in frame.columns:
+        frame.index = pd.Index(frame.pop(SHARED_INDEX_COLUMN).to_numpy())
+    return frame
+
+
+def _signature_json(signature):
+    return [list(entry) for entry in signature]
+
+
+@contextmanager
+def _shared_lock(root):
+    """共有ディレクトリのプロセス間ロック（fcntl が無い環境ではロックなし。書き出しは版ごとの置き換えで整合を保つ）"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(root / ".lock", "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def read_shared_manifest(root):
+    """CURRENT が指す版の manifest（無い・壊れている場合は None）"""
+    try:
+        current = json.loads((Path(root) / "CURRENT").read_text(encoding="utf-8"))
+        return json.loads((Path(root) / current["version"] / "manifest.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+@timed()
+def publish_shared(root, signature, dataset, pref_df, merge_conflicts=None):
+    """
+    dataset（build_dataset）の long・派生指標・キー索引と県全体データを版ごとのディレクトリに書き出し、CURRENT を切り替える。
+    版はデータ内容のハッシュ（dataset_version）。読み込み時の上書きの一覧（merge_sources）は manifest に記録する。
+    戻り値: 版
+    """
+    import shutil
+
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    df_long = dataset["long"]
+    version = dataset["version"]
+    target = root / version
+    conflicts = [] if merge_conflicts is None else (
+        merge_conflicts.astype(object).where(merge_conflicts.notna(), None).to_dict(orient="records")
+    )
+    if not target.exists():
+        tmp = root / f".tmp-{version}-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        try:
+            _write_arrow(tmp / "long.arrow", _arrow_table(df_long, index=True))
+            _write_arrow(tmp / "derived.arrow", _arrow_table(dataset["derived"]))
+            _write_arrow(tmp / "prefecture.arrow", _arrow_table(pref_df))
+            np.save(tmp / "long_keys.npy", dataset["key_index"]["keys"])
+            np.save(tmp / "derived_keys.npy", dataset["derived_index"]["keys"])
+            (tmp / "manifest.json").write_text(json.dumps({
+                "version": version,
+                "key_levels": {"long": dataset["key_index"]["levels"], "derived": dataset["derived_index"]["levels"]},
+                "signature": _signature_json(signature),
+                "data_dir": str(DATA_DIR),
+                "rows": int(len(df_long)),
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "merge_conflicts": conflicts,
+            }, ensure_ascii=False, indent=2, default=int), encoding="utf-8")
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)  # 書きかけの版を残さない
+            raise
+        try:
+            os.replace(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)  # 他のプロセスが同じ版を書き出し済み
+    else:
+        # 内容が同じでもファイルのシグネチャ・上書きの一覧は変わりうるため manifest だけ更新する
+        manifest = json.loads((target / "manifest.json").read_text(encoding="utf-8"))
+        manifest.update(signature=_signature_json(signature), merge_conflicts=conflicts)
+        tmp_manifest = target / f"manifest.json.{os.getpid()}"
+        tmp_manifest.write_text(json.dumps(manifest, ensure_ascii=False, indent=2, default=int), encoding="utf-8")
+        os.replace(tmp_manifest, target / "manifest.json")
+
+    tmp_current = root / f"CURRENT.{os.getpid()}"
+    tmp_current.write_text(json.dumps({"version": version}), encoding="utf-8")
+    os.replace(tmp_current, root / "CURRENT")
+    _prune_shared(root, keep=version)
+    return version
+
+
+def _prune_shared(root, keep):
+    """古い版のディレクトリを削除する（新しい順に SHARED_KEEP_VERSIONS 個を残す）"""
+    import shutil
+
+    versions = sorted(
+        (path for path in root.iterdir() if path.is_dir() and not path.name.startswith(".")),
+        key=lambda path: path.stat().st_mtime, reverse=True,
+    )
+    for path in [v for v in versions if v.name != keep][SHARED_KEEP_VERSIONS - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def attach_shared(root, version):
+    """
+    版 version の long 形式データ・派生指標・キー索引と県全体データを読み取り専用でメモリマップする。
+    戻り値: (df_long, pref_df, prebuilt)。prebuilt は build_dataset に渡す部品（派生指標のない古い版では None）
+    """
+    target = Path(root) / version
+    df_long, pref_df = _read_arrow(target / "long.arrow"), _read_arrow(target / "prefecture.arrow")
+    manifest = json.loads((target / "manifest.json").read_text(encoding="utf-8"))
+    levels = manifest.get("key_levels")
+    if levels is None or not (target / "derived.arrow").exists():
+        return df_long, pref_df, None
+    prebuilt = {
+        "key_index": key_index_from_levels(levels["long"], np.load(target / "long_keys.npy", mmap_mode="r")),
+        "derived": _read_arrow(target / "derived.arrow"),
+        "derived_index": key_index_from_levels(levels["derived"], np.load(target / "derived_keys.npy", mmap_mode="r")),
+    }
+    return df_long, pref_df, prebuilt
+
+
+def _load_shared(root, signature):
+    """共有ディレクトリの現在の版を使う（データファイルと一致しなければ読み込んで書き出してから使う）"""
+    manifest = read_shared_manifest(root)
+    if manifest is None or manifest["signature"] != _signature_json(signature):
+        root.mkdir(parents=True, exist_ok=True)
+        with _shared_lock(root):
+            manifest = read_shared_manifest(root)
+            if manifest is None or manifest["signature"] != _signature_json(signature):
+                loaded = _load_local(signature)
+                if loaded["dataset"] is None:
+                    return loaded
+                publish_shared(root, signature, loaded["dataset"], loaded["prefecture"], loaded["merge_conflicts"])
+                manifest = read_shared_manifest(root)
+    df_long, pref_df, prebuilt = attach_shared(root, manifest["version"])
+    return {
+        "signature": signature,
+        "prefecture": pref_df,
+        "dataset": build_dataset(df_long, prebuilt),
+        "shared_version": manifest["version"],
+        "merge_conflicts": pd.DataFrame(manifest.get("merge_conflicts", []), columns=MERGE_CONFLICT_COLUMNS),
+    }
+
+
+# ---------------- 期間増減マトリクス ----------------
+@timed()
+def build_period_matrix(frame, metric):
+    """
+    frame の (metric, total) を 年 × 市町村 の配列にし、全ての (開始年, 終了年) の組の
+    増減数・増減率をまとめて計算する。任意の期間の比較は period_change で引くだけになる。
+    県・エリアの合計行は含めない。市町村は元データの並び順（市町村コード順）。
+
+    キー:
+      years    : 年度のリスト（昇順）
+      year_pos : 年度 → years 上の位置
+      cities   : 市町村名（pd.Index）
+      values   : 値（年 × 市町村）。データなしは 0
+      present  : データ有無（年 × 市町村）
+      change   : 増減数（開始年 × 終了年 × 市町村）
+      rate     : 増減率%（開始年 × 終了年 × 市町村）。開始年が0の場合は増減0なら0、それ以外は inf
+    """
+    exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
+    rows = select_rows(frame, metric, "total", exclude_cities=exclude_list)
+    city_codes, cities = pd.factorize(rows["city"], sort=False)
+    year_codes, years = pd.factorize(rows["year"], sort=True)
+    raw = rows["value"].to_numpy()
+
+    values = np.zeros((len(years), len(cities)), dtype=raw.dtype)
+    present = np.zeros((len(years), len(cities)), dtype=bool)
+    values[year_codes, city_codes] = raw
+    present[year_codes, city_codes] = True
+
+    start = values[:, None, :]
+    change = values[None, :, :] - start
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = change / start * 100
+    rate = np.where(start == 0, np.where(change == 0, 0.0, np.inf), rate)
+    if values.dtype.kind == "f":
+        # 派生指標は丸め済みの値どうしの差なので、同じ桁に丸め直す
+        change = change.round(DERIVED_DECIMALS)
+
+    years = [int(y) for y in years]
+    return {
+        "years": years,
+        "year_pos": {year: i for i, year in enumerate(years)},
+        "cities": pd.Index(cities, name="city"),
+        "values": values,
+        "present": present,
+        "change": change,
+        "rate": rate,
+    }
+
+
+def period_matrix(dataset, metric, table=None):
+    """データセットの期間増減マトリクス（table 省略時は分析用テーブル）。版・(テーブル, 指標) ごとに初回だけ構築する"""
+    table = table or dataset["analysis_table"]
+    matrices = derived_cache(dataset, "period_matrices")
+    if (table, metric) not in matrices:
+        frame = dataset["tables"].get(table, dataset["analysis"])
+        matrices[(table, metric)] = build_period_matrix(frame, metric)
+    return matrices[(table, metric)]
+
+
+def period_cities(matrix, year):
+    """year にデータがある市町村（データがない年度は空の Index）"""
+    pos = matrix["year_pos"].get(year)
+    if pos is None:
+        return matrix["cities"][:0]
+    return matrix["cities"][matrix["present"][pos]]
+
+
+def period_change(matrix, start_year, end_year, cities=None):
+    """
+    期間増減マトリクスから (start_year, end_year) の組を引く。
+    両方の年にデータがある市町村（cities 指定時はその中）を元データの並び順で返す。
+    列: start, end, change, rate（index は市町村名）
+    """
+    pos = matrix["year_pos"]
+    if start_year not in pos or end_year not in pos:
+        return pd.DataFrame(columns=["start", "end", "change", "rate"], index=matrix["cities"][:0])
+    i, j = pos[start_year], pos[end_year]
+    mask = matrix["present"][i] & matrix["present"][j]
+    if cities is not None:
+        mask &= matrix["cities"].isin(cities)
+    return pd.DataFrame({
+        "start": matrix["values"][i][mask],
+        "end": matrix["values"][j][mask],
+        "change": matrix["change"][i, j][mask],
+        "rate": matrix["rate"][i, j][mask],
+    }, index=matrix["cities"][mask])
+
+
+@timed()
+def build_cube(df_long):
+    """
+    long形式データを (table, metric, cat1, year) × city のワイド形式に集計する。
+    列は41市町村を市町村コード順に並べ、その後ろにエリア・県の行（元データに含まれるもの）を置く。
+    データが存在しない組み合わせは NaN のまま残す。
+    """
+    cube = df_long.pivot_table(
+        index=["table", "metric", "cat1", "year"], columns="city", values="value", aggfunc="sum"
+    )
+    municipalities = [c for c in sorted(CITY_CODE, key=CITY_CODE.get) if c in cube.columns]
+    others = [c for c in cube.columns if c not in CITY_CODE]
+    cube = cube[municipalities + others].sort_index()
+    cube.columns.name = "city"
+    return cube
+
+
+def cube_frame(cube, table, metric, cat1="total"):
+    """キューブから (table, metric, cat1) の year × city 表を取り出す（存在しない場合は空のDataFrame）"""
+    try:
+        return cube.loc[(table, metric, cat1)]
+    except KeyError:
+        return pd.DataFrame(columns=cube.columns, dtype=float)
+
+
+@timed()
+def build_rank_cube(cube):
+    """キューブの各行について41市町村中の順位（降順・同値は最小順位）を計算する"""
+    municipalities = [c for c in cube.columns if c in CITY_CODE]
+    return cube[municipalities].rank(axis=1, method="min", ascending=False)
+
+
+def dataset_cube(dataset):
+    """
+    データセットのキューブ（生の指標と派生指標）と順位キューブ (cube, ranks)。版ごとに初回だけ構築する。
+    市町村×年ヒートマップなど、任意の (table, metric, cat1) の 年 × 市町村 の表を切り出すだけで使う。
+    """
+    cubes = derived_cache(dataset, "cube")
+    if "cube" not in cubes:
+        cube = build_cube(pd.concat([dataset["long"], dataset["derived"]], ignore_index=True))
+        cubes["cube"] = (cube, build_rank_cube(cube))
+    return cubes["cube"]
+
+
+CITY_HEATMAP_VALUES = ["値", "対前年増減率", "順位"]
+CITY_HEATMAP_ORDERS = ["市町村コード順", "値の大きい順"]
+
+
+def city_year_matrix(dataset, table, metric, cat1, year_range, value="値"):
+    """
+    キューブから (table, metric, cat1) の 年 × 41市町村（市町村コード順）の表を切り出す。年は year_range の全年、データなしは NaN。
+    value: 値 / 対前年増減率（前年が0・欠損の場合は NaN）/ 順位（41市町村中の降順の順位。同値は最小順位）
+    """
+    cube, ranks = dataset_cube(dataset)
+    start, end = year_range
+    municipalities = [c for c in cube.columns if c in CITY_CODE]
+    if value == "順位":
+        frame = cube_frame(ranks, table, metric, cat1)
+    elif value == "対前年増減率":
+        values = cube_frame(cube, table, metric, cat1).reindex(range(start - 1, end + 1))
+        previous = values.shift(1)
+        frame = (values - previous) / previous.where(previous != 0) * 100
+    else:
+        frame = cube_frame(cube, table, metric, cat1)
+    frame = frame.reindex(index=range(start, end + 1), columns=municipalities)
+    frame.index.name = "year"
+    return frame
+
+
+def resolve_analysis_table(cube):
+    """キューブに存在するテーブルから分析用テーブルを優先順位に従って選ぶ"""
+    return pick_analysis_table(cube.index.get_level_values("table").unique())
+
+
+# ---------------- 推移の類似検索 ----------------
+# 「X市と推移が似ている市町村」を探す。市町村別タブと同じ 年 × 市町村 のピボット（build_city_pivot）を
+# 市町村ごとに z スコア（平均0・標準偏差1）に正規化して規模の違いを除き、推移の形だけを比べる。
+# 41市町村の全ペアの距離行列を NumPy でまとめて計算してデータセットの版ごとに保持するので、
+# 基準の市町村や件数を変える操作は行列の1行を並べ替えるだけで済む。
+# ・相関: 1 − ピアソンの相関係数（両方にデータのある年だけで計算。0〜2）
+# ・DTW: 前後 SIMILARITY_DTW_WINDOW 年までのずれを許す動的時間伸縮の距離（1年あたり。欠損年は前後の年から補う）
+SIMILARITY_METHODS = ["相関", "DTW"]
+SIMILARITY_MIN_YEARS = 3  # 比較に必要な最小の年数
+SIMILARITY_DTW_WINDOW = 2  # DTW で許す年のずれ（Sakoe–Chiba 帯の幅）
+
+
+def normalize_trajectories(pivot):
+    """year × city のピボットを市町村ごとに z スコアにする（データのある年が SIMILARITY_MIN_YEARS 未満・値が一定の市町村は NaN）"""
+    values = pivot.to_numpy(dtype=float)
+    mask = np.isfinite(values)
+    counts = mask.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(mask, values, 0).sum(axis=0) / counts
+        deviation = np.where(mask, values - mean, 0)
+        std = np.sqrt((deviation ** 2).sum(axis=0) / counts)
+        normalized = np.where(mask, deviation / std, np.nan)
+    normalized[:, (counts < SIMILARITY_MIN_YEARS) | ~(std > 0)] = np.nan
+    return pd.DataFrame(normalized, index=pivot.index, columns=pivot.columns)
+
+
+@timed()
+def correlation_distances(normalized):
+    """全ペアの 1 − 相関係数（ペアごとに両方にデータのある年で計算。共通の年が SIMILARITY_MIN_YEARS 未満は NaN）"""
+    z = normalized.to_numpy(dtype=float)
+    mask = np.isfinite(z).astype(float)
+    x = np.where(mask > 0, z, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = mask.T @ mask
+        sx = x.T @ mask  # sx[i, j] = 市町村 j にもデータのある年の市町村 i の和
+        sxx = (x * x).T @ mask
+        cov = x.T @ x - sx * sx.T / n
+        r = cov / np.sqrt((sxx - sx ** 2 / n) * (sxx.T - sx.T ** 2 / n))
+    r = np.clip(r, -1, 1)
+    r[n < SIMILARITY_MIN_YEARS] = np.nan
+    distances = 1 - r
+    np.fill_diagonal(distances, np.where(np.isfinite(np.diag(distances)), 0, np.nan))
+    return pd.DataFrame(distances, index=normalized.columns, columns=normalized.columns)
+
+
+@timed()
+def dtw_distances(normalized, window=SIMILARITY_DTW_WINDOW):
+    """全ペアの DTW 距離（1年あたり）。動的計画法の各セルを全ペア分のベクトルでまとめて更新する"""
+    # 欠損年は前後の年から線形補間し、最初・最後の欠損は端の値で埋める（データのない市町村は NaN のまま）
+    z = normalized.interpolate(limit_area="inside").ffill().bfill().to_numpy(dtype=float)
+    years, count = z.shape
+    distances = np.full((count, count), np.nan)
+    if years >= SIMILARITY_MIN_YEARS:
+        left, right = np.triu_indices(count, 1)
+        a, b = z[:, left].T, z[:, right].T
+        cost = np.full((len(left), years + 1, years + 1), np.inf)
+        cost[:, 0, 0] = 0
+        for i in range(1, years + 1):
+            for j in range(max(1, i - window), min(years, i + window) + 1):
+                step = np.minimum(np.minimum(cost[:, i - 1, j], cost[:, i, j - 1]), cost[:, i - 1, j - 1])
+                cost[:, i, j] = np.abs(a[:, i - 1] - b[:, j - 1]) + step
+        distances[left, right] = distances[right, left] = cost[:, years, years] / years
+        valid = np.isfinite(z).all(axis=0)
+        distances[np.arange(count)[valid], np.arange(count)[valid]] = 0
+    return pd.DataFrame(distances, index=normalized.columns, columns=normalized.columns)
+
+
+def similarity_matrix(dataset, df_table, table, metric_en, cat1, year_range, method="相関"):
+    """
+    (table, metric, cat1, 期間, 方法) のピボット・正規化した系列・距離行列 (pivot, normalized, distances)。版ごとに初回だけ計算する。
+    系列は市町村別タブと同じ build_city_pivot（版ごとに保持した全期間ピボットの切り出し）から作る。
+    """
+    matrices = derived_cache(dataset, "similarity")
+    key = (table, metric_en, cat1, tuple(year_range), method)
+    if key not in matrices:
+        pivot = build_city_pivot(df_table, metric_en, cat1, year_range, cities=list(CITY_CODE), dataset=dataset)
+        normalized = normalize_trajectories(pivot)
+        distances = correlation_distances(normalized) if method == "相関" else dtw_distances(normalized)
+        matrices[key] = (pivot, normalized, distances)
+    return matrices[key]
+
+
+def nearest_cities(distances, city, k):
+    """距離行列から city に近い k 市町村（距離の昇順。同距離は市町村コード順）"""
+    if city not in distances.index:
+        return pd.Series(dtype=float)
+    return distances.loc[city].drop(city).dropna().sort_values(kind="stable").head(k)
+
+
+# ---------------- SQL コンソール ----------------
+# 定型の質問にない集計を、読み込み済みのデータに対する SQL 1本で行えるようにする。
+# エンジンはプロセス内の SQLite（標準ライブラリ。外部サーバーなし）。データセットの版ごとに共有キャッシュの
+# インメモリ DB を1つ作り、問い合わせごとに接続を開いて読み取り専用（query_only と許可リスト方式の authorizer）で実行する。
+# 実行時間は SQL_TIMEOUT 秒で打ち切り、結果は SQL_MAX_ROWS 行までに制限する。
+SQL_TIMEOUT = float(os.environ.get("OKINAWA_SQL_TIMEOUT", "5"))  # 問い合わせの制限時間（秒）
+SQL_MAX_ROWS = int(os.environ.get("OKINAWA_SQL_MAX_ROWS", "10000"))  # 結果の最大行数
+SQL_PROGRESS_STEPS = 1000  # 制限時間を確認する間隔（SQLite の仮想マシン命令数）
+SQL_TABLES = {
+    "long": ("long 形式データ全体（level: city=市町村 / area=エリア / pref=沖縄県）",
+             ["year", "city", "area", "level", "table_name", "cat1", "metric", "value"]),
+    "area_rollup": ("エリア別の合計（REGION_MAP の市町村を合算。エリア別タブと同じ集計）",
+                    ["year", "area", "table_name", "cat1", "metric", "value"]),
+    "hotel_breakdown": ("ホテル・旅館の内訳（hotel_type × size。合計行は total）",
+                        ["year", "city", "area", "level", "hotel_type", "size", "metric", "value"]),
+}
+SQL_EXAMPLE = """SELECT area, year, value
+FROM area_rollup
+WHERE table_name = 'accommodation_type' AND cat1 = 'total' AND metric = 'rooms'
+ORDER BY year DESC, value DESC"""
+_SQL_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+
+
+def sql_frames(dataset):
+    """SQL_TABLES の各テーブルに登録するフレーム（long 形式データから作る）"""
+    df_long = dataset["long"]
+    city_to_area = {c: r for r, lst in REGION_MAP.items() for c in lst}
+    city = df_long["city"]
+    level = np.where(city.isin(list(city_to_area)), "city", np.where(city == "沖縄県", "pref", "area"))
+    long = pd.DataFrame({
+        "year": df_long["year"].to_numpy(),
+        "city": city.to_numpy(),
+        "area": city.map(city_to_area).where(level != "area", city).to_numpy(),
+        "level": level,
+        "table_name": df_long["table"].to_numpy(),
+        "cat1": df_long["cat1"].to_numpy(),
+        "metric": df_long["metric"].to_numpy(),
+        "value": df_long["value"].to_numpy(),
+    })
+
+    area_rollup = (
+        long[long["level"] == "city"]
+        .groupby(["year", "area", "table_name", "cat1", "metric"], sort=True)["value"].sum()
+        .reset_index()
+    )
+
+    hotel = long[long["table_name"] == "hotel_breakdown"]
+    parts = hotel["cat1"].str.rsplit("_", n=1, expand=True).reindex(columns=[0, 1])
+    total = (hotel["cat1"] == "total").to_numpy()
+    hotel_breakdown = hotel[["year", "city", "area", "level"]].assign(
+        hotel_type=parts[0].where(~total, "total").to_numpy(),
+        size=parts[1].where(~total, "total").to_numpy(),
+        metric=hotel["metric"].to_numpy(),
+        value=hotel["value"].to_numpy(),
+    )
+    frames = {"long": long, "area_rollup": area_rollup, "hotel_breakdown": hotel_breakdown}
+    return {name: frames[name][columns] for name, (_, columns) in SQL_TABLES.items()}
+
+
+def _sql_column_type(dtype):
+    """pandas の列の型に対応する SQLite の列の型（整数・真偽値 → INTEGER、浮動小数点 → REAL、それ以外 → TEXT）"""
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+@timed()
+def _build_sql_database(dataset):
+    """版ごとの共有キャッシュのインメモリ DB を作り、テーブルを登録した接続（DB を保持し続ける）を返す"""
+    uri = f"file:okinawa_{dataset['version']}?mode=memory&cache=shared"
+    anchor = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    for name, frame in sql_frames(dataset).items():
+        columns = ", ".join(f"{col} {_sql_column_type(dtype)}" for col, dtype in frame.dtypes.items())
+        anchor.execute(f"CREATE TABLE {name} ({columns})")
+        anchor.executemany(
+            f"INSERT INTO {name} VALUES ({', '.join('?' * frame.shape[1])})",
+            zip(*(frame[col].astype(object).where(frame[col].notna(), None).tolist() for col in frame.columns)),
+        )
+    # select_rows と同じ (table, metric, cat1, year) 順の索引
+    anchor.execute("CREATE INDEX long_key ON long (table_name, metric, cat1, year)")
+    anchor.execute("CREATE INDEX hotel_breakdown_key ON hotel_breakdown (metric, year)")
+    anchor.commit()
+    return {"uri": uri, "anchor": anchor}
+
+
+@st.cache_resource
+def _sql_build_lock():
+    """SQL 用 DB の構築を1回にするためのロック（同じ版を複数のセッションが同時に作らない）"""
+    return threading.Lock()
+
+
+def sql_database(dataset):
+    """dataset の版に対応する SQL 用 DB（初回だけ作る。版が破棄されると保持用の接続を閉じて解放する）"""
+    cache = derived_cache(dataset, "sql")
+    with _sql_build_lock():
+        if "database" not in cache:
+            cache["database"] = _build_sql_database(dataset)
+    return cache["database"]
+
+
+def _sql_authorizer(action, *args):
+    """読み取り（SELECT・列の参照・関数・再帰 CTE）以外の操作をすべて拒否する"""
+    return sqlite3.SQLITE_OK if action in _SQL_ALLOWED_ACTIONS else sqlite3.SQLITE_DENY
+
+
+@timed()
+def run_sql(dataset, query, timeout=None, max_rows=None):
+    """
+    dataset に読み取り専用の SQL を1文実行する。
+    戻り値: {"frame": 結果, "truncated": max_rows 行で打ち切ったか, "elapsed_ms": 実行時間}
+    制限時間を超えた場合は TimeoutError、書き込み・構文誤りなど実行できない SQL は ValueError を送出する。
+    """
+    timeout = SQL_TIMEOUT if timeout is None else timeout
+    max_rows = SQL_MAX_ROWS if max_rows is None else max_rows
+    database = sql_database(dataset)
+    conn = sqlite3.connect(database["uri"], uri=True)
+    t0 = time.perf_counter()
+    deadline = t0 + timeout
+    try:
+        conn.execute("PRAGMA query_only = ON")
+        conn.set_authorizer(_sql_authorizer)
+        conn.set_progress_handler(lambda: time.perf_counter() > deadline, SQL_PROGRESS_STEPS)
+        cursor = conn.execute(query)
+        rows = cursor.fetchmany(max_rows + 1) if cursor.description else []
+        columns = [col[0] for col in cursor.description or []]
+    except sqlite3.Error as exc:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"制限時間（{timeout:g} 秒）を超えたため中止しました") from exc
+        raise ValueError(f"SQL を実行できません: {exc}") from exc
+    finally:
+        conn.close()
+    return {
+        "frame": pd.DataFrame.from_records(rows[:max_rows], columns=columns),
+        "truncated": len(rows) > max_rows,
+        "elapsed_ms": (time.perf_counter() - t0) * 1000,
+    }
+
+
+def render_sql_console(dataset):
+    """SQL タブ: テーブル定義・問い合わせの入力・結果（読み取り専用）"""
+    st.header("🧮 SQL コンソール")
+    st.write(f"読み込み済みのデータに SQL（SQLite）を実行します。読み取り専用で、"
+             f"{SQL_TIMEOUT:g} 秒を超える問い合わせは中止し、結果は {SQL_MAX_ROWS:,} 行までです。")
+    with st.expander("テーブル定義", expanded=False):
+        for name, (description, columns) in SQL_TABLES.items():
+            st.markdown(f"**{name}**: {description}  \n`{', '.join(columns)}`")
+    query = st.text_area("SQL", value=SQL_EXAMPLE, height=160, key="sql_query")
+    if not st.button("実行", key="run_sql"):
+        return
+    try:
+        result = run_sql(dataset, query)
+    except (TimeoutError, ValueError) as exc:
+        st.error(str(exc))
+        return
+    frame = result["frame"]
+    st.caption(f"{len(frame):,} 行 / {result['elapsed_ms']:,.0f} ms"
+               + (f"（{SQL_MAX_ROWS:,} 行で打ち切り）" if result["truncated"] else ""))
+    show_table(frame, hide_index=True, use_container_width=True)
+    st.download_button("CSV をダウンロード", frame.to_csv(index=False).encode("utf-8-sig"),
+                       file_name="query.csv", mime="text/csv", key="sql_download")
+
 # ---------------- ヘルプコンテンツ表示関数 ----------------
 def display_help_content():
     """ヘルプコンテンツの表示"""
@@ -401,14 +2426,16 @@ def generate_question_preview(question_type, metric, location_type, locations, p
     
     return "質問を設定してください"
 
+@timed()
 def process_structured_question(**params):
-    """構造化された質問パラメータを処理して回答を生成"""
+    """構造化された質問パラメータを処理して回答を生成（params には df とその dataset が必要）"""
     try:
         question_type = params['question_type']
         location_type = params['location_type']
         locations = params['locations']
         df = params['df']
         debug_mode = params.get('debug_mode', False)
+        dataset = params['dataset']  # build_dataset のデータセット（df はその long）
         
         if debug_mode:
             import streamlit as st
@@ -430,15 +2457,15 @@ def process_structured_question(**params):
                 st.write(f"- 指標: {metrics}")
             
             # データフィルタリング
-            df_analysis = get_analysis_dataframe(df, debug_mode)
+            df_analysis = get_analysis_dataframe(df, dataset, debug_mode)
             if df_analysis is None:
                 return "申し訳ございませんが、分析に使用できるデータが見つかりません。"
             
             # 全指標のデータ存在確認
             valid_metrics = []
             for metric_jp in metrics:
-                metric_en = {"軒数": "facilities", "客室数": "rooms", "収容人数": "capacity"}[metric_jp]
-                if validate_metric_data(df_analysis, metric_en, metric_jp, debug_mode):
+                metric_en = METRIC_OPTIONS[metric_jp]
+                if validate_metric_data(df_analysis, metric_en, metric_jp, dataset, debug_mode):
                     valid_metrics.append(metric_jp)
             
             if not valid_metrics:
@@ -451,18 +2478,18 @@ def process_structured_question(**params):
         else:
             # 従来の単一指標処理
             metric_jp = params['metric']
-            metric_en = {"軒数": "facilities", "客室数": "rooms", "収容人数": "capacity"}[metric_jp]
+            metric_en = METRIC_OPTIONS[metric_jp]
             
             if debug_mode:
                 st.write(f"- metric: {metric_jp} ({metric_en})")
             
             # データフィルタリング
-            df_analysis = get_analysis_dataframe(df, debug_mode)
+            df_analysis = get_analysis_dataframe(df, dataset, debug_mode)
             if df_analysis is None:
                 return "申し訳ございませんが、分析に使用できるデータが見つかりません。"
             
             # 指標データの存在確認
-            if not validate_metric_data(df_analysis, metric_en, metric_jp, debug_mode):
+            if not validate_metric_data(df_analysis, metric_en, metric_jp, dataset, debug_mode):
                 return f"申し訳ございませんが、指標「{metric_jp}」のデータが見つかりません。"
             
             # パラメータにdebug_modeを追加
@@ -512,29 +2539,15 @@ def process_structured_question(**params):
 - 場所: {params.get('location_type', 'N/A')}
 """
 
-def get_analysis_dataframe(df, debug_mode=False):
-    """分析用データフレームを取得（優先順位付き）"""
-    # 1. accommodation_typeテーブルを最優先
-    df_accom = df.query("table == 'accommodation_type'")
-    if not df_accom.empty:
-        df_analysis = df_accom
-        table_used = "accommodation_type"
-    else:
-        # 2. scale_classテーブルを次優先
-        df_scale = df.query("table == 'scale_class'")
-        if not df_scale.empty:
-            df_analysis = df_scale  
-            table_used = "scale_class"
-        else:
-            # 3. hotel_breakdownテーブルを使用
-            df_hotel = df.query("table == 'hotel_breakdown'")
-            if not df_hotel.empty:
-                df_analysis = df_hotel
-                table_used = "hotel_breakdown"
-            else:
-                # 4. 全データから使用
-                df_analysis = df
-                table_used = "全テーブル"
+@timed()
+def get_analysis_dataframe(df, dataset, debug_mode=False):
+    """
+    分析用データフレームを取得（優先順位付き）。
+    優先順位（accommodation_type → scale_class → hotel_breakdown → 全データ）は build_dataset で解決済みのものを使う。
+    dataset: df を構築した build_dataset のデータセット（ここでは構築しない。索引の登録・派生データの版を増やさないため）
+    """
+    df_analysis = dataset["analysis"]
+    table_used = dataset["analysis_table"]
     
     if debug_mode:
         import streamlit as st
@@ -543,31 +2556,44 @@ def get_analysis_dataframe(df, debug_mode=False):
     
     return df_analysis if not df_analysis.empty else None
 
-def validate_metric_data(df_analysis, metric_en, metric_jp, debug_mode=False):
-    """指標データの存在を確認"""
+@timed()
+def validate_metric_data(df_analysis, metric_en, metric_jp, dataset, debug_mode=False):
+    """
+    指標データの存在を確認。
+    dataset（df_analysis を含む build_dataset のデータセット）のデータ有無カタログで判定する。
+    派生指標は分子・分母の指標がどちらも存在すれば有効とする。
+    """
+    spec = DERIVED_METRICS.get(metric_en)
+    if spec is not None:
+        return all(validate_metric_data(df_analysis, metric, metric_jp, dataset, debug_mode)
+                   for metric in dict.fromkeys([spec["numerator"], spec["denominator"]]))
+    catalog = dataset["catalog"]
+    table = dataset["analysis_table"]
+    tables = [table] if table in catalog["metrics"] else list(catalog["metrics"])
+
     # 指定された指標のデータが存在するかチェック
-    metric_data = df_analysis.query(f"metric == '{metric_en}'")
-    if metric_data.empty:
+    metric_rows = sum(catalog["rows"].get((t, metric_en), 0) for t in tables)
+    if metric_rows == 0:
         if debug_mode:
             import streamlit as st
-            available_metrics = sorted(df_analysis['metric'].unique())
+            available_metrics = sorted({m for t in tables for m in catalog["metrics"][t]})
             st.warning(f"指標「{metric_jp}」({metric_en})のデータがありません。利用可能: {available_metrics}")
         return False
     
     # totalカテゴリのデータが存在するかチェック
-    total_data = metric_data.query("cat1 == 'total'")
-    if total_data.empty:
+    total_years = sorted({y for t in tables for y in available_years(catalog, t, metric_en, "total")})
+    if not total_years:
         if debug_mode:
             import streamlit as st
-            available_cats = sorted(metric_data['cat1'].unique())
+            available_cats = sorted({c for t in tables for c in catalog["cat1"].get((t, metric_en), ())})
             st.warning(f"指標「{metric_jp}」のtotalカテゴリデータがありません。利用可能: {available_cats}")
         return False
     
     if debug_mode:
         import streamlit as st
-        st.write(f"- {metric_jp}データ件数: {len(metric_data):,}行")
-        st.write(f"- {metric_jp}(total)データ件数: {len(total_data):,}行")
-        st.write(f"- 年度範囲: {total_data['year'].min()}〜{total_data['year'].max()}年")
+        st.write(f"- {metric_jp}データ件数: {metric_rows:,}行")
+        st.write(f"- {metric_jp}(total)データ年数: {len(total_years)}年")
+        st.write(f"- 年度範囲: {total_years[0]}〜{total_years[-1]}年")
     
     return True
 
@@ -697,6 +2723,7 @@ def generate_question_preview(question_type, metric, location_type, locations, p
     
     return "質問を設定してください"
 
+@timed()
 def handle_change_ranking(df, metric_en, metric_jp, location_type, locations, params):
     """増減数・増減率ランキングの処理"""
     try:
@@ -740,21 +2767,22 @@ def handle_change_ranking(df, metric_en, metric_jp, location_type, locations, pa
         if analysis_type == "対前年比較":
             target_year = params['target_year']
             result = handle_change_ranking_year_over_year(df, metric_en, metric_jp, target_cities, scope_text, 
-                                                      target_year, result_type, ranking_count)
+                                                      target_year, result_type, ranking_count,
+                                                      dataset=params.get('dataset'))
         else:  # 期間比較
             start_year = params['start_year']
             end_year = params['end_year']
             if debug_mode:
                 st.write(f"- 期間比較実行: {start_year}-{end_year}")
             result = handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_text,
-                                              start_year, end_year, result_type, ranking_count, debug_mode)
+                                              start_year, end_year, result_type, ranking_count, debug_mode,
+                                              dataset=params.get('dataset'))
         
         if debug_mode:
-            st.write(f"- 処理結果の長さ: {len(result) if result else 0}文字")
-            if result:
-                st.write(f"- 結果の最初の100文字: {result[:100]}...")
+            st.write(f"- 処理結果: {len(result['rows']) if isinstance(result, dict) else len(result or '')}"
+                     f"{'行' if isinstance(result, dict) else '文字'}")
         
-        if not result or result.strip() == "":
+        if not result or (isinstance(result, str) and result.strip() == ""):
             error_msg = f"""増減ランキングの処理結果が空でした。
 
 **詳細情報:**
@@ -779,6 +2807,7 @@ def handle_change_ranking(df, metric_en, metric_jp, location_type, locations, pa
             st.code(traceback.format_exc())
         return error_msg
 
+@timed()
 def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, analysis_type, result_type, ranking_count, params, debug_mode=False):
     """エリア別の増減ランキング処理"""
     try:
@@ -803,12 +2832,10 @@ def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, anal
                 area_cities = REGION_MAP.get(area, [])
                 
                 # 現在年のエリア合計
-                current_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @target_year & city in @area_cities")
-                area_current[area] = current_data['value'].sum()
+                area_current[area] = location_total(df, metric_en, target_year, cities=area_cities)
                 
                 # 前年のエリア合計
-                previous_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @previous_year & city in @area_cities")
-                area_previous[area] = previous_data['value'].sum()
+                area_previous[area] = location_total(df, metric_en, previous_year, cities=area_cities)
             
             # 増減数と増減率を計算
             area_increases = {}
@@ -825,36 +2852,10 @@ def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, anal
                     else:
                         area_rates[area] = 0 if increase == 0 else float('inf')
             
-            # ランキング作成
-            if result_type == "増減数":
-                ranked_areas = sorted(area_increases.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
-                result = f"## {target_year}年 対前年エリア別{metric_jp}増減数ランキング トップ{ranking_count}（{scope_text}）\n\n"
-                
-                for i, (area, increase) in enumerate(ranked_areas, 1):
-                    current_val = area_current.get(area, 0)
-                    previous_val = area_previous.get(area, 0)
-                    rate = area_rates.get(area, 0)
-                    
-                    result += f"**{i}位: {area}エリア**\n"
-                    result += f"- 増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                    result += f"- 増減率: {rate:+.1f}%\n"
-                    result += f"- {target_year}年: {current_val:,}{get_unit(metric_jp)}\n"
-                    result += f"- {previous_year}年: {previous_val:,}{get_unit(metric_jp)}\n\n"
-            else:  # 増減率
-                finite_rates = {area: rate for area, rate in area_rates.items() if rate != float('inf')}
-                ranked_areas = sorted(finite_rates.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
-                result = f"## {target_year}年 対前年エリア別{metric_jp}増減率ランキング トップ{ranking_count}（{scope_text}）\n\n"
-                
-                for i, (area, rate) in enumerate(ranked_areas, 1):
-                    current_val = area_current.get(area, 0)
-                    previous_val = area_previous.get(area, 0)
-                    increase = area_increases.get(area, 0)
-                    
-                    result += f"**{i}位: {area}エリア**\n"
-                    result += f"- 増減率: {rate:+.1f}%\n"
-                    result += f"- 増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                    result += f"- {target_year}年: {current_val:,}{get_unit(metric_jp)}\n"
-                    result += f"- {previous_year}年: {previous_val:,}{get_unit(metric_jp)}\n\n"
+            area_end, area_start = area_current, area_previous
+            end_year, start_year = target_year, previous_year
+            title = f"{target_year}年 対前年エリア別{metric_jp}{{kind}}ランキング トップ{ranking_count}（{scope_text}）"
+            prefix = ""
         
         else:  # 期間比較
             start_year = params['start_year']
@@ -868,12 +2869,10 @@ def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, anal
                 area_cities = REGION_MAP.get(area, [])
                 
                 # 開始年のエリア合計
-                start_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @start_year & city in @area_cities")
-                area_start[area] = start_data['value'].sum()
+                area_start[area] = location_total(df, metric_en, start_year, cities=area_cities)
                 
                 # 終了年のエリア合計
-                end_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @end_year & city in @area_cities")
-                area_end[area] = end_data['value'].sum()
+                area_end[area] = location_total(df, metric_en, end_year, cities=area_cities)
             
             # 増減数と増減率を計算
             area_increases = {}
@@ -891,42 +2890,24 @@ def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, anal
                         area_rates[area] = 0 if increase == 0 else float('inf')
             
             period_text = f"{start_year}年〜{end_year}年（{end_year - start_year + 1}年間）"
-            
-            # ランキング作成
-            if result_type == "増減数":
-                ranked_areas = sorted(area_increases.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
-                result = f"## {period_text} 期間エリア別{metric_jp}増減数ランキング トップ{ranking_count}（{scope_text}）\n\n"
-                
-                for i, (area, increase) in enumerate(ranked_areas, 1):
-                    start_val = area_start.get(area, 0)
-                    end_val = area_end.get(area, 0)
-                    rate = area_rates.get(area, 0)
-                    
-                    result += f"**{i}位: {area}エリア**\n"
-                    result += f"- 期間増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                    if rate != float('inf'):
-                        result += f"- 期間増減率: {rate:+.1f}%\n"
-                    else:
-                        result += f"- 期間増減率: 新規開設\n"
-                    result += f"- {end_year}年: {end_val:,}{get_unit(metric_jp)}\n"
-                    result += f"- {start_year}年: {start_val:,}{get_unit(metric_jp)}\n\n"
-            else:  # 増減率
-                finite_rates = {area: rate for area, rate in area_rates.items() if rate != float('inf')}
-                ranked_areas = sorted(finite_rates.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
-                result = f"## {period_text} 期間エリア別{metric_jp}増減率ランキング トップ{ranking_count}（{scope_text}）\n\n"
-                
-                for i, (area, rate) in enumerate(ranked_areas, 1):
-                    start_val = area_start.get(area, 0)
-                    end_val = area_end.get(area, 0)
-                    increase = area_increases.get(area, 0)
-                    
-                    result += f"**{i}位: {area}エリア**\n"
-                    result += f"- 期間増減率: {rate:+.1f}%\n"
-                    result += f"- 期間増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                    result += f"- {end_year}年: {end_val:,}{get_unit(metric_jp)}\n"
-                    result += f"- {start_year}年: {start_val:,}{get_unit(metric_jp)}\n\n"
+            title = f"{period_text} 期間エリア別{metric_jp}{{kind}}ランキング トップ{ranking_count}（{scope_text}）"
+            prefix = "期間"
         
-        return result
+        # ランキング作成（増減率は新規開設（inf）を除く）
+        kind = "増減数" if result_type == "増減数" else "増減率"
+        if kind == "増減数":
+            ranked_areas = sorted(area_increases.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
+        else:
+            finite_rates = {area: rate for area, rate in area_rates.items() if rate != float('inf')}
+            ranked_areas = sorted(finite_rates.items(), key=lambda x: x[1], reverse=True)[:ranking_count]
+        records = [
+            {"name": area, "level": "area", "metric": metric_jp, "year": end_year, "base_year": start_year,
+             "value": area_end.get(area, 0), "base_value": area_start.get(area, 0),
+             "change": area_increases.get(area, 0), "rate": area_rates.get(area, 0), "rank": i}
+            for i, (area, _) in enumerate(ranked_areas, 1)
+        ]
+        return make_answer("change_ranking", title.format(kind=kind), records,
+                           unit=get_unit(metric_jp), prefix=prefix, result_type=kind)
         
     except Exception as e:
         import traceback
@@ -945,7 +2926,8 @@ def handle_area_change_ranking(df, metric_en, metric_jp, areas, scope_text, anal
 - 結果タイプ: {result_type}
 """
 
-def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_text, start_year, end_year, result_type, ranking_count, debug_mode=False):
+@timed()
+def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_text, start_year, end_year, result_type, ranking_count, debug_mode=False, dataset=None):
     """期間比較の増減ランキング"""
     try:
         # データ取得前の確認
@@ -958,28 +2940,16 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
             st.write(f"- 利用可能な指標: {sorted(df['metric'].unique())}")
             st.write(f"- 対象市町村数: {len(target_cities)}")
         
-        # エリア名と県名を除外するフィルタ
-        exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
-        
-        # データ取得 - より安全なフィルタリング（エリア・県名を除外）
-        start_data_all = df[
-            (df['metric'] == metric_en) & 
-            (df['cat1'] == 'total') & 
-            (df['year'] == start_year) &
-            (~df['city'].isin(exclude_list))  # エリア・県名を除外
-        ]
-        end_data_all = df[
-            (df['metric'] == metric_en) & 
-            (df['cat1'] == 'total') & 
-            (df['year'] == end_year) &
-            (~df['city'].isin(exclude_list))  # エリア・県名を除外
-        ]
+        # 期間増減マトリクス（エリア・県名は含まない）から開始年・終了年の組を引く
+        matrix = period_matrix(dataset, metric_en) if dataset is not None else build_period_matrix(df, metric_en)
+        start_cities_all = period_cities(matrix, start_year)
+        end_cities_all = period_cities(matrix, end_year)
         
         if debug_mode:
-            st.write(f"- {start_year}年データ行数（除外後）: {len(start_data_all)}行")
-            st.write(f"- {end_year}年データ行数（除外後）: {len(end_data_all)}行")
+            st.write(f"- {start_year}年データ行数（除外後）: {len(start_cities_all)}行")
+            st.write(f"- {end_year}年データ行数（除外後）: {len(end_cities_all)}行")
         
-        if start_data_all.empty:
+        if start_cities_all.empty:
             available_years = sorted(df[df['metric'] == metric_en]['year'].unique())
             return f"""## {start_year}年〜{end_year}年 期間{metric_jp}{result_type}ランキング
 
@@ -993,7 +2963,7 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
 - totalカテゴリデータ件数: {len(df[(df['metric'] == metric_en) & (df['cat1'] == 'total')]):,}行
 """
         
-        if end_data_all.empty:
+        if end_cities_all.empty:
             available_years = sorted(df[df['metric'] == metric_en]['year'].unique())
             return f"""## {start_year}年〜{end_year}年 期間{metric_jp}{result_type}ランキング
 
@@ -1002,25 +2972,20 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
 **指標「{metric_jp}」({metric_en})の利用可能な年度:** {available_years}
 """
         
-        # 対象市町村でフィルタ
-        start_data = start_data_all[start_data_all['city'].isin(target_cities)].set_index('city')['value']
-        end_data = end_data_all[end_data_all['city'].isin(target_cities)].set_index('city')['value']
-        
-        if debug_mode:
-            st.write(f"- フィルタ後 {start_year}年データ: {len(start_data)}市町村")
-            st.write(f"- フィルタ後 {end_year}年データ: {len(end_data)}市町村")
-        
-        # 両方の年にデータがある市町村のみ対象
-        common_cities = start_data.index.intersection(end_data.index)
+        # 対象市町村のうち、両方の年にデータがある市町村のみ対象
+        changes = period_change(matrix, start_year, end_year, cities=target_cities)
+        common_cities = changes.index
         
         if debug_mode:
+            st.write(f"- フィルタ後 {start_year}年データ: {start_cities_all.isin(target_cities).sum()}市町村")
+            st.write(f"- フィルタ後 {end_year}年データ: {end_cities_all.isin(target_cities).sum()}市町村")
             st.write(f"- 共通市町村数: {len(common_cities)}市町村")
             if len(common_cities) > 0:
                 st.write(f"- 共通市町村例: {list(common_cities)[:5]}")
         
         if len(common_cities) == 0:
-            available_start = set(start_data_all['city'].unique())
-            available_end = set(end_data_all['city'].unique())
+            available_start = set(start_cities_all)
+            available_end = set(end_cities_all)
             target_set = set(target_cities)
             
             return f"""## {start_year}年〜{end_year}年 期間{metric_jp}{result_type}ランキング
@@ -1038,8 +3003,9 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
 **対象市町村:** {sorted(target_cities)[:10]}...
 """
         
-        # 増減数と増減率を計算
-        increases = end_data[common_cities] - start_data[common_cities]
+        # 増減数と増減率（分母が0の場合は増減0なら0、それ以外は inf）
+        increases = changes['change']
+        rates = changes['rate']
         
         if debug_mode:
             st.write(f"- 増減数計算完了, データ数: {len(increases)}件")
@@ -1049,58 +3015,19 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
             for city, increase in sample_increases.items():
                 st.write(f"  - {city}: {increase:+.1f}{get_unit(metric_jp)}")
         
-        # ゼロ除算を避けるため、分母が0の場合は0を設定
-        rates = increases.copy()
-        for city in common_cities:
-            if start_data[city] != 0:
-                rates[city] = (increases[city] / start_data[city]) * 100
-            else:
-                rates[city] = 0 if increases[city] == 0 else float('inf')
-        
         period_text = f"{start_year}年〜{end_year}年（{end_year - start_year + 1}年間）"
-        
-        if result_type == "増減数":
-            ranked_data = increases.sort_values(ascending=False).head(ranking_count)
-            
-            if debug_mode:
-                st.write(f"- ランキングデータ: {len(ranked_data)}件")
-            
-            result = f"## {period_text} 期間{metric_jp}増減数ランキング トップ{ranking_count}（{scope_text}）\n\n"
-            
-            for i, (city, increase) in enumerate(ranked_data.items(), 1):
-                start_val = start_data.get(city, 0)
-                end_val = end_data.get(city, 0)
-                rate = rates.get(city, 0)
-                
-                result += f"**{i}位: {city}**\n"
-                result += f"- 期間増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                if rate != float('inf'):
-                    result += f"- 期間増減率: {rate:+.1f}%\n"
-                else:
-                    result += f"- 期間増減率: 新規開設\n"
-                result += f"- {end_year}年: {end_val:,}{get_unit(metric_jp)}\n"
-                result += f"- {start_year}年: {start_val:,}{get_unit(metric_jp)}\n\n"
-        else:  # 増減率
-            # 無限大を除外してソート
-            finite_rates = rates[rates != float('inf')]
-            ranked_data = finite_rates.sort_values(ascending=False).head(ranking_count)
-            result = f"## {period_text} 期間{metric_jp}増減率ランキング トップ{ranking_count}（{scope_text}）\n\n"
-            
-            for i, (city, rate) in enumerate(ranked_data.items(), 1):
-                start_val = start_data.get(city, 0)
-                end_val = end_data.get(city, 0)
-                increase = increases.get(city, 0)
-                
-                result += f"**{i}位: {city}**\n"
-                result += f"- 期間増減率: {rate:+.1f}%\n"
-                result += f"- 期間増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                result += f"- {end_year}年: {end_val:,}{get_unit(metric_jp)}\n"
-                result += f"- {start_year}年: {start_val:,}{get_unit(metric_jp)}\n\n"
+        kind = "増減数" if result_type == "増減数" else "増減率"
+        # 増減数は降順、増減率は無限大（新規開設）を除外して降順
+        ranked_data = (increases if kind == "増減数" else rates[rates != float('inf')]).sort_values(ascending=False).head(ranking_count)
         
         if debug_mode:
-            st.write(f"- 結果生成完了, 文字数: {len(result)}文字")
+            st.write(f"- ランキングデータ: {len(ranked_data)}件")
         
-        return result
+        return make_answer(
+            "change_ranking", f"{period_text} 期間{metric_jp}{kind}ランキング トップ{ranking_count}（{scope_text}）",
+            change_records(ranked_data.index, changes, metric_jp, start_year, end_year),
+            unit=get_unit(metric_jp), prefix="期間", result_type=kind,
+        )
         
     except Exception as e:
         import traceback
@@ -1120,283 +3047,146 @@ def handle_change_ranking_period(df, metric_en, metric_jp, target_cities, scope_
 - 指標: {metric_en}
 """
 
-def handle_change_ranking_year_over_year(df, metric_en, metric_jp, target_cities, scope_text, target_year, result_type, ranking_count):
+@timed()
+def handle_change_ranking_year_over_year(df, metric_en, metric_jp, target_cities, scope_text, target_year, result_type, ranking_count, dataset=None):
     """対前年比較の増減ランキング"""
     try:
-        # エリア名と県名を除外するフィルタ
-        exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
-        
-        # 対象年と前年のデータ取得
+        # 対象年と前年の組を期間増減マトリクス（エリア・県名は含まない）から引く
         previous_year = target_year - 1
+        matrix = period_matrix(dataset, metric_en) if dataset is not None else build_period_matrix(df, metric_en)
         
-        current_data_all = df[
-            (df['metric'] == metric_en) & 
-            (df['cat1'] == 'total') & 
-            (df['year'] == target_year) &
-            (~df['city'].isin(exclude_list))
-        ]
-        previous_data_all = df[
-            (df['metric'] == metric_en) & 
-            (df['cat1'] == 'total') & 
-            (df['year'] == previous_year) &
-            (~df['city'].isin(exclude_list))
-        ]
-        
-        if current_data_all.empty or previous_data_all.empty:
+        if period_cities(matrix, target_year).empty or period_cities(matrix, previous_year).empty:
             return f"指定年度のデータが不足しています。{target_year}年または{previous_year}年のデータがありません。"
         
-        # 対象市町村でフィルタ
-        current_data = current_data_all[current_data_all['city'].isin(target_cities)].set_index('city')['value']
-        previous_data = previous_data_all[previous_data_all['city'].isin(target_cities)].set_index('city')['value']
-        
-        # 両方の年にデータがある市町村のみ対象
-        common_cities = current_data.index.intersection(previous_data.index)
+        # 対象市町村のうち、両方の年にデータがある市町村のみ対象
+        changes = period_change(matrix, previous_year, target_year, cities=target_cities)
         
-        if len(common_cities) == 0:
+        if changes.empty:
             return f"比較可能なデータがありません。"
         
-        # 増減数と増減率を計算
-        increases = current_data[common_cities] - previous_data[common_cities]
-        
-        # ゼロ除算を避けるため、分母が0の場合は特別扱い
-        rates = increases.copy()
-        for city in common_cities:
-            if previous_data[city] != 0:
-                rates[city] = (increases[city] / previous_data[city]) * 100
-            else:
-                rates[city] = 0 if increases[city] == 0 else float('inf')
-        
-        if result_type == "増減数":
-            ranked_data = increases.sort_values(ascending=False).head(ranking_count)
-            result = f"## {target_year}年 対前年{metric_jp}増減数ランキング トップ{ranking_count}（{scope_text}）\n\n"
-            
-            for i, (city, increase) in enumerate(ranked_data.items(), 1):
-                current_val = current_data.get(city, 0)
-                previous_val = previous_data.get(city, 0)
-                rate = rates.get(city, 0)
-                
-                result += f"**{i}位: {city}**\n"
-                result += f"- 対前年増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                if rate != float('inf'):
-                    result += f"- 対前年増減率: {rate:+.1f}%\n"
-                else:
-                    result += f"- 対前年増減率: 新規開設\n"
-                result += f"- {target_year}年: {current_val:,}{get_unit(metric_jp)}\n"
-                result += f"- {previous_year}年: {previous_val:,}{get_unit(metric_jp)}\n\n"
-        else:  # 増減率
-            # 無限大を除外してソート
-            finite_rates = rates[rates != float('inf')]
-            ranked_data = finite_rates.sort_values(ascending=False).head(ranking_count)
-            result = f"## {target_year}年 対前年{metric_jp}増減率ランキング トップ{ranking_count}（{scope_text}）\n\n"
-            
-            for i, (city, rate) in enumerate(ranked_data.items(), 1):
-                current_val = current_data.get(city, 0)
-                previous_val = previous_data.get(city, 0)
-                increase = increases.get(city, 0)
-                
-                result += f"**{i}位: {city}**\n"
-                result += f"- 対前年増減率: {rate:+.1f}%\n"
-                result += f"- 対前年増減数: {increase:+,}{get_unit(metric_jp)}\n"
-                result += f"- {target_year}年: {current_val:,}{get_unit(metric_jp)}\n"
-                result += f"- {previous_year}年: {previous_val:,}{get_unit(metric_jp)}\n\n"
-        
-        return result
+        # 増減数と増減率（分母が0の場合は増減0なら0、それ以外は inf）
+        increases = changes['change']
+        rates = changes['rate']
+        
+        kind = "増減数" if result_type == "増減数" else "増減率"
+        # 増減数は降順、増減率は無限大（新規開設）を除外して降順
+        ranked_data = (increases if kind == "増減数" else rates[rates != float('inf')]).sort_values(ascending=False).head(ranking_count)
+        return make_answer(
+            "change_ranking", f"{target_year}年 対前年{metric_jp}{kind}ランキング トップ{ranking_count}（{scope_text}）",
+            change_records(ranked_data.index, changes, metric_jp, previous_year, target_year),
+            unit=get_unit(metric_jp), prefix="対前年", result_type=kind,
+        )
         
     except Exception as e:
         return f"対前年比較ランキング処理中にエラー: {str(e)}"
 
+@timed()
 def handle_basic_info_multi_metrics(df, metrics, location_type, locations, target_year):
     """複数指標対応の基本情報取得処理（市町村ごとにまとめて表示）"""
     # エリア名と県名を除外する共通フィルタ
     exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
+    metric_map = METRIC_OPTIONS
+    records = []
     
     if location_type == "市町村":
-        result = f"## {target_year}年 基本情報\n\n"
-        
-        # 各指標のランキング情報を事前に計算
-        all_rankings = {}
+        # 各指標の全市町村データ（値と降順の順位）を事前に計算
         all_data = {}
-        
         for metric_jp in metrics:
-            metric_en = {"軒数": "facilities", "客室数": "rooms", "収容人数": "capacity"}[metric_jp]
-            
-            # 全市町村データを取得してランキング作成
-            all_municipal_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @target_year & ~city.isin(@exclude_list)")
-            
+            all_municipal_data = select_rows(df, metric_map[metric_jp], "total", target_year, target_year, exclude_cities=exclude_list)
             if not all_municipal_data.empty:
-                ranking = all_municipal_data.sort_values('value', ascending=False).reset_index(drop=True)
-                all_rankings[metric_jp] = ranking
-                
-                # 市町村ごとのデータを辞書化
-                city_data = {}
-                for _, row in all_municipal_data.iterrows():
-                    city_data[row['city']] = row['value']
-                all_data[metric_jp] = city_data
-        
-        # 市町村ごとに情報をまとめて表示
+                ranking = all_municipal_data.sort_values('value', ascending=False)['city'].tolist()
+                ranks = {}
+                for rank, city in enumerate(ranking, 1):
+                    ranks.setdefault(city, rank)
+                values = dict(zip(all_municipal_data['city'].tolist(), all_municipal_data['value'].tolist()))
+                all_data[metric_jp] = (values, ranks, len(ranking))
+        
+        # 市町村ごとに情報をまとめる（データがない指標は値が欠損の行）
         for city in locations:
-            result += f"### {city}\n\n"
-            
             for metric_jp in metrics:
-                if metric_jp in all_data and city in all_data[metric_jp]:
-                    value = all_data[metric_jp][city]
-                    result += f"**{metric_jp}:** {value:,}{get_unit(metric_jp)}"
-                    
-                    # ランキング情報を追加
-                    if metric_jp in all_rankings:
-                        ranking = all_rankings[metric_jp]
-                        city_rank_info = ranking[ranking['city'] == city]
-                        if not city_rank_info.empty:
-                            rank = city_rank_info.index[0] + 1
-                            result += f" （全市町村中 {rank}位／{len(ranking)}市町村）"
-                    result += "  \n"  # 改行を追加（マークダウンの改行）
-                else:
-                    result += f"**{metric_jp}:** {target_year}年のデータがありません。  \n"
-            
-            result += "\n"
-        
-        return result
+                record = {"name": city, "level": "city", "metric": metric_jp, "year": target_year}
+                if metric_jp in all_data and city in all_data[metric_jp][0]:
+                    values, ranks, total = all_data[metric_jp]
+                    record.update(value=values[city], rank=ranks[city], rank_total=total)
+                records.append(record)
+        title = f"{target_year}年 基本情報"
     
     elif location_type == "エリア":
-        result = f"## {target_year}年 エリア別基本情報\n\n"
-        
         for area in locations:
-            result += f"### {area}エリア\n\n"
             area_cities = REGION_MAP.get(area, [])
-            
             for metric_jp in metrics:
-                metric_en = {"軒数": "facilities", "客室数": "rooms", "収容人数": "capacity"}[metric_jp]
-                
-                # エリアデータ集計
-                area_data = df.query(f"city in @area_cities & metric == @metric_en & cat1 == 'total' & year == @target_year & ~city.isin(@exclude_list)")
-                total_value = area_data['value'].sum()
-                
-                result += f"**{metric_jp}:** {total_value:,}{get_unit(metric_jp)}  \n"
-                
-                # エリア内トップ3
+                # エリア合計とエリア内トップ3（内訳の行）
+                area_data = select_rows(df, metric_map[metric_jp], "total", target_year, target_year, cities=area_cities, exclude_cities=exclude_list)
+                records.append({"name": area, "level": "area", "metric": metric_jp, "year": target_year,
+                                "value": location_total(df, metric_map[metric_jp], target_year, cities=area_cities, exclude_cities=exclude_list)})
                 top3 = area_data.sort_values('value', ascending=False).head(3)
-                if not top3.empty:
-                    result += f"　主要市町村: "
-                    details = [f"{row['city']}({row['value']:,})" for _, row in top3.iterrows()]
-                    result += "、".join(details) + "  \n"
-            
-            result += "\n"
-            
-        return result
+                records.extend(
+                    {"name": city, "level": "city", "parent": area, "metric": metric_jp, "year": target_year, "value": value, "rank": i}
+                    for i, (city, value) in enumerate(zip(top3['city'].tolist(), top3['value'].tolist()), 1)
+                )
+        title = f"{target_year}年 エリア別基本情報"
     
     else:  # 全体
-        result = f"## {target_year}年 沖縄県全体基本情報\n\n"
-        
         for metric_jp in metrics:
-            metric_en = {"軒数": "facilities", "客室数": "rooms", "収容人数": "capacity"}[metric_jp]
-            
-            # 市町村データのみをフィルタしてランキングと統計を計算
-            data_for_ranking = df.query(f"metric == @metric_en & cat1 == 'total' & year == @target_year & ~city.isin(@exclude_list)")
-            total_value = data_for_ranking['value'].sum()
-            
-            result += f"**{metric_jp}合計:** {total_value:,}{get_unit(metric_jp)}  \n"
-            result += f"**集計市町村数:** {len(data_for_ranking)}市町村  \n"
-            
-            # トップ5
+            # 市町村データのみで合計・集計市町村数・トップ5（内訳の行）を計算
+            data_for_ranking = select_rows(df, metric_map[metric_jp], "total", target_year, target_year, exclude_cities=exclude_list)
+            records.append({"name": "沖縄県", "level": "pref", "metric": metric_jp, "year": target_year,
+                            "value": location_total(df, metric_map[metric_jp], target_year, exclude_cities=exclude_list),
+                            "rank_total": len(data_for_ranking)})
             top5 = data_for_ranking.sort_values('value', ascending=False).head(5)
-            result += f"**{metric_jp}トップ5市町村:**  \n"
-            for i, (_, row) in enumerate(top5.iterrows(), 1):
-                result += f"　{i}位: {row['city']} ({row['value']:,}{get_unit(metric_jp)})  \n"
-            result += "  \n"
-            
-        return result
+            records.extend(
+                {"name": city, "level": "city", "parent": "沖縄県", "metric": metric_jp, "year": target_year, "value": value, "rank": i}
+                for i, (city, value) in enumerate(zip(top5['city'].tolist(), top5['value'].tolist()), 1)
+            )
+        title = f"{target_year}年 沖縄県全体基本情報"
+    
+    return make_answer("basic_info", title, records, location_type=location_type, year=target_year)
 
+@timed()
 def handle_ranking(df, metric_en, metric_jp, location_type, locations, ranking_count, ranking_year):
-    """ランキング表示の処理（棒グラフを生成・エリア対応版）"""
-    import plotly.graph_objects as go
-    
+    """ランキング表示の処理（画面では answer_figure の棒グラフで表示・エリア対応版）"""
     # エリア名と県名を除外するフィルタ
     exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
     
     # データの対象範囲を決定
-    if location_type == "市町村" and locations and locations != ["全体"]:
-        data = df.query(f"city in @locations & metric == @metric_en & cat1 == 'total' & year == @ranking_year & ~city.isin(@exclude_list)")
-        scope_text = f"選択市町村（{'・'.join(locations[:3])}{'など' if len(locations) > 3 else ''}）"
-        
-        # 該当データがない場合はメッセージを返す
-        if data.empty:
-            return f"## {ranking_year}年 {scope_text} {metric_jp}ランキング\n\n該当するデータがありません。"
-        
-        ranking = data.sort_values('value', ascending=False).head(ranking_count)
-        
-        # グラフ用データ
-        ranking_for_plot = ranking.sort_values('value', ascending=True)
-        x_values = ranking_for_plot['value']
-        y_labels = ranking_for_plot['city']
-        
-    elif location_type == "エリア" and locations and locations != ["全体"]:
-        # エリア別集計処理
+    if location_type == "エリア" and locations and locations != ["全体"]:
+        # エリア別集計処理（エリア内の市町村の合計）
         area_data = {}
-        
         for area in locations:
             area_cities = REGION_MAP.get(area, [])
-            
-            # エリア内の市町村データを取得
-            area_city_data = df.query(f"city in @area_cities & metric == @metric_en & cat1 == 'total' & year == @ranking_year & ~city.isin(@exclude_list)")
-            
-            # エリア合計を計算
-            area_total = area_city_data['value'].sum()
-            area_data[area] = area_total
+            area_data[area] = location_total(df, metric_en, ranking_year, cities=area_cities, exclude_cities=exclude_list)
         
         if not area_data:
             return f"## {ranking_year}年 エリア別 {metric_jp}ランキング\n\n該当するデータがありません。"
         
-        # エリアをランキング順にソート（降順）
-        sorted_areas = sorted(area_data.items(), key=lambda x: x[1], reverse=True)
-        
-        # グラフ用に昇順でソート（Plotlyの水平棒グラフ用）
-        sorted_areas_for_plot = sorted(area_data.items(), key=lambda x: x[1], reverse=False)
-        
+        # エリアをランキング順にソート（降順）
+        ranked = sorted(area_data.items(), key=lambda x: x[1], reverse=True)
         scope_text = f"{'・'.join(locations)}エリア"
-        x_values = [value for area, value in sorted_areas_for_plot]
-        y_labels = [f"{area}エリア" for area, value in sorted_areas_for_plot]
-        
-    else:  # 全体またはフィルタなし
-        data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @ranking_year & ~city.isin(@exclude_list)")
-        scope_text = "全市町村"
+        level = "area"
+    else:
+        if location_type == "市町村" and locations and locations != ["全体"]:
+            data = select_rows(df, metric_en, "total", ranking_year, ranking_year, cities=locations, exclude_cities=exclude_list)
+            scope_text = f"選択市町村（{'・'.join(locations[:3])}{'など' if len(locations) > 3 else ''}）"
+        else:  # 全体またはフィルタなし
+            data = select_rows(df, metric_en, "total", ranking_year, ranking_year, exclude_cities=exclude_list)
+            scope_text = "全市町村"
         
         # 該当データがない場合はメッセージを返す
         if data.empty:
             return f"## {ranking_year}年 {scope_text} {metric_jp}ランキング\n\n該当するデータがありません。"
         
         ranking = data.sort_values('value', ascending=False).head(ranking_count)
-        
-        # グラフ用データ
-        ranking_for_plot = ranking.sort_values('value', ascending=True)
-        x_values = ranking_for_plot['value']
-        y_labels = ranking_for_plot['city']
+        ranked = list(zip(ranking['city'].tolist(), ranking['value'].tolist()))
+        level = "city"
     
-    # 棒グラフ作成
-    unit = get_unit(metric_jp)
     title_text = f"{ranking_year}年 {scope_text} {metric_jp}ランキング"
     if location_type != "エリア":
         title_text += f" トップ{ranking_count}"
-    
-    fig = go.Figure(go.Bar(
-        x=x_values,
-        y=y_labels,
-        orientation='h',
-        text=[f'{x:,}' for x in x_values],  # バーの横に数値を表示
-        textposition='outside',
-        hovertemplate=f"%{{y}}: %{{x:,}}{unit}<extra></extra>",
-        marker_color='cornflowerblue'
-    ))
-    
-    fig.update_layout(
-        title=title_text,
-        xaxis_title=f"{metric_jp} ({unit})",
-        yaxis_title="エリア" if location_type == "エリア" else "市町村",
-        yaxis=dict(tickmode='linear'),  # すべてのラベルを表示
-        height=max(400, len(y_labels) * 40),  # 件数に応じて高さを調整
-        margin=dict(l=120, r=40, t=80, b=40)  # 左マージンを広げて名前を見やすくする
-    )
-    
-    return fig
+    records = [
+        {"name": name, "level": level, "metric": metric_jp, "year": ranking_year, "value": value, "rank": i}
+        for i, (name, value) in enumerate(ranked, 1)
+    ]
+    return make_answer("ranking", title_text, records, unit=get_unit(metric_jp), metric_jp=metric_jp, location_type=location_type)
 
 def display_help_content():
     """ヘルプコンテンツの表示（ブラッシュアップ版）"""
@@ -1421,6 +3211,11 @@ def display_help_content():
             4. **🏛️ ホテル・旅館種別**: リゾート・ビジネス・シティホテル等の分析
             5. **🗺️ エリア別分析**: 南部・中部・北部・宮古・八重山・離島の分析
             
+            定型の質問にない集計は **🧮 SQL** タブで、読み取り専用の SQL として実行できます。
+            
+            指標は軒数・客室数・収容人数のほか、**1軒あたり客室数・1室あたり収容人数・構成比（total に占める割合）** も選べます
+            （エリア・県全体の値は合計どうしの比。構成比は各タブの詳細項目で使い、質問では選べません）。
+            
             #### ✨ 主な特徴
             - **操作が簡単**: クリックとドラッグで直感的に操作
             - **リアルタイム更新**: 設定変更で即座にグラフが更新
@@ -2700,6 +4495,7 @@ def display_help_content():
     **データ期間**: 昭和47年（1972年）〜令和6年（2024年）の52年間
     """)
 
+@timed()
 def handle_change_analysis(df, metric_en, metric_jp, location_type, locations, params):
     """増減・伸び率分析の処理"""
     analysis_type = params['analysis_type']
@@ -2710,28 +4506,31 @@ def handle_change_analysis(df, metric_en, metric_jp, location_type, locations, p
     if analysis_type == "対前年比較":
         target_year = params['target_year']
         return handle_year_over_year_analysis(df, metric_en, metric_jp, location_type, locations, 
-                                            target_year, result_type, show_ranking, ranking_count)
+                                            target_year, result_type, show_ranking, ranking_count,
+                                            dataset=params.get('dataset'))
     else:
         start_year = params['start_year']
         end_year = params['end_year']
         return handle_period_change_analysis(df, metric_en, metric_jp, location_type, locations,
-                                           start_year, end_year, result_type, show_ranking, ranking_count)
+                                           start_year, end_year, result_type, show_ranking, ranking_count,
+                                           dataset=params.get('dataset'))
 
-def handle_year_over_year_analysis(df, metric_en, metric_jp, location_type, locations, target_year, result_type, show_ranking, ranking_count):
+@timed()
+def handle_year_over_year_analysis(df, metric_en, metric_jp, location_type, locations, target_year, result_type, show_ranking, ranking_count, dataset=None):
     """
     対前年比較分析（全体順位の母数を41市町村に限定して修正）
     """
     # 1. 全41市町村のリストを定義
     all_municipalities_list = list(CITY_CODE.keys())
     
-    # 2. 全41市町村のデータを取得
-    current_data_all = df.query(f"metric == @metric_en & cat1 == 'total' & year == @target_year & city in @all_municipalities_list").set_index('city')['value']
-    previous_data_all = df.query(f"metric == @metric_en & cat1 == 'total' & year == {target_year - 1} & city in @all_municipalities_list").set_index('city')['value']
+    # 2. 全41市町村の前年・対象年の組を期間増減マトリクスから引く
+    matrix = period_matrix(dataset, metric_en) if dataset is not None else build_period_matrix(df, metric_en)
+    changes = period_change(matrix, target_year - 1, target_year, cities=all_municipalities_list)
 
-    # 3. 全41市町村での増減数・増減率を計算
-    common_cities_all = current_data_all.index.intersection(previous_data_all.index)
-    increases_all = current_data_all.reindex(common_cities_all) - previous_data_all.reindex(common_cities_all)
-    rates_all = (increases_all / previous_data_all.reindex(common_cities_all).replace(0, pd.NA) * 100).fillna(0)
+    # 3. 全41市町村での増減数・増減率（前年が0の場合は0）
+    common_cities_all = changes.index
+    increases_all = changes['change']
+    rates_all = changes['rate'].where(changes['start'] != 0, 0)
 
     # 4. 全41市町村での順位を計算
     increase_ranks = increases_all.rank(method='min', ascending=False).astype(int)
@@ -2749,258 +4548,1210 @@ def handle_year_over_year_analysis(df, metric_en, metric_jp, location_type, loca
         cities_to_display = increases_all.sort_values(ascending=False).head(ranking_count).index.tolist() if show_ranking else common_cities_all.tolist()
         scope_text = "全市町村"
 
-    # 6. 結果を生成
-    result = f"## {target_year}年 対前年{metric_jp}分析（{scope_text}）\n\n"
-    
-    if show_ranking and location_type == "全体":
-        result += f"### 📈 対前年増減数 上位{len(cities_to_display)}市町村\n"
-        
-    for city in sorted(cities_to_display, key=lambda c: increases_all.get(c, -float('inf')), reverse=True):
-        if city in common_cities_all:
-            increase = increases_all.get(city, 0)
-            rate = rates_all.get(city, 0)
-            current_val = current_data_all.get(city, 0)
-            previous_val = previous_data_all.get(city, 0)
-            inc_rank = increase_ranks.get(city, '-')
-            rate_rank = rate_ranks.get(city, '-')
-
-            result += f"**{city}**\n"
-            result += f"- **対前年増減数**: {increase:+,}{get_unit(metric_jp)} （全体 {inc_rank}位 / {total_municipalities_in_rank}市町村）\n"
-            result += f"- **対前年増減率**: {rate:+.1f}% （全体 {rate_rank}位 / {total_municipalities_in_rank}市町村）\n"
-            result += f"- {target_year}年: {current_val:,}{get_unit(metric_jp)}\n"
-            result += f"- {target_year-1}年: {previous_val:,}{get_unit(metric_jp)}\n\n"
-        elif city in locations:
-             result += f"**{city}**: {target_year}年または{target_year-1}年のデータがなく、計算できませんでした。\n\n"
-
-    return result
-
-def handle_period_change_analysis(df, metric_en, metric_jp, location_type, locations, start_year, end_year, result_type, show_ranking, ranking_count):
+    # 6. 結果を生成（選択されているがデータがない市町村は増減が欠損の行）
+    ranked = changes.assign(rate=rates_all, change_rank=increase_ranks, rate_rank=rate_ranks)
+    records = analysis_records(cities_to_display, locations, ranked,
+                               metric_jp, target_year - 1, target_year, total_municipalities_in_rank)
+    subtitle = f"対前年増減数 上位{len(cities_to_display)}市町村" if show_ranking and location_type == "全体" else None
+    return make_answer("change_analysis", f"{target_year}年 対前年{metric_jp}分析（{scope_text}）", records,
+                       unit=get_unit(metric_jp), prefix="対前年", subtitle=subtitle,
+                       missing_text=f"{target_year}年または{target_year-1}年")
+
+@timed()
+def handle_period_change_analysis(df, metric_en, metric_jp, location_type, locations, start_year, end_year, result_type, show_ranking, ranking_count, dataset=None):
     """
     期間比較分析（全体順位の母数を41市町村に限定して修正）
     """
     # 1. 全41市町村のリストを定義
     all_municipalities_list = list(CITY_CODE.keys())
 
-    # 2. 全41市町村のデータを取得
-    start_data_all = df.query(f"metric == @metric_en & cat1 == 'total' & year == @start_year & city in @all_municipalities_list").set_index('city')['value']
-    end_data_all = df.query(f"metric == @metric_en & cat1 == 'total' & year == @end_year & city in @all_municipalities_list").set_index('city')['value']
+    # 2. 全41市町村の開始年・終了年の組を期間増減マトリクスから引く
+    matrix = period_matrix(dataset, metric_en) if dataset is not None else build_period_matrix(df, metric_en)
+    changes = period_change(matrix, start_year, end_year, cities=all_municipalities_list)
+
+    # 3. 全41市町村での増減数・増減率（開始年が0の場合は0）
+    common_cities_all = changes.index
+    increases_all = changes['change']
+    rates_all = changes['rate'].where(changes['start'] != 0, 0)
+
+    # 4. 全41市町村での順位を計算
+    increase_ranks = increases_all.rank(method='min', ascending=False).astype(int)
+    rate_ranks = rates_all.rank(method='min', ascending=False).astype(int)
+    total_municipalities_in_rank = len(increases_all) # データが存在する市町村の総数
+
+    # 5. 表示対象の市町村リストを決定
+    if location_type == "市町村":
+        cities_to_display = locations
+        scope_text = "選択市町村"
+    elif location_type == "エリア":
+        cities_to_display = [city for area in locations for city in REGION_MAP.get(area, [])]
+        scope_text = f"{'・'.join(locations)}エリア"
+    else: # 全体
+        cities_to_display = increases_all.sort_values(ascending=False).head(ranking_count).index.tolist() if show_ranking else common_cities_all.tolist()
+        scope_text = "全市町村"
+
+    # 6. 結果を生成（選択されているがデータがない市町村は増減が欠損の行）
+    period_text = f"{start_year}年〜{end_year}年"
+    ranked = changes.assign(rate=rates_all, change_rank=increase_ranks, rate_rank=rate_ranks)
+    records = analysis_records(cities_to_display, locations, ranked,
+                               metric_jp, start_year, end_year, total_municipalities_in_rank)
+    subtitle = f"期間増減数 上位{len(cities_to_display)}市町村" if show_ranking and location_type == "全体" else None
+    return make_answer("change_analysis", f"{period_text} {metric_jp}変化分析（{scope_text}）", records,
+                       unit=get_unit(metric_jp), prefix="期間", subtitle=subtitle,
+                       missing_text=f"{start_year}年または{end_year}年")
+
+@timed()
+def handle_trend_analysis(df, metric_en, metric_jp, location_type, locations, start_year, end_year):
+    """期間推移分析の処理（場所ごとの年別の値と、開始年からの増減）"""
+    def series_records(name, level, years, values):
+        # 期間全体の変化は各年の値と開始年の値の差（開始年が0以下の場合、増減率は欠損）
+        if not values:
+            return [{"name": name, "level": level, "metric": metric_jp}]
+        first = values[0]
+        return [
+            {"name": name, "level": level, "metric": metric_jp, "year": year, "base_year": years[0],
+             "value": value, "base_value": first, "change": value - first,
+             "rate": (value - first) / first * 100 if first > 0 else None}
+            for year, value in zip(years, values)
+        ]
+
+    years = list(range(start_year, end_year + 1))
+    records = []
+    if location_type == "市町村":
+        for city in locations:
+            data = select_rows(df, metric_en, "total", start_year, end_year, cities=[city]).sort_values('year')
+            records += series_records(city, "city", data['year'].tolist(), data['value'].tolist())
+        title = f"{start_year}年〜{end_year}年 {metric_jp}推移"
+    
+    elif location_type == "エリア":
+        for area in locations:
+            area_cities = REGION_MAP.get(area, [])
+            totals = [location_total(df, metric_en, year, cities=area_cities) for year in years]
+            records += series_records(area, "area", years, totals)
+        title = f"{start_year}年〜{end_year}年 エリア別{metric_jp}推移"
+    
+    else:  # 全体
+        totals = [location_total(df, metric_en, year) for year in years]
+        records += series_records("沖縄県", "pref", years, totals)
+        title = f"{start_year}年〜{end_year}年 沖縄県全体{metric_jp}推移"
+    
+    return make_answer("trend", title, records, unit=get_unit(metric_jp))
+
+@timed()
+def handle_comparison(df, metric_en, metric_jp, location_type, locations, comparison_year):
+    """比較分析の処理"""
+    def city_records(data, parent=None):
+        return [
+            {"name": city, "level": "city", "parent": parent, "metric": metric_jp, "year": comparison_year, "value": value, "rank": i}
+            for i, (city, value) in enumerate(zip(data['city'].tolist(), data['value'].tolist()), 1)
+        ]
+
+    meta = {"unit": get_unit(metric_jp), "location_type": location_type}
+    if location_type == "市町村":
+        data = select_rows(df, metric_en, "total", comparison_year, comparison_year, cities=locations)
+        records = city_records(data.sort_values('value', ascending=False))
+        title = f"{comparison_year}年 {metric_jp}比較"
+    
+    elif location_type == "エリア":
+        area_data = []
+        for area in locations:
+            city_data = select_rows(df, metric_en, "total", comparison_year, comparison_year, cities=REGION_MAP.get(area, []))
+            area_data.append((area, location_total(df, metric_en, comparison_year, cities=REGION_MAP.get(area, [])), city_data))
+        
+        # エリアを値でソートし、エリア構成詳細としてエリア内トップ3を内訳の行にする
+        area_data.sort(key=lambda x: x[1], reverse=True)
+        records = [
+            {"name": area, "level": "area", "metric": metric_jp, "year": comparison_year, "value": total, "rank": i}
+            for i, (area, total, _) in enumerate(area_data, 1)
+        ]
+        for area, _, city_data in area_data:
+            records += city_records(city_data.sort_values('value', ascending=False).head(3), parent=area)
+        title = f"{comparison_year}年 エリア別{metric_jp}比較"
+    
+    else:  # 全体の場合は意味がないので、トップ10を表示
+        data = select_rows(df, metric_en, "total", comparison_year, comparison_year)
+        records = city_records(data.sort_values('value', ascending=False).head(10))
+        meta.update(total=location_total(df, metric_en, comparison_year), mean=data['value'].mean())
+        title = f"{comparison_year}年 沖縄県全体{metric_jp}トップ10"
+    
+    return make_answer("comparison", title, records, **meta)
+
+def get_unit(metric_jp):
+    """指標に応じた単位を返す"""
+    units = {
+        "軒数": "軒",
+        "施設数": "軒", 
+        "客室数": "室",
+        "部屋数": "室",
+        "収容人数": "人",
+        "定員": "人",
+        **{spec["label"]: spec["unit"] for spec in DERIVED_METRICS.values()},
+    }
+    return units.get(metric_jp, "")
+
+# ---------------- 回答データ ----------------
+# handle_* 関数は文字列ではなく回答データ（辞書）を返し、表示形式は描画関数で選ぶ。
+#   layout : 回答の種類（ANSWER_MARKDOWN のキー）
+#   title  : 見出し
+#   rows   : ANSWER_COLUMNS の型付き DataFrame（1行 = 1つの場所・指標・年の値。数値は1回だけ計算する）
+#   meta   : 単位・年・見出し補足など、行に載らない情報
+# 描画は answer_markdown（従来と同じ文章）・answer_table（表）・answer_figure（グラフ）・answer_json（JSON）。
+# 行の parent はエリア内の主要市町村など「内訳の行」を表し、parent が空の行を回答の主な行とする。
+ANSWER_COLUMNS = {
+    "name": ("str", "名称"),
+    "level": ("str", "区分"),  # city: 市町村 / area: エリア / pref: 沖縄県
+    "parent": ("str", "内訳元"),
+    "metric": ("str", "指標"),
+    "year": ("int", "年"),
+    "base_year": ("int", "比較年"),
+    "value": ("num", "値"),
+    "base_value": ("num", "比較年の値"),
+    "change": ("num", "増減数"),
+    "rate": ("float", "増減率(%)"),
+    "rank": ("int", "順位"),
+    "change_rank": ("int", "増減数順位"),
+    "rate_rank": ("int", "増減率順位"),
+    "rank_total": ("int", "順位の母数"),
+}
+ANSWER_TABLE_PLACES = 10  # 主な行の場所がこれより多い回答は文章ではなく表で表示する
+
+
+def _answer_column(values, kind):
+    """
+    回答の列を型付きの配列にする（int: Int64 / float: float64 / num: 整数だけなら Int64、それ以外は float64）。
+    num の小数（派生指標の値・増減）は DERIVED_DECIMALS 桁に丸める。
+    """
+    if kind == "str":
+        return pd.array(values, dtype="str")
+    if kind == "float":
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    present = [v for v in values if v is not None and not pd.isna(v)]
+    if kind == "int" or all(isinstance(v, (int, np.integer)) for v in present):
+        return pd.array(values, dtype="Int64")
+    return np.array([np.nan if v is None else v for v in values], dtype=float).round(DERIVED_DECIMALS)
+
+
+def make_answer(layout, title, records, **meta):
+    """回答データを作る。records は ANSWER_COLUMNS のキーを持つ辞書の列（無いキーは欠損）"""
+    rows = pd.DataFrame({
+        col: _answer_column([record.get(col) for record in records], kind)
+        for col, (kind, _) in ANSWER_COLUMNS.items()
+    })
+    return {"layout": layout, "title": title, "rows": rows, "meta": meta}
+
+
+def change_records(cities, changes, metric_jp, start_year, end_year):
+    """period_change の結果から cities の順に増減の行を作る（rank は並び順）"""
+    ranked = changes.loc[list(cities)]
+    return [
+        {"name": city, "level": "city", "metric": metric_jp, "year": end_year, "base_year": start_year,
+         "value": end, "base_value": start, "change": change, "rate": rate, "rank": i}
+        for i, (city, start, end, change, rate) in enumerate(zip(
+            ranked.index, ranked["start"].tolist(), ranked["end"].tolist(),
+            ranked["change"].tolist(), ranked["rate"].tolist()), 1)
+    ]
+
+
+def analysis_records(cities, locations, changes, metric_jp, start_year, end_year, rank_total):
+    """
+    増減・伸び率分析の行。cities を増減数の降順に並べ、changes（period_change に順位列を加えたもの）にない市町村は
+    locations に含まれる場合だけ増減が欠損の行にする。
+    """
+    increases = changes['change']
+    records = []
+    for city in sorted(cities, key=lambda c: increases.get(c, -float('inf')), reverse=True):
+        record = {"name": city, "level": "city", "metric": metric_jp, "year": end_year, "base_year": start_year}
+        if city in changes.index:
+            record.update({col: changes[col][city] for col in ["change", "rate", "change_rank", "rate_rank"]},
+                          value=changes['end'][city], base_value=changes['start'][city], rank_total=rank_total)
+        elif city not in locations:
+            continue
+        records.append(record)
+    return records
+
+
+def _answer_label(row):
+    """行の表示名（エリアは「〜エリア」）"""
+    return f"{row.name}エリア" if row.level == "area" else row.name
+
+
+def _main_rows(answer):
+    """回答の主な行（内訳の行を除く）"""
+    rows = answer["rows"]
+    return rows[rows["parent"].isna()]
+
+
+def _detail_rows(answer, parent, metric=None):
+    """parent の内訳の行（metric を指定するとその指標だけ）"""
+    rows = answer["rows"]
+    mask = rows["parent"] == parent
+    if metric is not None:
+        mask &= rows["metric"] == metric
+    return rows[mask.fillna(False).to_numpy(dtype=bool)]
+
+
+def _markdown_change_ranking(answer):
+    """増減数・増減率ランキング（市町村・エリア、対前年・期間）"""
+    meta = answer["meta"]
+    unit, prefix = meta["unit"], meta["prefix"]
+    parts = [f"## {answer['title']}\n\n"]
+    for row in answer["rows"].itertuples(index=False):
+        change_line = f"- {prefix}増減数: {row.change:+,}{unit}\n"
+        rate_line = f"- {prefix}増減率: {'新規開設' if row.rate == float('inf') else f'{row.rate:+.1f}%'}\n"
+        parts.append(f"**{row.rank}位: {_answer_label(row)}**\n")
+        parts.extend([change_line, rate_line] if meta["result_type"] == "増減数" else [rate_line, change_line])
+        parts.append(f"- {row.year}年: {row.value:,}{unit}\n")
+        parts.append(f"- {row.base_year}年: {row.base_value:,}{unit}\n\n")
+    return "".join(parts)
+
+
+def _markdown_change_analysis(answer):
+    """増減・伸び率分析（全41市町村中の順位付き）"""
+    meta = answer["meta"]
+    unit, prefix = meta["unit"], meta["prefix"]
+    parts = [f"## {answer['title']}\n\n"]
+    if meta.get("subtitle"):
+        parts.append(f"### 📈 {meta['subtitle']}\n")
+    for row in answer["rows"].itertuples(index=False):
+        if pd.isna(row.change):
+            parts.append(f"**{row.name}**: {meta['missing_text']}のデータがなく、計算できませんでした。\n\n")
+            continue
+        parts.append(f"**{row.name}**\n")
+        parts.append(f"- **{prefix}増減数**: {row.change:+,}{unit} （全体 {row.change_rank}位 / {row.rank_total}市町村）\n")
+        parts.append(f"- **{prefix}増減率**: {row.rate:+.1f}% （全体 {row.rate_rank}位 / {row.rank_total}市町村）\n")
+        parts.append(f"- {row.year}年: {row.value:,}{unit}\n")
+        parts.append(f"- {row.base_year}年: {row.base_value:,}{unit}\n\n")
+    return "".join(parts)
+
+
+def _answer_value(value, metric_jp):
+    """値の表示。複数の指標を含む回答では値の列が float になるため、生の指標は整数で表示する"""
+    return f"{int(value):,}" if metric_jp in METRIC_JP.values() else f"{value:,}"
+
+
+def _markdown_basic_info(answer):
+    """基本情報取得（市町村: 順位付き / エリア: 主要市町村 / 全体: 合計とトップ5）"""
+    meta = answer["meta"]
+    year = meta["year"]
+    parts = [f"## {answer['title']}\n\n"]
+    main = _main_rows(answer)
+    if meta["location_type"] == "全体":
+        for row in main.itertuples(index=False):
+            unit = get_unit(row.metric)
+            total_label = "合計" if row.metric in METRIC_JP.values() else "（県全体）"
+            parts.append(f"**{row.metric}{total_label}:** {_answer_value(row.value, row.metric)}{unit}  \n")
+            parts.append(f"**集計市町村数:** {row.rank_total}市町村  \n")
+            parts.append(f"**{row.metric}トップ5市町村:**  \n")
+            for top in _detail_rows(answer, row.name, row.metric).itertuples(index=False):
+                parts.append(f"　{top.rank}位: {top.name} ({_answer_value(top.value, row.metric)}{unit})  \n")
+            parts.append("  \n")
+        return "".join(parts)
+
+    for name, group in main.groupby("name", sort=False):
+        first = next(group.itertuples(index=False))
+        parts.append(f"### {_answer_label(first)}\n\n")
+        for row in group.itertuples(index=False):
+            unit = get_unit(row.metric)
+            if pd.isna(row.value):
+                parts.append(f"**{row.metric}:** {year}年のデータがありません。  \n")
+            elif row.level == "area":
+                parts.append(f"**{row.metric}:** {_answer_value(row.value, row.metric)}{unit}  \n")
+                tops = _detail_rows(answer, name, row.metric)
+                if len(tops):
+                    details = [f"{top.name}({_answer_value(top.value, row.metric)})" for top in tops.itertuples(index=False)]
+                    parts.append("　主要市町村: " + "、".join(details) + "  \n")
+            else:
+                parts.append(f"**{row.metric}:** {_answer_value(row.value, row.metric)}{unit} （全市町村中 {row.rank}位／{row.rank_total}市町村）  \n")
+        parts.append("\n")
+    return "".join(parts)
+
+
+def _markdown_trend(answer):
+    """期間推移分析（場所ごとの年別の値と期間全体の変化）"""
+    unit = answer["meta"]["unit"]
+    parts = [f"## {answer['title']}\n\n"]
+    for _, group in _main_rows(answer).groupby("name", sort=False):
+        first = next(group.itertuples(index=False))
+        if first.level != "pref":
+            parts.append(f"### {_answer_label(first)}\n\n")
+        if pd.isna(first.year):
+            parts.append("データが見つかりません。\n\n")
+            continue
+        for row in group.itertuples(index=False):
+            parts.append(f"- {row.year}年: {row.value:,}{unit}\n")
+        if len(group) >= 2:
+            last = group.iloc[-1]
+            rate = "" if pd.isna(last["rate"]) else f" ({last['rate']:+.1f}%)"
+            parts.append(f"\n**期間全体の変化:** {last['change']:+,}{unit}{rate}\n" + ("" if first.level == "pref" else "\n"))
+    return "".join(parts)
+
+
+def _markdown_comparison(answer):
+    """比較分析（順位と最大差・エリア構成・県全体の統計）"""
+    meta = answer["meta"]
+    unit = meta["unit"]
+    main = _main_rows(answer)
+    # 派生指標（比・構成比）のエリア・県全体の値は合計ではなく分子・分母それぞれの合計の比（location_total）
+    summed = main.empty or main["metric"].iloc[0] in METRIC_JP.values()
+    parts = [f"## {answer['title']}\n\n"]
+    for row in main.itertuples(index=False):
+        parts.append(f"**{row.rank}位: {_answer_label(row)}** - {row.value:,}{unit}\n")
+    if meta["location_type"] == "市町村":
+        if len(main) >= 2:
+            top, bottom = main.iloc[0], main.iloc[-1]
+            parts.append(f"\n**最大差:** {round(top['value'] - bottom['value'], DERIVED_DECIMALS):,}{unit}\n")
+            parts.append(f"（{top['name']} vs {bottom['name']}）\n")
+    elif meta["location_type"] == "エリア":
+        parts.append("\n### エリア構成詳細\n\n")
+        for row in main.itertuples(index=False):
+            parts.append(f"**{row.name}エリア** ({'合計' if summed else '値'}: {row.value:,}{unit})\n")
+            for city in _detail_rows(answer, row.name).itertuples(index=False):
+                parts.append(f"　- {city.name}: {city.value:,}{unit}\n")
+            parts.append("\n")
+    else:
+        parts.append(f"\n**{'県全体合計' if summed else '県全体の値'}:** {meta['total']:,}{unit}\n")
+        parts.append(f"**市町村平均:** {meta['mean']:,.1f}{unit}\n")
+    return "".join(parts)
+
+
+def _markdown_ranking(answer):
+    """ランキング表示（文章で使う場合。画面では answer_figure の棒グラフ）"""
+    unit = answer["meta"]["unit"]
+    lines = [f"**{row.rank}位: {_answer_label(row)}** - {row.value:,}{unit}\n" for row in answer["rows"].itertuples(index=False)]
+    return f"## {answer['title']}\n\n" + "".join(lines)
+
+
+ANSWER_MARKDOWN = {
+    "change_ranking": _markdown_change_ranking,
+    "change_analysis": _markdown_change_analysis,
+    "basic_info": _markdown_basic_info,
+    "trend": _markdown_trend,
+    "comparison": _markdown_comparison,
+    "ranking": _markdown_ranking,
+}
+
+
+def answer_markdown(answer):
+    """回答の文章（マークダウン）。文字列の回答（メッセージ・エラー）はそのまま返す"""
+    if isinstance(answer, str):
+        return answer
+    return ANSWER_MARKDOWN[answer["layout"]](answer)
+
+
+def answer_table(answer):
+    """回答の行を表示用の表にする（すべて欠損の列は省き、列名は日本語。期間推移は場所 × 年）"""
+    rows = answer["rows"]
+    if answer["layout"] == "trend":
+        return rows.dropna(subset=["year"]).pivot(index="name", columns="year", values="value").reindex(
+            rows["name"].unique()).rename_axis(index="名称", columns="年").reset_index()
+    rows = rows.loc[:, rows.notna().any().to_numpy()]
+    return rows.rename(columns={col: label for col, (_, label) in ANSWER_COLUMNS.items()})
+
+
+def answer_figure(answer):
+    """グラフで表示する回答（ランキング表示）の棒グラフ。グラフを持たない回答は None"""
+    if isinstance(answer, str) or answer["layout"] != "ranking":
+        return None
+    meta = answer["meta"]
+    unit = get_unit(meta["metric_jp"])
+    rows = answer["rows"].sort_values("value", ascending=True)
+    x_values = rows["value"].to_numpy(dtype=np.int64 if pd.api.types.is_integer_dtype(rows["value"]) else float)
+    y_labels = [_answer_label(row) for row in rows.itertuples(index=False)]
+    fig = go.Figure(go.Bar(
+        x=x_values,
+        y=y_labels,
+        orientation='h',
+        text=[f'{x:,}' for x in x_values],  # バーの横に数値を表示
+        textposition='outside',
+        hovertemplate=f"%{{y}}: %{{x:,}}{unit}<extra></extra>",
+        marker_color='cornflowerblue'
+    ))
+    fig.update_layout(
+        title=answer["title"],
+        xaxis_title=f"{meta['metric_jp']} ({unit})",
+        yaxis_title="エリア" if meta["location_type"] == "エリア" else "市町村",
+        yaxis=dict(tickmode='linear'),  # すべてのラベルを表示
+        height=max(400, len(y_labels) * 40),  # 件数に応じて高さを調整
+        margin=dict(l=120, r=40, t=80, b=40)  # 左マージンを広げて名前を見やすくする
+    )
+    return fig
+
+
+def answer_json(answer):
+    """回答データの JSON（行は欠損を null にしたレコードの列）"""
+    if isinstance(answer, str):
+        return json.dumps({"message": answer}, ensure_ascii=False)
+    rows = answer["rows"].astype(object).where(answer["rows"].notna(), None)
+    return json.dumps({
+        "layout": answer["layout"],
+        "title": answer["title"],
+        "meta": answer["meta"],
+        "rows": rows.to_dict(orient="records"),
+    }, ensure_ascii=False, default=lambda v: v.item() if hasattr(v, "item") else str(v))
+
+
+def render_answer(answer, key=None):
+    """
+    回答を表示する。グラフを持つ回答はグラフ、主な行の場所が ANSWER_TABLE_PLACES を超える回答は表、それ以外は文章。
+    回答データには表（CSV）と JSON のダウンロードを付ける（key はグラフ・ダウンロードボタンのキーの接頭辞。
+    同じ回答を1回の実行で複数表示する場合は、回答ごとに別の key を渡す）。
+    """
+    chart_key = f"{key}_chart" if key is not None else None
+    if isinstance(answer, go.Figure):
+        st.plotly_chart(answer, use_container_width=True, key=chart_key)
+        return
+    if isinstance(answer, str):
+        st.markdown(answer)
+        return
+    figure = answer_figure(answer)
+    if figure is not None:
+        st.plotly_chart(figure, use_container_width=True, key=chart_key)
+    elif _main_rows(answer)["name"].nunique() > ANSWER_TABLE_PLACES:
+        st.markdown(f"## {answer['title']}")
+        show_table(answer_table(answer), hide_index=True, use_container_width=True)
+    else:
+        st.markdown(answer_markdown(answer))
+    if key is not None:
+        col1, col2 = st.columns(2)
+        col1.download_button("表をダウンロード（CSV）", answer_table(answer).to_csv(index=False).encode("utf-8-sig"),
+                             file_name="answer.csv", mime="text/csv", key=f"{key}_csv")
+        col2.download_button("回答データをダウンロード（JSON）", answer_json(answer).encode("utf-8"),
+                             file_name="answer.json", mime="application/json", key=f"{key}_json")
+
+
+# ---------------- 一括質問 ----------------
+# ランキング分析タブの質問を複数まとめて実行する（例: 3指標 × 直近5年のランキング）。
+# 質問は process_structured_question に渡すパラメータの辞書で表し、組み合わせから作るか JSON Lines で貼り付ける。
+# 共有のデータセットに対してスレッドプールで並行に処理し、終わった質問から順に表示する。
+BATCH_WORKERS = int(os.environ.get("OKINAWA_BATCH_WORKERS", "4"))  # 並行して処理する質問数
+BATCH_MAX_QUESTIONS = 50  # 1回に実行できる質問数の上限
+BATCH_QUESTION_TYPES = ["基本情報取得", "ランキング表示", "増減数ランキング", "増減率ランキング", "増減・伸び率分析", "比較分析"]
+BATCH_EXAMPLE = """{"question_type": "ランキング表示", "metric": "客室数", "ranking_year": 2024, "ranking_count": 10}
+{"question_type": "増減率ランキング", "metric": "軒数", "analysis_type": "期間比較", "start_year": 2019, "end_year": 2024, "ranking_count": 5}
+{"question_type": "比較分析", "metric": "収容人数", "location_type": "エリア", "locations": ["南部", "中部", "北部"], "comparison_year": 2024}"""
+
+
+def build_batch_questions(question_types, metrics, years, ranking_count=5, location_type="全体", locations=None):
+    """質問タイプ × 指標 × 年の組み合わせから質問の一覧を作る（基本情報取得は指標をまとめて1問）"""
+    locations = list(locations) if location_type != "全体" and locations else ["全体"]
+    if locations == ["全体"]:
+        location_type = "全体"
+    questions = []
+    for question_type in question_types:
+        for year in years:
+            base = {"question_type": question_type, "location_type": location_type, "locations": locations}
+            if question_type == "基本情報取得":
+                if metrics:
+                    questions.append({**base, "metrics": list(metrics), "target_year": year})
+                continue
+            for metric in metrics:
+                question = {**base, "metric": metric}
+                if question_type == "ランキング表示":
+                    question.update(ranking_year=year, ranking_count=ranking_count)
+                elif question_type in ["増減数ランキング", "増減率ランキング"]:
+                    question.update(analysis_type="対前年比較", target_year=year, ranking_count=ranking_count,
+                                    result_type="増減数" if question_type == "増減数ランキング" else "増減率")
+                elif question_type == "増減・伸び率分析":
+                    question.update(analysis_type="対前年比較", target_year=year, result_type="両方",
+                                    show_ranking=True, ranking_count=ranking_count)
+                elif question_type == "比較分析":
+                    question.update(comparison_year=year)
+                questions.append(question)
+    return questions
+
+
+# 貼り付けた質問の検査に使う、質問タイプごとの必須キーと省略時の既定値（build_batch_questions が作る質問と同じ）。
+# 増減系の年のキーは analysis_type で決まる（BATCH_ANALYSIS_YEARS）。
+BATCH_QUESTION_SPECS = {
+    "基本情報取得": {"required": ["target_year"], "defaults": {}},
+    "ランキング表示": {"required": ["ranking_year"], "defaults": {"ranking_count": 5}},
+    "増減数ランキング": {"required": [], "defaults": {"result_type": "増減数", "ranking_count": 5}},
+    "増減率ランキング": {"required": [], "defaults": {"result_type": "増減率", "ranking_count": 5}},
+    "増減・伸び率分析": {"required": [], "defaults": {"result_type": "両方", "show_ranking": True, "ranking_count": 5}},
+    "期間推移分析": {"required": ["start_year", "end_year"], "defaults": {}},
+    "比較分析": {"required": ["comparison_year"], "defaults": {}},
+}
+BATCH_ANALYSIS_YEARS = {
+    "対前年比較": ["target_year"],
+    "期間比較": ["start_year", "end_year"],
+    "期間比較（開始年〜最新年）": ["start_year", "end_year"],
+}
+BATCH_YEAR_KEYS = ["target_year", "ranking_year", "comparison_year", "start_year", "end_year"]
+BATCH_QUESTION_KEYS = {"question_type", "metric", "metrics", "location_type", "locations", "ranking_count",
+                       "analysis_type", "result_type", "show_ranking", *BATCH_YEAR_KEYS}
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validate_batch_question(question):
+    """
+    貼り付けた1問を検査し、既定値を補った質問を返す。誤りは理由の文字列を持つ ValueError を送出する。
+    検査: 質問タイプ・未知のキー・指標（QUESTION_METRICS）・場所（locations はリスト）・必須キー・年（整数、開始年 ≦ 終了年）
+    """
+    if not isinstance(question, dict):
+        raise ValueError("1行に1つの JSON オブジェクトを書いてください")
+    question_type = question.get("question_type")
+    spec = BATCH_QUESTION_SPECS.get(question_type)
+    if spec is None:
+        raise ValueError(f"question_type がないか、未対応の質問タイプです（{'・'.join(BATCH_QUESTION_SPECS)}）")
+    unknown = sorted(set(question) - BATCH_QUESTION_KEYS)
+    if unknown:
+        raise ValueError(f"未対応のキーがあります: {', '.join(unknown)}")
+    question = {**spec["defaults"], **question}
+
+    if question_type == "基本情報取得":
+        metrics = question.pop("metrics", None)
+        if metrics is None and "metric" in question:
+            metrics = [question.pop("metric")]
+        if not isinstance(metrics, list) or not metrics:
+            raise ValueError("metrics（指標のリスト）を指定してください")
+        question["metrics"] = metrics
+    elif "metric" not in question:
+        raise ValueError("metric を指定してください")
+    for metric in question.get("metrics", [question.get("metric")]):
+        if metric not in QUESTION_METRICS:
+            raise ValueError(f"未対応の指標です: {metric}（{'・'.join(QUESTION_METRICS)}）")
+
+    location_type = question.setdefault("location_type", "全体")
+    if location_type == "全体":
+        question["locations"] = ["全体"]
+    else:
+        known = {"エリア": REGION_MAP, "市町村": CITY_CODE}.get(location_type)
+        if known is None:
+            raise ValueError(f"未対応の場所タイプです: {location_type}（全体・エリア・市町村）")
+        locations = question.get("locations")
+        if not isinstance(locations, list) or not locations:
+            raise ValueError("locations は場所名のリストで指定してください（例: [\"那覇市\"]）")
+        unknown = [str(location) for location in locations if location not in known]
+        if unknown:
+            raise ValueError(f"{location_type}名が正しくありません: {'・'.join(unknown)}")
+
+    required = list(spec["required"])
+    if question_type in ["増減数ランキング", "増減率ランキング", "増減・伸び率分析"]:
+        # 単一質問の画面と同じく、開始年があれば期間比較、なければ対前年比較
+        analysis_type = question.setdefault("analysis_type", "期間比較" if "start_year" in question else "対前年比較")
+        if analysis_type not in BATCH_ANALYSIS_YEARS:
+            raise ValueError(f"未対応の analysis_type です: {analysis_type}（{'・'.join(BATCH_ANALYSIS_YEARS)}）")
+        required += BATCH_ANALYSIS_YEARS[analysis_type]
+        if question["result_type"] not in ["増減数", "増減率", "両方"]:
+            raise ValueError(f"未対応の result_type です: {question['result_type']}（増減数・増減率・両方）")
+    missing = [key for key in required if key not in question]
+    if missing:
+        raise ValueError(f"{question_type}には {', '.join(missing)} が必要です")
+    for key in BATCH_YEAR_KEYS:
+        if key in question and not _is_int(question[key]):
+            raise ValueError(f"{key} は整数の年で指定してください（{question[key]!r}）")
+    if "start_year" in required and question["start_year"] > question["end_year"]:
+        raise ValueError(f"start_year（{question['start_year']}）が end_year（{question['end_year']}）より後です")
+    if "ranking_count" in question and not (_is_int(question["ranking_count"]) and question["ranking_count"] > 0):
+        raise ValueError(f"ranking_count は1以上の整数で指定してください（{question['ranking_count']!r}）")
+    return question
+
+
+def parse_batch_questions(text):
+    """JSON Lines（1行1問）の質問を読み込んで検査する（validate_batch_question）。誤りがあれば行番号付きの ValueError を送出する"""
+    questions = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            question = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise ValueError(f"{number}行目: JSON として読めません（{exc.msg}）") from exc
+        try:
+            questions.append(validate_batch_question(question))
+        except ValueError as exc:
+            raise ValueError(f"{number}行目: {exc}") from exc
+    return questions
+
+
+def batch_question_label(question):
+    """一括質問の見出し（質問タイプ・指標・年・場所）"""
+    metric = "・".join(question["metrics"]) if "metrics" in question else question.get("metric", "")
+    year = next((question[key] for key in ["ranking_year", "target_year", "comparison_year"] if key in question), None)
+    if year is None and "start_year" in question:
+        year = f"{question['start_year']}〜{question.get('end_year', '')}"
+    place = "・".join(question["locations"]) if question.get("location_type") != "全体" else "全体"
+    return "｜".join(str(part) for part in [question["question_type"], metric, f"{year}年" if year else None, place] if part)
+
+
+def run_batch_questions(dataset, questions, max_workers=None):
+    """
+    questions を共有のデータセットに対して並行に処理し、終わった順に (番号, 回答) を返すジェネレータ。
+    ワーカーでは Streamlit に書き込まないよう debug_mode は常に無効にする。途中で止めた場合は未着手の質問を取り消す。
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers or BATCH_WORKERS, thread_name_prefix="batch_question")
+    try:
+        futures = {
+            pool.submit(process_structured_question,
+                        **{**question, "df": dataset["long"], "dataset": dataset, "debug_mode": False}): index
+            for index, question in enumerate(questions)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_batch_questions(dataset, year_options_desc, all_municipalities):
+    """ランキング分析タブの一括質問: 質問の作成・並行実行・終わった順の表示"""
+    mode = st.radio("作成方法", ["組み合わせで作成", "JSON Lines で貼り付け"], horizontal=True, key="batch_mode")
+    if mode == "組み合わせで作成":
+        col1, col2 = st.columns(2)
+        with col1:
+            question_types = st.multiselect("質問タイプ", BATCH_QUESTION_TYPES, default=["ランキング表示"], key="batch_types")
+            metrics = st.multiselect("指標", QUESTION_METRICS, default=list(METRIC_JP.values()), key="batch_metrics")
+            years = st.multiselect("対象年度", year_options_desc, default=year_options_desc[:5], key="batch_years")
+        with col2:
+            ranking_count = st.selectbox("表示件数", [3, 5, 10, 15, 20], index=1, key="batch_ranking_count")
+            location_type = st.selectbox("場所タイプ", ["全体", "エリア", "市町村"], key="batch_location_type")
+            if location_type == "エリア":
+                locations = st.multiselect("エリア選択", list(REGION_MAP.keys()), default=list(REGION_MAP.keys()), key="batch_areas")
+            elif location_type == "市町村":
+                locations = st.multiselect("市町村選択", all_municipalities, default=[], key="batch_cities")
+            else:
+                locations = ["全体"]
+        questions = build_batch_questions(question_types, metrics, years, ranking_count, location_type, locations)
+    else:
+        text = st.text_area("質問（1行に1問。キーは単一質問のパラメータと同じ）", value=BATCH_EXAMPLE, height=140, key="batch_json")
+        try:
+            questions = parse_batch_questions(text)
+        except ValueError as exc:
+            st.error(str(exc))
+            return
+
+    st.caption(f"{len(questions)} 問（同時実行 {BATCH_WORKERS}、上限 {BATCH_MAX_QUESTIONS} 問）")
+    if not st.button("▶️ 一括実行", key="run_batch_questions"):
+        return
+    if not questions:
+        st.warning("質問がありません。")
+        return
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        st.warning(f"質問は {BATCH_MAX_QUESTIONS} 問までです（{len(questions)} 問）。")
+        return
+
+    progress = st.progress(0.0, text="実行中...")
+    slots = []
+    for number, question in enumerate(questions, start=1):
+        st.markdown(f"#### {number}. {batch_question_label(question)}")
+        slots.append(st.empty())
+        slots[-1].caption("⏳ 待機中")
+    t0 = time.perf_counter()
+    for done, (index, answer) in enumerate(run_batch_questions(dataset, questions), start=1):
+        with slots[index].container():
+            render_answer(answer, key=f"batch_{index}")
+        progress.progress(done / len(questions), text=f"{done} / {len(questions)} 問")
+    progress.progress(1.0, text=f"{len(questions)} 問を {time.perf_counter() - t0:,.1f} 秒で処理しました")
+
+
+# ---------------- ヘルパー関数 ----------------
+def slice_pivot(pivot, year_range, columns=None, integer=True):
+    """
+    全期間ピボットから year_range の行（と columns の列）を切り出す。
+    範囲内にデータのない年・列は落とし、欠損がなければ整数に戻す（範囲で絞ってから pivot_table した場合と同じ形になる）。
+    """
+    sliced = pivot.loc[year_range[0]:year_range[1]]
+    if columns is not None:
+        sliced = sliced.loc[:, sliced.columns.isin(columns)]
+    sliced = sliced.dropna(how="all").dropna(axis=1, how="all")
+    if integer and not sliced.isna().to_numpy().any():
+        sliced = sliced.astype(np.int64)
+    return sliced
+
+
+def cached_pivot(dataset, df_table, kind, key, build):
+    """
+    df_table（build_dataset のテーブル別ビュー）の全期間ピボットを版ごとに保持して返す。
+    dataset がない場合や索引未登録のフレームはその場で build() する。
+    """
+    entry = _key_index_registry().get(id(df_table)) if dataset is not None else None
+    if entry is None or entry[0]() is not df_table or entry[3] is None:
+        return build()
+    pivots = derived_cache(dataset, kind)
+    key = (entry[3],) + key
+    if key not in pivots:
+        pivots[key] = build()
+    return pivots[key]
+
+
+@timed()
+def build_city_pivot(df_table, metric_en, cat1, year_range, cities=None, dataset=None):
+    """
+    市町村別タブ（タブ2〜4）の year × city ピボットを作成する。
+    cities を指定した場合はその市町村に絞り、市町村コード順に列を並べる。
+    dataset を渡すと全期間ピボットを版ごとに保持し、year_range はその切り出しだけで処理する。
+    """
+    full = cached_pivot(
+        dataset, df_table, "city_pivots", (metric_en, cat1),
+        lambda: select_rows(df_table, metric_en, cat1).pivot_table(index="year", columns="city", values="value", aggfunc="sum").sort_index(),
+    )
+    pivot = slice_pivot(full, year_range, cities, integer=pd.api.types.is_integer_dtype(metric_frame(df_table, metric_en)["value"].dtype))
+    if cities is not None:
+        pivot = pivot.reindex(columns=[city for city in sorted(CITY_CODE, key=CITY_CODE.get) if city in cities])
+    return pivot
+
+
+@timed()
+def build_hotel_group_pivot(df_hotel, metric_en, year_range, cities, prefix=None, suffix=None):
+    """
+    hotel_breakdown の「種別_規模」カテゴリを種別（prefix）または規模（suffix）ごとに合計したピボット。
+    派生指標は分子・分母それぞれのピボットの比（構成比の分母は hotel_breakdown の total）。
+    """
+    spec = DERIVED_METRICS.get(metric_en)
+    if spec is not None:
+        numerator = build_hotel_group_pivot(df_hotel, spec["numerator"], year_range, cities, prefix, suffix)
+        if spec["share"]:
+            denominator = build_city_pivot(df_hotel, spec["denominator"], "total", year_range, cities=cities)
+        else:
+            denominator = build_hotel_group_pivot(df_hotel, spec["denominator"], year_range, cities, prefix, suffix)
+        return derived_ratio(metric_en, numerator, denominator)
+    rows = select_rows(df_hotel, metric_en, start=year_range[0], end=year_range[1])
+    in_group = rows["cat1"].str.startswith(f"{prefix}_") if prefix else rows["cat1"].str.endswith(f"_{suffix}")
+    return (
+        rows[in_group & rows["city"].isin(cities)]
+        .groupby(['year', 'city'])['value'].sum().reset_index()
+        .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
+        .reindex(columns=[city for city in sorted(CITY_CODE, key=CITY_CODE.get) if city in cities])
+        .sort_index()
+    )
+
+
+@timed()
+def build_area_pivot(df_table, metric_en, cat1, year_range, areas, dataset=None):
+    """
+    エリア別タブ（タブ5）の year × area ピボット（REGION_MAP の市町村を合算）。
+    dataset を渡すと全期間ピボットを版ごとに保持し、year_range はその切り出しだけで処理する。
+    派生指標は分子・分母それぞれのエリア合計の比（構成比の分母は total）。
+    """
+    spec = DERIVED_METRICS.get(metric_en)
+    if spec is not None:
+        return derived_ratio(
+            metric_en,
+            build_area_pivot(df_table, spec["numerator"], cat1, year_range, areas, dataset),
+            build_area_pivot(df_table, spec["denominator"], "total" if spec["share"] else cat1, year_range, areas, dataset),
+        )
+    city_to_area = {c: r for r, lst in REGION_MAP.items() for c in lst}
+
+    def build():
+        rows = select_rows(df_table, metric_en, cat1)
+        return (
+            rows[rows["city"].isin(list(city_to_area))]
+            .assign(area=lambda d: d["city"].map(city_to_area))
+            .groupby(["area", "year"])['value'].sum()
+            .unstack("area")
+            .sort_index()
+        )
+
+    full = cached_pivot(dataset, df_table, "area_pivots", (metric_en, cat1, tuple(sorted(city_to_area.items()))), build)
+    pivot = slice_pivot(full, year_range, integer=pd.api.types.is_integer_dtype(df_table["value"].dtype))
+    return pivot.reindex(columns=areas)
+
+
+# background_gradient(cmap="Blues") と同じ ColorBrewer Blues の9色
+GRADIENT_BLUES = ["#f7fbff", "#deebf7", "#c6dbef", "#9ecae1", "#6baed6", "#4292c6", "#2171b5", "#08519c", "#08306b"]
+
+
+def gradient_css(frame, columns):
+    """
+    columns の各列を列ごとに最小〜最大で正規化し、Blues の背景色と文字色の CSS を配列演算で求める。
+    Styler.background_gradient と同じ256段階の色・文字色の切り替え（相対輝度 0.408 未満は白文字）で、matplotlib は使わない。
+    戻り値は frame と同じ形の CSS 文字列の DataFrame（対象外の列・欠損は空文字）。
+    """
+    css = pd.DataFrame("", index=frame.index, columns=frame.columns)
+    positions = [frame.columns.get_loc(col) for col in columns]
+    values = frame.iloc[:, positions].to_numpy(dtype=float)
+    if not values.size:
+        return css
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        low, high = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+        scaled = np.where(high > low, (values - low) / (high - low), 0.0)
+    scaled = np.nan_to_num(np.clip(scaled, 0, 1))  # 欠損は最後に空文字にする
+    levels = np.minimum(np.floor(scaled * 256), 255) / 255 * (len(GRADIENT_BLUES) - 1)
+    stops = np.array([[int(color[i:i + 2], 16) / 255 for i in (1, 3, 5)] for color in GRADIENT_BLUES])
+    lower = np.minimum(np.floor(levels).astype(int), len(stops) - 2)
+    weight = (levels - lower)[..., None]
+    rgb = stops[lower] * (1 - weight) + stops[lower + 1] * weight
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    dark = linear @ np.array([0.2126, 0.7152, 0.0722]) < 0.408
+
+    codes = np.round(rgb * 255).astype(int).reshape(-1, 3)
+    cells = np.array([
+        f"background-color: #{r:02x}{g:02x}{b:02x};color: {'#f1f1f1' if d else '#000000'};"
+        for (r, g, b), d in zip(codes.tolist(), dark.ravel().tolist())
+    ], dtype=object).reshape(values.shape)
+    cells[np.isnan(values)] = ""
+    css.iloc[:, positions] = cells
+    return css
+
+
+@timed("st.dataframe")
+def show_table(frame, gradient_columns=None, **kwargs):
+    """
+    数値表を表示する。Styler は使わず、数値列は column_config で桁区切り（localized）にして Arrow のまま送る。
+    gradient_columns を指定した場合だけ、その列に背景色のグラデーションを付ける（色は gradient_css で計算し Styler で渡す）。
+    """
+    if gradient_columns is not None:
+        styled = frame.style.format(thousands=",").apply(lambda _: gradient_css(frame, gradient_columns), axis=None)
+        return st.dataframe(styled, **kwargs)
+    column_config = {
+        str(col): st.column_config.NumberColumn(format="localized")
+        for col, dtype in frame.dtypes.items() if pd.api.types.is_numeric_dtype(dtype)
+    }
+    return st.dataframe(frame, column_config=column_config, **kwargs)
+
+
+@timed()
+def create_period_change_heatmap(matrix, start_year, end_year, metric_jp, value="増減率"):
+    """
+    期間増減マトリクスから、開始年を基準にした 市町村 × 年 の増減ヒートマップを作る。
+    値は配列の切り出しだけで得られるため、年度スライダーを動かしても再集計しない。
+    """
+    unit = "%" if value == "増減率" else get_unit(metric_jp)
+    pos = matrix["year_pos"]
+    years = [y for y in matrix["years"] if start_year < y <= end_year]
+    fig = go.Figure()
+    if start_year in pos and years:
+        i = pos[start_year]
+        cols = [pos[y] for y in years]
+        present = matrix["present"][i][None, :] & matrix["present"][cols]
+        grid = matrix["rate"][i, cols] if value == "増減率" else matrix["change"][i, cols]
+        z = np.where(present & np.isfinite(grid), grid, np.nan).T
+        fig.add_heatmap(
+            z=z,
+            x=years,
+            y=list(matrix["cities"]),
+            colorscale="RdBu",
+            zmid=0,
+            colorbar=dict(title=unit),
+            hovertemplate=f"%{{y}} %{{x}}年: %{{z:+,.1f}}{unit}<extra></extra>" if value == "増減率"
+                          else f"%{{y}} %{{x}}年: %{{z:+,}}{unit}<extra></extra>",
+        )
+    fig.update_layout(
+        title=f"{start_year}年比 {metric_jp}{value}（市町村別）",
+        xaxis_title="年",
+        yaxis=dict(autorange="reversed", tickmode="linear"),
+        height=max(400, len(matrix["cities"]) * 18),
+        margin=dict(l=120, r=40, t=80, b=40),
+    )
+    return fig
+
+
+@timed()
+def create_city_year_heatmap(matrix, title, metric_jp, value="値", order="市町村コード順"):
+    """
+    city_year_matrix の表から 市町村 × 年 のヒートマップを作る（41市町村を1本の heatmap トレースで描く）。
+    前後のデータがない年は除き、order が「値の大きい順」ならデータのある最後の年の値で市町村を並べる（順位は1位から）。
+    """
+    filled = matrix.dropna(how="all")
+    frame = matrix.loc[filled.index[0]:filled.index[-1]] if len(filled) else matrix
+    if order == "値の大きい順" and len(filled):
+        latest = filled.iloc[-1]
+        frame = frame[latest.sort_values(ascending=value == "順位", na_position="last", kind="stable").index]
+    z = frame.to_numpy(dtype=float).T
+    finite = z[np.isfinite(z)]
+    integral = bool(np.array_equal(finite, np.round(finite)))
+    # 送るデータを小さくするため、欠損のない整数は最小の整数型、それ以外は float32 にする（欠損は NaN のまま空白）
+    if integral and finite.size == z.size and z.size and np.abs(z).max() < 2 ** 15:
+        z = z.astype(np.int16)
+    else:
+        z = z.astype(np.float32)
+    unit = "%" if value == "対前年増減率" else "位" if value == "順位" else get_unit(metric_jp)
+    hover = {
+        "値": f"%{{y}} %{{x}}年: %{{z:,{'' if integral else f'.{DERIVED_DECIMALS}f'}}}{unit}<extra></extra>",
+        "対前年増減率": f"%{{y}} %{{x}}年: %{{z:+,.1f}}{unit}<extra></extra>",
+        "順位": f"%{{y}} %{{x}}年: %{{z}}{unit}<extra></extra>",
+    }[value]
+    fig = go.Figure()
+    fig.add_heatmap(
+        z=z,
+        x=np.asarray(frame.index, dtype=np.int16),
+        y=list(frame.columns),
+        colorscale="RdBu" if value == "対前年増減率" else "Blues",
+        reversescale=value == "順位",
+        zmid=0 if value == "対前年増減率" else None,
+        colorbar=dict(title=unit),
+        hovertemplate=hover,
+        hoverongaps=False,
+    )
+    fig.update_layout(
+        title=title,
+        xaxis_title="年",
+        yaxis=dict(autorange="reversed", tickmode="linear"),
+        height=max(400, frame.shape[1] * 18),
+        margin=dict(l=120, r=40, t=80, b=40),
+    )
+    return fig
+
+
+# ---------------- 市町村境界地図 ----------------
+# CITY_CODE（全国地方公共団体コードの上5桁）で市町村境界の GeoJSON と結合し、キューブの値を塗り分けた地図を描く。
+# 境界はローカルの GeoJSON（map_geojson_path。tools/prepare_geojson で国土数値情報 N03 から簡略化して作成）を
+# プロセスで1回だけ読み込み、座標を MAP_COORD_DECIMALS 桁に丸めて保持する。背景タイルは使わない（white-bg）。
+# 図には境界を1回だけ含め、年はスライダー（frames）・指標はボタンで切り替える。切り替えで送るのは値の配列だけになる。
+MAP_GEOJSON_NAME = "okinawa_municipalities.geojson"
+MAP_COORD_DECIMALS = 4  # 座標の桁数（約10m）
+MAP_CODE_PROPERTIES = ["code", "N03_007", "city_code", "CITY_CODE", "JCODE"]  # 市町村コードを探すプロパティ（先頭から）
+MAP_NAME_PROPERTIES = ["name", "N03_004", "city", "CITY_NAME"]  # コードがない場合に市町村名を探すプロパティ
+MAP_WIDTH_PX = 700  # 初期表示のズームを決める地図の幅
+# plotly 5.24 未満は mapbox 版の地図（white-bg はどちらもタイル・アクセストークンを使わない）
+MAP_SUBPLOT = "map" if hasattr(go, "Choroplethmap") else "mapbox"
+MAP_TRACE = go.Choroplethmap if MAP_SUBPLOT == "map" else go.Choroplethmapbox
+
+
+def map_geojson_path():
+    """市町村境界の GeoJSON のパス（環境変数 OKINAWA_GEOJSON、既定はデータディレクトリの raw/ 配下）"""
+    return Path(os.environ.get("OKINAWA_GEOJSON") or RAW_DIR / MAP_GEOJSON_NAME)
+
+
+def _feature_code(properties):
+    """フィーチャーのプロパティから CITY_CODE の市町村コードを求める（該当なしは None）"""
+    codes = set(CITY_CODE.values())
+    for key in MAP_CODE_PROPERTIES:
+        value = str(properties.get(key) or "").strip()
+        if value[:5].isdigit() and int(value[:5]) in codes:
+            return int(value[:5])
+    for key in MAP_NAME_PROPERTIES:
+        code = CITY_CODE.get(str(properties.get(key) or "").strip())
+        if code is not None:
+            return code
+    return None
+
+
+def _quantize_ring(ring):
+    """リングの座標を丸め、丸めで重なった連続点を除く（4点未満になったリングは None）"""
+    points = np.round(np.asarray(ring, dtype=float)[:, :2], MAP_COORD_DECIMALS)
+    points = points[np.r_[True, (np.diff(points, axis=0) != 0).any(axis=1)]]
+    return points.tolist() if len(points) >= 4 else None
+
+
+@st.cache_resource
+def _municipal_geometry(path, signature):
+    """
+    GeoJSON を読み込み、市町村コードごとに1つの MultiPolygon にまとめる（signature はファイルの更新検知用）。
+    戻り値: {"geojson": id=市町村コードの FeatureCollection, "codes": 含まれる市町村コード, "center": {lat, lon}, "zoom"}
+    """
+    with open(path, encoding="utf-8") as f:
+        source = json.load(f)
+    polygons = defaultdict(list)
+    for feature in source.get("features", []):
+        geometry = feature.get("geometry") or {}
+        code = _feature_code(feature.get("properties") or {})
+        if code is None or geometry.get("type") not in ("Polygon", "MultiPolygon"):
+            continue
+        parts = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+        for part in parts:
+            rings = [_quantize_ring(ring) for ring in part]
+            if rings and rings[0] is not None:
+                polygons[code].append([ring for ring in rings if ring is not None])
+    if not polygons:
+        return None
+
+    features = [
+        {"type": "Feature", "id": code, "properties": {}, "geometry": {"type": "MultiPolygon", "coordinates": parts}}
+        for code, parts in sorted(polygons.items())
+    ]
+    points = np.array([point for parts in polygons.values() for part in parts for point in part[0]])
+    (lon_min, lat_min), (lon_max, lat_max) = points.min(axis=0), points.max(axis=0)
+    span = max(lon_max - lon_min, (lat_max - lat_min) * 1.2, 0.01)
+    return {
+        "geojson": {"type": "FeatureCollection", "features": features},
+        "codes": set(polygons),
+        "center": {"lat": float(lat_min + lat_max) / 2, "lon": float(lon_min + lon_max) / 2},
+        "zoom": float(np.log2(360 * MAP_WIDTH_PX / (256 * span))) - 0.3,
+    }
+
+
+def municipal_geometry():
+    """市町村境界（_municipal_geometry）。GeoJSON がない・読み込めない場合は None"""
+    path = map_geojson_path()
+    try:
+        stat = path.stat()
+        return _municipal_geometry(str(path), (stat.st_size, stat.st_mtime_ns))
+    except (OSError, ValueError) as exc:
+        if not isinstance(exc, FileNotFoundError):
+            TIMING_LOG.warning(json.dumps({"event": "geojson_error", "path": str(path), "error": str(exc)}, ensure_ascii=False))
+        return None
+
+
+@timed()
+def create_city_map(geometry, layers, title, value="値"):
+    """
+    市町村の塗り分け地図。layers は [(指標名, city_year_matrix の表)] で、最初の指標の最新年を初期表示にする。
+    境界は図に1回だけ含め、年はスライダー（指標ごとの frames）、指標はボタンで切り替える（送るのは z の配列だけ）。
+    """
+    municipalities = [city for city in sorted(CITY_CODE, key=CITY_CODE.get) if CITY_CODE[city] in geometry["codes"]]
+    locations = [CITY_CODE[city] for city in municipalities]
+    colors = {"対前年増減率": dict(colorscale="RdBu", reversescale=False), "順位": dict(colorscale="Blues", reversescale=True)}
+
+    def z_values(matrix, year):
+        return matrix.loc[year, municipalities].to_numpy(dtype=float).astype(np.float32)
+
+    frames, sliders, buttons = [], [], []
+    for i, (metric_jp, matrix) in enumerate(layers):
+        years = [int(y) for y in matrix.dropna(how="all").index]
+        finite = matrix[municipalities].to_numpy(dtype=float)
+        finite = finite[np.isfinite(finite)]
+        unit = "%" if value == "対前年増減率" else "位" if value == "順位" else get_unit(metric_jp)
+        if value == "対前年増減率":
+            # 小さい値からの増減率が極端な値になるため、色の範囲は絶対値の95パーセンタイルまで
+            limit = float(np.percentile(np.abs(finite), 95)) if finite.size else 1.0
+            zmin, zmax = -max(limit, 1.0), max(limit, 1.0)
+        else:
+            zmin, zmax = (float(finite.min()), float(finite.max())) if finite.size else (0.0, 1.0)
+        number = "%{z:+,.1f}" if value == "対前年増減率" else "%{z:,.0f}" if value == "順位" or metric_jp in METRIC_JP.values() \
+            else f"%{{z:,.{DERIVED_DECIMALS}f}}"
+        style = {
+            "zmin": zmin, "zmax": zmax, "colorbar": {"title": {"text": unit}},
+            "hovertemplate": f"%{{text}}: {number}{unit}<extra></extra>",
+        }
+        frames += [go.Frame(name=f"{i}|{year}", data=[MAP_TRACE(z=z_values(matrix, year))], traces=[0]) for year in years]
+        sliders.append([{
+            "active": len(years) - 1,
+            "currentvalue": {"prefix": f"{metric_jp} "},
+            "pad": {"t": 30},
+            "steps": [
+                {"label": str(year), "method": "animate",
+                 "args": [[f"{i}|{year}"], {"mode": "immediate", "frame": {"duration": 0, "redraw": True}, "transition": {"duration": 0}}]}
+                for year in years
+            ],
+        }])
+        latest = z_values(matrix, years[-1]) if years else np.full(len(municipalities), np.nan, dtype=np.float32)
+        latest_list = [None if np.isnan(v) else round(float(v), DERIVED_DECIMALS) for v in
+                       (matrix.loc[years[-1], municipalities].to_numpy(dtype=float) if years else latest)]
+        buttons.append({
+            "label": metric_jp, "method": "update",
+            "args": [{"z": [latest_list], **{key: [val] for key, val in style.items()}},
+                     {"sliders": sliders[-1], "title": {"text": f"{title} {metric_jp}"}}],
+        })
+        if i == 0:
+            initial = dict(z=latest, **style)
+
+    fig = go.Figure(
+        data=[MAP_TRACE(
+            geojson=geometry["geojson"], locations=locations, featureidkey="id", text=municipalities,
+            marker_line_width=0.5, marker_line_color="white", **colors.get(value, dict(colorscale="Blues", reversescale=False)),
+            **initial,
+        )],
+        frames=frames,
+    )
+    fig.update_layout(**{
+        MAP_SUBPLOT: dict(style="white-bg", center=geometry["center"], zoom=geometry["zoom"]),
+        "title": {"text": f"{title} {layers[0][0]}"},
+        "sliders": sliders[0],
+        "updatemenus": [{"type": "buttons", "direction": "right", "x": 0, "xanchor": "left", "y": 1.08, "yanchor": "bottom",
+                         "showactive": True, "buttons": buttons}] if len(buttons) > 1 else [],
+        "height": 650,
+        "margin": dict(l=10, r=10, t=100, b=10),
+    })
+    return fig
+
+
+@timed()
+def create_trajectory_overlay(pivot, normalized, city, neighbours, title, metric_jp):
+    """
+    基準の市町村と似ている市町村の推移を重ねた折れ線（縦軸は z スコア、ホバーに実数）。
+    基準の市町村は黒の太線、似ている市町村は近い順に色を付ける。
+    """
+    colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b',
+              '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+    unit = get_unit(metric_jp)
+    values = pivot.to_numpy(dtype=float)
+    finite = values[np.isfinite(values)]
+    value_format = "," if np.array_equal(finite, np.round(finite)) else f",.{DERIVED_DECIMALS}f"
+    fig = go.Figure()
+    for i, item in enumerate([city] + list(neighbours.index)):
+        color = "#000000" if i == 0 else colors[(i - 1) % len(colors)]
+        label = item if i == 0 else f"{item}（距離 {neighbours[item]:.3f}）"
+        fig.add_trace(go.Scatter(
+            x=normalized.index,
+            y=normalized[item],
+            mode="lines+markers",
+            name=label,
+            customdata=pivot[item],
+            hovertemplate=f"<b>{item}</b><br>%{{x}}年: %{{customdata:{value_format}}}{unit}<br>zスコア: %{{y:.2f}}<extra></extra>",
+            line=dict(width=4 if i == 0 else 2, color=color),
+            marker=dict(size=8 if i == 0 else 6, color=color),
+        ))
+    fig.update_layout(
+        title=title,
+        hovermode="x unified",
+        height=450,
+        xaxis_title="年",
+        yaxis_title="zスコア（市町村ごとに正規化）",
+        xaxis=dict(tickmode="linear", dtick=1),
+        legend=dict(orientation="h", yanchor="top", y=-0.15, xanchor="left", x=0),
+    )
+    return fig
 
-    # 3. 全41市町村での増減数・増減率を計算
-    common_cities_all = start_data_all.index.intersection(end_data_all.index)
-    increases_all = end_data_all.reindex(common_cities_all) - start_data_all.reindex(common_cities_all)
-    rates_all = (increases_all / start_data_all.reindex(common_cities_all).replace(0, pd.NA) * 100).fillna(0)
 
-    # 4. 全41市町村での順位を計算
-    increase_ranks = increases_all.rank(method='min', ascending=False).astype(int)
-    rate_ranks = rates_all.rank(method='min', ascending=False).astype(int)
-    total_municipalities_in_rank = len(increases_all) # データが存在する市町村の総数
+def descending_ranks(values):
+    """
+    2次元配列の行ごとの降順の順位（1始まり）。
+    同値の並びは行ごとに Series.sort_values(ascending=False) で並べて順番に振った場合と同じになる。
+    """
+    n_cols = values.shape[1]
+    order = (n_cols - 1 - values[:, ::-1].argsort(axis=1, kind="quicksort"))[:, ::-1]
+    ranks = np.empty(values.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(1, n_cols + 1), values.shape), axis=1)
+    return ranks
 
-    # 5. 表示対象の市町村リストを決定
-    if location_type == "市町村":
-        cities_to_display = locations
-        scope_text = "選択市町村"
-    elif location_type == "エリア":
-        cities_to_display = [city for area in locations for city in REGION_MAP.get(area, [])]
-        scope_text = f"{'・'.join(locations)}エリア"
-    else: # 全体
-        cities_to_display = increases_all.sort_values(ascending=False).head(ranking_count).index.tolist() if show_ranking else common_cities_all.tolist()
-        scope_text = "全市町村"
 
-    # 6. 結果を生成
-    period_text = f"{start_year}年〜{end_year}年"
-    result = f"## {period_text} {metric_jp}変化分析（{scope_text}）\n\n"
-    
-    if show_ranking and location_type == "全体":
-        result += f"### 📈 期間増減数 上位{len(cities_to_display)}市町村\n"
-
-    for city in sorted(cities_to_display, key=lambda c: increases_all.get(c, -float('inf')), reverse=True):
-        if city in common_cities_all:
-            increase = increases_all.get(city, 0)
-            rate = rates_all.get(city, 0)
-            start_val = start_data_all.get(city, 0)
-            end_val = end_data_all.get(city, 0)
-            inc_rank = increase_ranks.get(city, '-')
-            rate_rank = rate_ranks.get(city, '-')
-            
-            result += f"**{city}**\n"
-            result += f"- **期間増減数**: {increase:+,}{get_unit(metric_jp)} （全体 {inc_rank}位 / {total_municipalities_in_rank}市町村）\n"
-            result += f"- **期間増減率**: {rate:+.1f}% （全体 {rate_rank}位 / {total_municipalities_in_rank}市町村）\n"
-            result += f"- {end_year}年: {end_val:,}{get_unit(metric_jp)}\n"
-            result += f"- {start_year}年: {start_val:,}{get_unit(metric_jp)}\n\n"
-        elif city in locations: # 選択されているがデータがない場合のみメッセージを表示
-            result += f"**{city}**: {start_year}年または{end_year}年のデータがなく、計算できませんでした。\n\n"
-
-    return result
+def build_prefecture_pivot(pref_df):
+    """県全体データ（load_transition_total）を year × 指標（日本語名）の表にする"""
+    return (
+        pref_df.pivot_table(index="year", columns="metric", values="value", aggfunc="sum")
+                .sort_index()
+                .rename(columns={"facilities": "軒数", "rooms": "客室数", "capacity": "収容人数"})
+    )
 
-def handle_trend_analysis(df, metric_en, metric_jp, location_type, locations, start_year, end_year):
-    """期間推移分析の処理"""
-    if location_type == "市町村":
-        result = f"## {start_year}年〜{end_year}年 {metric_jp}推移\n\n"
-        
-        for city in locations:
-            data = df.query(f"city == @city & metric == @metric_en & cat1 == 'total' & year >= @start_year & year <= @end_year")
-            data = data.sort_values('year')
-            
-            if not data.empty:
-                result += f"### {city}\n\n"
-                
-                # 年別データ表示
-                for _, row in data.iterrows():
-                    result += f"- {row['year']}年: {row['value']:,}{get_unit(metric_jp)}\n"
-                
-                # 期間全体の変化
-                if len(data) >= 2:
-                    first_value = data.iloc[0]['value']
-                    last_value = data.iloc[-1]['value']
-                    total_change = last_value - first_value
-                    if first_value > 0:
-                        total_growth = (total_change / first_value) * 100
-                        result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)} ({total_growth:+.1f}%)\n\n"
-                    else:
-                        result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)}\n\n"
-            else:
-                result += f"### {city}\n\nデータが見つかりません。\n\n"
-        
-        return result
-    
-    elif location_type == "エリア":
-        result = f"## {start_year}年〜{end_year}年 エリア別{metric_jp}推移\n\n"
-        
-        for area in locations:
-            area_cities = REGION_MAP.get(area, [])
-            
-            result += f"### {area}エリア\n\n"
-            
-            # 年別エリア合計を計算
-            years = range(start_year, end_year + 1)
-            area_totals = []
-            
-            for year in years:
-                year_data = df.query(f"city in @area_cities & metric == @metric_en & cat1 == 'total' & year == @year")
-                total_value = year_data['value'].sum()
-                area_totals.append((year, total_value))
-                result += f"- {year}年: {total_value:,}{get_unit(metric_jp)}\n"
-            
-            # 期間全体の変化
-            if len(area_totals) >= 2:
-                first_value = area_totals[0][1]
-                last_value = area_totals[-1][1]
-                total_change = last_value - first_value
-                if first_value > 0:
-                    total_growth = (total_change / first_value) * 100
-                    result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)} ({total_growth:+.1f}%)\n\n"
-                else:
-                    result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)}\n\n"
-        
-        return result
-    
-    else:  # 全体
-        result = f"## {start_year}年〜{end_year}年 沖縄県全体{metric_jp}推移\n\n"
-        
-        years = range(start_year, end_year + 1)
-        totals = []
-        
-        for year in years:
-            year_data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @year")
-            total_value = year_data['value'].sum()
-            totals.append((year, total_value))
-            result += f"- {year}年: {total_value:,}{get_unit(metric_jp)}\n"
-        
-        # 期間全体の変化
-        if len(totals) >= 2:
-            first_value = totals[0][1]
-            last_value = totals[-1][1]
-            total_change = last_value - first_value
-            if first_value > 0:
-                total_growth = (total_change / first_value) * 100
-                result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)} ({total_growth:+.1f}%)\n"
-            else:
-                result += f"\n**期間全体の変化:** {total_change:+,}{get_unit(metric_jp)}\n"
-        
-        return result
 
-def handle_comparison(df, metric_en, metric_jp, location_type, locations, comparison_year):
-    """比較分析の処理"""
-    if location_type == "市町村":
-        data = df.query(f"city in @locations & metric == @metric_en & cat1 == 'total' & year == @comparison_year")
-        data = data.sort_values('value', ascending=False)
-        
-        result = f"## {comparison_year}年 {metric_jp}比較\n\n"
-        
-        for i, (_, row) in enumerate(data.iterrows(), 1):
-            result += f"**{i}位: {row['city']}** - {row['value']:,}{get_unit(metric_jp)}\n"
-        
-        # 差異分析
-        if len(data) >= 2:
-            max_value = data.iloc[0]['value']
-            min_value = data.iloc[-1]['value']
-            diff = max_value - min_value
-            
-            result += f"\n**最大差:** {diff:,}{get_unit(metric_jp)}\n"
-            result += f"（{data.iloc[0]['city']} vs {data.iloc[-1]['city']}）\n"
-        
-        return result
-    
-    elif location_type == "エリア":
-        result = f"## {comparison_year}年 エリア別{metric_jp}比較\n\n"
-        
-        area_data = []
-        for area in locations:
-            area_cities = REGION_MAP.get(area, [])
-            area_total = df.query(f"city in @area_cities & metric == @metric_en & cat1 == 'total' & year == @comparison_year")['value'].sum()
-            area_data.append((area, area_total))
-        
-        # エリアを値でソート
-        area_data.sort(key=lambda x: x[1], reverse=True)
-        
-        for i, (area, total) in enumerate(area_data, 1):
-            result += f"**{i}位: {area}エリア** - {total:,}{get_unit(metric_jp)}\n"
-        
-        # エリア構成詳細
-        result += "\n### エリア構成詳細\n\n"
-        for area, total in area_data:
-            area_cities = REGION_MAP.get(area, [])
-            city_data = df.query(f"city in @area_cities & metric == @metric_en & cat1 == 'total' & year == @comparison_year")
-            city_ranking = city_data.sort_values('value', ascending=False).head(3)
-            
-            result += f"**{area}エリア** (合計: {total:,}{get_unit(metric_jp)})\n"
-            for _, row in city_ranking.iterrows():
-                result += f"　- {row['city']}: {row['value']:,}{get_unit(metric_jp)}\n"
-            result += "\n"
-        
-        return result
-    
-    else:  # 全体の場合は意味がないので、トップ10を表示
-        data = df.query(f"metric == @metric_en & cat1 == 'total' & year == @comparison_year")
-        ranking = data.sort_values('value', ascending=False).head(10)
-        
-        result = f"## {comparison_year}年 沖縄県全体{metric_jp}トップ10\n\n"
-        
-        for i, (_, row) in enumerate(ranking.iterrows(), 1):
-            result += f"**{i}位: {row['city']}** - {row['value']:,}{get_unit(metric_jp)}\n"
-        
-        # 全体統計
-        total_value = data['value'].sum()
-        avg_value = data['value'].mean()
-        
-        result += f"\n**県全体合計:** {total_value:,}{get_unit(metric_jp)}\n"
-        result += f"**市町村平均:** {avg_value:,.1f}{get_unit(metric_jp)}\n"
-        
-        return result
+@timed()
+def create_prefecture_chart(pref_pivot):
+    """県全体の推移グラフ（客室数・収容人数の棒 + 軒数の折れ線）"""
+    fig_pref = make_subplots(specs=[[{"secondary_y": True}]])
+    fig_pref.add_bar(
+        x=pref_pivot.index,
+        y=pref_pivot["客室数"],
+        name="客室数（室）",
+        marker_color="lightblue",
+        opacity=0.8,
+        hovertemplate="客室数 %{y:,} 室<extra></extra>",
+    )
+    fig_pref.add_bar(
+        x=pref_pivot.index,
+        y=pref_pivot["収容人数"],
+        name="収容人数（人）",
+        marker_color="cornflowerblue",
+        opacity=0.8,
+        hovertemplate="収容人数 %{y:,} 人<extra></extra>",
+    )
+    fig_pref.add_scatter(
+        x=pref_pivot.index,
+        y=pref_pivot["軒数"],
+        mode="lines+markers",
+        name="軒数（軒）",
+        line=dict(color="darkblue", width=3),
+        marker=dict(size=8),
+        hovertemplate="軒数 %{y:,} 軒<extra></extra>",
+        secondary_y=True,
+    )
+    fig_pref.update_layout(
+        title="沖縄県宿泊施設推移状況 (S47→R6, total)",
+        xaxis_title="年",
+        yaxis_title="客室数・収容人数",
+        yaxis2_title="軒数（軒）",
+        hovermode="x unified",
+        legend=dict(orientation="h", y=1.02, x=0.5, xanchor="center"),
+        height=550,
+        margin=dict(l=60, r=30, t=80, b=50),
+    )
+    return fig_pref
 
-def get_unit(metric_jp):
-    """指標に応じた単位を返す"""
-    units = {
-        "軒数": "軒",
-        "施設数": "軒", 
-        "客室数": "室",
-        "部屋数": "室",
-        "収容人数": "人",
-        "定員": "人"
-    }
-    return units.get(metric_jp, "")
 
-# ---------------- ヘルパー関数 ----------------
+@timed()
 def create_line_chart(df, target_list, title, y_label="軒数", show_legend=False, df_all=None, show_ranking=True):
     """共通のライングラフ作成関数"""
     # 41市町村のみの順位計算
@@ -3010,21 +5761,11 @@ def create_line_chart(df, target_list, title, y_label="軒数", show_legend=Fals
         exclude_list = ['沖縄県', '南部', '中部', '北部', '宮古', '八重山', '離島']
         municipalities_only = [col for col in df_all.columns if col not in exclude_list]
         
-        for year in df.index:
-            if year in df_all.index:
-                # その年の市町村のみの値を取得
-                year_data = df_all.loc[year, municipalities_only]
-                year_data_clean = year_data.fillna(0)
-                
-                # 値で降順ソート
-                sorted_data = year_data_clean.sort_values(ascending=False)
-                
-                # 順位を計算
-                rankings = {}
-                for rank, (city, value) in enumerate(sorted_data.items(), 1):
-                    rankings[city] = rank
-                
-                all_rankings[year] = rankings
+        # 表示する年の市町村の値から、年ごとの順位をまとめて計算
+        years = [year for year in df.index if year in df_all.index]
+        if years:
+            ranks = descending_ranks(df_all.loc[years, municipalities_only].fillna(0).to_numpy())
+            all_rankings = {year: dict(zip(municipalities_only, row)) for year, row in zip(years, ranks.tolist())}
     
     # 最終年の値で降順ソート（初期表示順序）
     if len(df) > 0 and len(df.columns) > 0:
@@ -3090,24 +5831,208 @@ def create_line_chart(df, target_list, title, y_label="軒数", show_legend=Fals
         margin=dict(l=60, r=30, t=60, b=40)
     )
     
-    return fig
+    return track_memory(f"図: {title}", fig, kind="図")
+
+# ---------------- ウォームアップ ----------------
+# デプロイ直後の最初の利用者が読み込み・集計・図の初回作成の待ち時間を負わないよう、
+# データの読み込みと各タブの既定表示で使う派生データ・図をあらかじめ作っておく。
+# ・サーバー: python -m tools.serve で起動すると、ポートを開く前にバックグラウンドでウォームアップを始める
+#             （streamlit run app.py で起動した場合は、環境変数 OKINAWA_WARMUP=1 で最初のスクリプト実行時に行う）
+# ・CLI     : python -m tools.warmup（処理時間の表示・ヘルスチェック用の --check）
+# サーバーのプロセスで完了した場合だけ、準備状況を OKINAWA_READY_FILE（または ready_file）に JSON で書き出す
+# （source・pid を記録し、--check は別のプロセスが書いたファイルや終了したサーバーのファイルを準備完了と見なさない）。
+WARMUP_HOTEL_CITIES = ["宮古島市"]  # タブ4の市町村選択の既定値
+
+
+@st.cache_resource
+def _warmup_state():
+    """ウォームアップの準備状況（プロセスで共有）と、同時に2回実行しないためのロック"""
+    return {"ready": False, "version": None, "signature": None, "stages": [], "total_ms": None, "error": None}, threading.Lock()
+
+
+def warmup_status():
+    """ウォームアップの準備状況の写し（ready, version, stages[段階, 時間(ms)], total_ms, error など）"""
+    state, _ = _warmup_state()
+    return dict(state, stages=list(state["stages"]))
+
+
+def write_ready_file(path, status):
+    """サーバーの準備状況を JSON で書き出す（途中の状態が読まれないよう一時ファイルから置き換える）"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    status = dict(status, data_dir=str(DATA_DIR), source="server", pid=os.getpid())
+    tmp.write_text(json.dumps(status, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def warm_up(ready_file=None, source="server"):
+    """
+    データを読み込み、各タブの既定表示で使う派生データと図を作る。
+    作るもの: 読み込み済みデータ（県全体データ・データセット）/ 期間増減マトリクス（分析用テーブル×指標）/
+              市町村別・エリア別の全期間ピボット（タブ2〜5のテーブル×指標×カテゴリ）/ 既定表示の図
+    source: "server"（アプリを配信するプロセス）/ "cli"（tools.warmup。準備状況ファイルは書かない）
+    戻り値: warmup_status()
+    """
+    state, lock = _warmup_state()
+    with lock:
+        return _run_warm_up(state, ready_file if source == "server" else None, source)
+
+
+def start_warm_up(ready_file=None):
+    """サーバーの起動時にウォームアップをバックグラウンドのスレッドで始める（tools.serve から呼ぶ）。戻り値: スレッド"""
+    # 以前のサーバーの準備状況ファイルが残っていれば、完了するまでヘルスチェックが通らないよう消しておく
+    path = ready_file or os.environ.get("OKINAWA_READY_FILE")
+    if path:
+        Path(path).unlink(missing_ok=True)
+    thread = threading.Thread(target=warm_up, args=(ready_file,), name="okinawa-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def default_year_range(catalog):
+    """期間スライダーの既定値（データのある最初の年〜最後の年）"""
+    years = available_years(catalog)
+    return (years[0], years[-1]) if years else (2007, 2024)
+
+
+def warm_up_stages(loaded):
+    """読み込み済みデータ loaded について、派生データ・図を作る段階の一覧 [(段階名, 関数)]"""
+    pref_df, dataset = loaded["prefecture"], loaded["dataset"]
+    tables = dataset["tables"]
+    areas = list(REGION_MAP.keys())
+    year_range = default_year_range(dataset["catalog"])  # タブ2・3・5の期間スライダーの既定値
+
+    def period_matrices():
+        for metric in METRICS:
+            period_matrix(dataset, metric)
+
+    def city_pivots():
+        for table in ["accommodation_type", "scale_class", "hotel_breakdown"]:
+            frame = tables.get(table)
+            if frame is None:
+                continue
+            for metric in METRICS:
+                for cat1 in dataset["catalog"]["cat1"].get((table, metric), ()):
+                    build_city_pivot(frame, metric, cat1, year_range, dataset=dataset)
+
+    def area_pivots():
+        for table in ["accommodation_type", "scale_class", "hotel_breakdown"]:
+            frame = tables.get(table)
+            if frame is None:
+                continue
+            for metric in METRICS:
+                for cat1 in dataset["catalog"]["cat1"].get((table, metric), ()):
+                    build_area_pivot(frame, metric, cat1, year_range, areas, dataset=dataset)
+
+    def default_figures():
+        # 県全体の推移・ランキングタブのヒートマップ・タブ4（宮古島市）・タブ5（全エリア）の軒数
+        if not pref_df.empty:
+            create_prefecture_chart(build_prefecture_pivot(pref_df))
+        matrix = period_matrix(dataset, "facilities")
+        if len(matrix["years"]) >= 2:
+            create_period_change_heatmap(matrix, matrix["years"][0], matrix["years"][-1], "軒数")
+        if "hotel_breakdown" in tables:
+            hotel_years = available_years(dataset["catalog"], "hotel_breakdown")
+            hotel_range = (hotel_years[0], hotel_years[-1]) if hotel_years else year_range
+            frame = tables["hotel_breakdown"]
+            pivot = build_city_pivot(frame, "facilities", "total", hotel_range, cities=WARMUP_HOTEL_CITIES, dataset=dataset)
+            pivot_all = build_city_pivot(frame, "facilities", "total", hotel_range, dataset=dataset)
+            create_line_chart(pivot, WARMUP_HOTEL_CITIES, "warmup", "軒数", df_all=pivot_all, show_ranking=True)
+        analysis = tables.get("accommodation_type")
+        if analysis is not None:
+            pivot = build_area_pivot(analysis, "facilities", "total", year_range, areas, dataset=dataset)
+            create_line_chart(pivot, areas, "warmup", "軒数", show_legend=True, df_all=None, show_ranking=False)
+
+    return [
+        ("期間増減マトリクス", period_matrices),
+        ("市町村別ピボット", city_pivots),
+        ("エリア別ピボット", area_pivots),
+        ("既定表示の図", default_figures),
+    ]
+
+
+def _run_warm_up(state, ready_file, source="server"):
+    state.update(ready=False, error=None, stages=[], total_ms=None)
+    started = time.perf_counter()
+
+    def stage(name, fn):
+        t0 = time.perf_counter()
+        with timed_stage(f"warmup/{name}"):
+            result = fn()
+        state["stages"].append({"段階": name, "時間(ms)": round((time.perf_counter() - t0) * 1000, 1)})
+        return result
+
+    try:
+        loaded = stage("データ読み込み", _loaded_data)
+        dataset = loaded["dataset"]
+        if dataset is None:
+            raise RuntimeError("データファイルが見つかりません")
+        for name, build in warm_up_stages(loaded):
+            stage(name, build)
+        state.update(ready=True, version=dataset["version"], signature=loaded["signature"])
+    except Exception as e:
+        state["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        state["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    status = warmup_status()
+    TIMING_LOG.info(json.dumps({"event": "warmup", "source": source,
+                                **{k: status[k] for k in ("ready", "version", "total_ms", "error")}}, ensure_ascii=False))
+    ready_file = ready_file or (os.environ.get("OKINAWA_READY_FILE") if source == "server" else None)
+    if ready_file:
+        write_ready_file(ready_file, status)
+    return status
+
+
+def ensure_warm():
+    """OKINAWA_WARMUP が設定されていて、現在の版のデータでまだウォームアップしていなければ実行する"""
+    if not os.environ.get("OKINAWA_WARMUP"):
+        return
+    state, lock = _warmup_state()
+    with lock:
+        current = _loaded_store()[0]["current"]
+        if not (state["ready"] and current is not None and state["signature"] == current["signature"]):
+            _run_warm_up(state, None)
+
+
+def run_page():
+    """1回のスクリプト実行（streamlit run app.py、または tools.serve から呼ぶ）"""
+    start_timing_run()
+    start_memory_run()
+    ensure_warm()
+    main()
+    timing_run = finish_timing_run()
+    if st.session_state.get("timing_mode", False):
+        render_timing_panel(timing_run)
+    if st.session_state.get("memory_mode", False):
+        render_memory_panel(memory_report(session_state=st.session_state))
+    if st.session_state.get("consistency_mode", False):
+        render_data_check_panel(get_loaded_data())
+
 
 # ---------------- メイン関数 ----------------
 def main():
     st.title("沖縄県宿泊施設データ可視化アプリ")
 
+    # 開発者向け表示（デバッグ出力・処理時間パネル）
+    with st.sidebar.expander("🛠️ 開発者向け", expanded=False):
+        st.checkbox("デバッグ情報を表示", key="debug_mode")
+        st.checkbox("処理時間パネルを表示", key="timing_mode")
+        st.checkbox("メモリ使用量パネルを表示", key="memory_mode")
+        st.checkbox("データ検査パネルを表示", key="consistency_mode")
+
     # ===== 県全体 =====
     st.header("📈 沖縄県全体の状況")
-    pref_df = load_transition_total(TRANSITION_XLSX)
+    loaded = get_loaded_data()  # 実行の途中でデータが差し替わっても、この実行は同じ版で最後まで表示する
+    for problem in loaded.get("problems", ()):
+        (st.error if problem["level"] == "error" else st.warning)(problem["message"])
+    pref_df = track_memory("県全体（Transition.xlsx）", loaded["prefecture"])
     if pref_df.empty:
         st.error("Transition.xlsx を読み込めませんでした")
         return
 
-    pref_pivot = (
-        pref_df.pivot_table(index="year", columns="metric", values="value", aggfunc="sum")
-                .sort_index()
-                .rename(columns={"facilities": "軒数", "rooms": "客室数", "capacity": "収容人数"})
-    )
+    pref_pivot = build_prefecture_pivot(pref_df)
 
     latest_year = pref_pivot.index.max()
     latest = pref_pivot.loc[latest_year]
@@ -3116,73 +6041,36 @@ def main():
     c2.metric(f"総客室数（{latest_year}年）", f"{latest['客室数']:,} 室")
     c3.metric(f"総収容人数（{latest_year}年）", f"{latest['収容人数']:,} 人")
 
-    fig_pref = make_subplots(specs=[[{"secondary_y": True}]])
-    fig_pref.add_bar(
-        x=pref_pivot.index,
-        y=pref_pivot["客室数"],
-        name="客室数（室）",
-        marker_color="lightblue",
-        opacity=0.8,
-        hovertemplate="客室数 %{y:,} 室<extra></extra>",
-    )
-    fig_pref.add_bar(
-        x=pref_pivot.index,
-        y=pref_pivot["収容人数"],
-        name="収容人数（人）",
-        marker_color="cornflowerblue",
-        opacity=0.8,
-        hovertemplate="収容人数 %{y:,} 人<extra></extra>",
-    )
-    fig_pref.add_scatter(
-        x=pref_pivot.index,
-        y=pref_pivot["軒数"],
-        mode="lines+markers",
-        name="軒数（軒）",
-        line=dict(color="darkblue", width=3),
-        marker=dict(size=8),
-        hovertemplate="軒数 %{y:,} 軒<extra></extra>",
-        secondary_y=True,
-    )
-    fig_pref.update_layout(
-        title="沖縄県宿泊施設推移状況 (S47→R6, total)",
-        xaxis_title="年",
-        yaxis_title="客室数・収容人数",
-        yaxis2_title="軒数（軒）",
-        hovermode="x unified",
-        legend=dict(orientation="h", y=1.02, x=0.5, xanchor="center"),
-        height=550,
-        margin=dict(l=60, r=30, t=80, b=50),
-    )
+    fig_pref = create_prefecture_chart(pref_pivot)
     st.plotly_chart(fig_pref, use_container_width=True)
 
-    # ===== データ読み込み =====
-    df_long = load_all_data()
-    if df_long.empty:
+    # ===== データ読み込み（プロセスで共有する読み込み済みデータ） =====
+    dataset = loaded["dataset"]
+    if dataset is None:
         st.warning("データファイルが見つかりません")
         return
 
-    df_long = df_long.assign(
-        city=lambda d: d["city"].str.strip(),
-        cat1=lambda d: d["cat1"].fillna("").str.lower().str.strip(),
-        metric=lambda d: d["metric"].str.lower().str.strip(),
-        value=lambda d: pd.to_numeric(d["value"], errors="coerce").fillna(0).astype(int)
-    )
-    df_long = df_long.query("metric in ['facilities','rooms','capacity']")
+    df_long = track_memory("df_long", dataset["long"])
+    tables = dataset["tables"]
+    catalog = dataset["catalog"]
+    for table, frame in tables.items():
+        track_memory(f"テーブル: {table}", frame, base=df_long)
 
     # 市町村リスト（市町村コード順）
     all_municipalities = sorted(CITY_CODE.keys(), key=CITY_CODE.get)
     
     # 年度範囲の設定
-    max_y = int(df_long["year"].max()) if not df_long.empty else 2024
-    min_y = int(df_long["year"].min()) if not df_long.empty else 2007
+    min_y, max_y = default_year_range(catalog)
+    year_options = available_years(catalog)
+    year_options_desc = available_years(catalog, descending=True)
     
     st.markdown("---")
 
     # 指標マッピング
-    elem_map = {"軒数":"facilities","客室数":"rooms","収容人数":"capacity"}
+    elem_map = METRIC_OPTIONS
 
     # ===== タブで分離 =====
-    tab1, tab2, tab3, tab4, tab5, tab_help = st.tabs(["🤖 ランキング分析", "🏘️ 市町村別分析", "🏨 ホテル・旅館特化　規模別分析", "🏛️ ホテル・旅館特化　宿泊形態別分析", "🗺️ エリア別分析", "📖 ヘルプ"])
+    tab1, tab2, tab3, tab4, tab5, tab_sql, tab_help = st.tabs(["🤖 ランキング分析", "🏘️ 市町村別分析", "🏨 ホテル・旅館特化　規模別分析", "🏛️ ホテル・旅館特化　宿泊形態別分析", "🗺️ エリア別分析", "🧮 SQL", "📖 ヘルプ"])
 
     # 宿泊形態の日本語表示マッピング
     accommodation_type_mapping = {
@@ -3205,7 +6093,7 @@ def main():
     # =================================================
     # TAB 1: ランキング分析（自然言語質問機能）
     # =================================================
-    with tab1:
+    with tab1, timed_stage("tab1"):
         # 新しいヘッダー部分 ↓
         col_header1, col_header2 = st.columns([5, 1])
         with col_header1:
@@ -3245,14 +6133,14 @@ def main():
             if question_type == "基本情報取得":
                 selected_metrics = st.multiselect(
                     "📈 指標（複数選択可）",
-                    ["軒数", "客室数", "収容人数"],
+                    QUESTION_METRICS,
                     default=["軒数", "客室数", "収容人数"], # デフォルトで全て選択
                     key="selected_metrics"
                 )
             else:
                 selected_metric = st.selectbox(
                     "📈 指標",
-                    ["軒数", "客室数", "収容人数"],
+                    QUESTION_METRICS,
                     key="selected_metric"
                 )
 
@@ -3285,7 +6173,7 @@ def main():
             st.subheader("📋 基本情報設定")
             target_year = st.selectbox(
                 "対象年度",
-                sorted(df_long['year'].unique(), reverse=True),
+                year_options_desc,
                 key="basic_year"
             )
             
@@ -3302,7 +6190,7 @@ def main():
             with col2:
                 ranking_year = st.selectbox(
                     "対象年度",
-                    sorted(df_long['year'].unique(), reverse=True),
+                    year_options_desc,
                     key="ranking_year"
                 )
 
@@ -3326,7 +6214,7 @@ def main():
                 if change_analysis_type == "対前年比較":
                     target_year_ranking = st.selectbox(
                         "対象年度",
-                        sorted(df_long['year'].unique(), reverse=True),
+                        year_options_desc,
                         key="target_year_ranking"
                     )
                 else:
@@ -3340,13 +6228,13 @@ def main():
                         with col_start:
                             custom_start_ranking = st.selectbox(
                                 "開始年",
-                                sorted(df_long['year'].unique()),
+                                year_options,
                                 key="custom_start_ranking"
                             )
                         with col_end:
                             custom_end_ranking = st.selectbox(
                                 "終了年",
-                                sorted(df_long['year'].unique(), reverse=True),
+                                year_options_desc,
                                 key="custom_end_ranking"
                             )
             
@@ -3369,7 +6257,7 @@ def main():
                 if analysis_type == "対前年比較":
                     target_year_change = st.selectbox(
                         "対象年度",
-                        sorted(df_long['year'].unique(), reverse=True),
+                        year_options_desc,
                         key="target_year_change"
                     )
                 else:
@@ -3383,13 +6271,13 @@ def main():
                         with col_start:
                             custom_start = st.selectbox(
                                 "開始年",
-                                sorted(df_long['year'].unique()),
+                                year_options,
                                 key="custom_start"
                             )
                         with col_end:
                             custom_end = st.selectbox(
                                 "終了年",
-                                sorted(df_long['year'].unique(), reverse=True),
+                                year_options_desc,
                                 key="custom_end"
                             )
             
@@ -3422,13 +6310,13 @@ def main():
                     with col_start:
                         trend_start = st.selectbox(
                             "開始年",
-                            sorted(df_long['year'].unique()),
+                            year_options,
                             key="trend_start"
                         )
                     with col_end:
                         trend_end = st.selectbox(
                             "終了年",
-                            sorted(df_long['year'].unique(), reverse=True),
+                            year_options_desc,
                             key="trend_end"
                         )
         
@@ -3436,7 +6324,7 @@ def main():
             st.subheader("🔍 比較設定")
             comparison_year = st.selectbox(
                 "比較年度",
-                sorted(df_long['year'].unique(), reverse=True),
+                year_options_desc,
                 key="comparison_year"
             )
         
@@ -3474,6 +6362,7 @@ def main():
                                 'location_type': location_type,
                                 'locations': selected_locations,
                                 'df': df_long,
+                                'dataset': dataset,
                                 'all_municipalities': all_municipalities,
                                 'debug_mode': st.session_state.get('debug_mode', False),
                                 'target_year': target_year
@@ -3486,6 +6375,7 @@ def main():
                                 'location_type': location_type,
                                 'locations': selected_locations,
                                 'df': df_long,
+                                'dataset': dataset,
                                 'all_municipalities': all_municipalities,
                                 'debug_mode': st.session_state.get('debug_mode', False)
                             }
@@ -3550,12 +6440,7 @@ def main():
                         answer = process_structured_question(**params)
                         
                         st.markdown("### 📊 分析結果")
-                        if isinstance(answer, go.Figure):
-                            st.plotly_chart(answer, use_container_width=True)
-                        elif isinstance(answer, str):
-                            st.markdown(answer)
-                        else:
-                            st.write(answer)
+                        render_answer(answer, key="answer")
 
                     except Exception as e:
                         st.error(f"分析処理中にエラーが発生しました: {e}")
@@ -3578,10 +6463,37 @@ def main():
             )
             st.write(f"**生成される質問:** {preview_text}")
 
+        # 期間増減ヒートマップ（期間増減マトリクスの切り出しのみで描画）
+        with st.expander("🗓️ 期間増減ヒートマップ"):
+            hm_col1, hm_col2 = st.columns(2)
+            with hm_col1:
+                hm_metric = st.selectbox("指標", list(elem_map.keys()), key="period_heatmap_metric")
+            with hm_col2:
+                hm_value = st.radio("表示", ["増減率", "増減数"], horizontal=True, key="period_heatmap_value")
+            hm_matrix = period_matrix(dataset, elem_map[hm_metric])
+            if len(hm_matrix["years"]) >= 2:
+                hm_start, hm_end = st.slider(
+                    "期間（開始年を基準に各年の増減を表示）",
+                    min_value=hm_matrix["years"][0],
+                    max_value=hm_matrix["years"][-1],
+                    value=(hm_matrix["years"][0], hm_matrix["years"][-1]),
+                    key="period_heatmap_years",
+                )
+                st.plotly_chart(
+                    create_period_change_heatmap(hm_matrix, hm_start, hm_end, hm_metric, hm_value),
+                    use_container_width=True,
+                )
+            else:
+                st.info("比較できる年度がありません。")
+
+        # 一括質問（複数の質問を並行に処理し、終わった順に表示）
+        with st.expander("📋 一括質問"):
+            render_batch_questions(dataset, year_options_desc, all_municipalities)
+
     # =================================================
     # TAB 2: 市町村別分析（accommodation_typeのみ）
     # =================================================
-    with tab2:
+    with tab2, timed_stage("tab2"):
         col_header1, col_header2 = st.columns([5, 1])
         with col_header1:
             st.header("🏘️ 市町村別の状況")
@@ -3592,15 +6504,18 @@ def main():
                 
                 ✅ **宿泊形態別**: ホテル・民宿・ペンション等の詳細分析  
                 ✅ **複数市町村比較**: 同時に比較可能  
-                ✅ **順位表示**: 全市町村中の順位を確認
+                ✅ **順位表示**: 全市町村中の順位を確認  
+                ✅ **ヒートマップ**: 全41市町村の推移（値・対前年増減率・順位）を1枚で確認
+                ✅ **マップ**: 地図上で年・指標を切り替え（境界データが必要）
+                ✅ **似ている市町村**: 推移の形が近い市町村を検索して重ねて表示
                 """)
         
         # accommodation_type（宿泊形態別）データをフィルタ
-        df_accommodation = df_long.query("table == 'accommodation_type'")
+        df_accommodation = table_frame(tables, "accommodation_type", df_long)
         
         if df_accommodation.empty:
             st.warning("accommodation_typeのデータが見つかりません")
-            possible_tables = df_long['table'].unique()
+            possible_tables = list(dataset["table_rows"])
             st.write(f"利用可能なテーブル: {possible_tables}")
         else:
             # 市町村選択
@@ -3612,7 +6527,7 @@ def main():
             )
             
             # 宿泊形態別カテゴリの取得
-            accommodation_categories = sorted([cat for cat in df_accommodation['cat1'].unique() if cat and cat != 'total'])
+            accommodation_categories = available_categories(catalog, "accommodation_type")
             
             # 英語キーを日本語表示に変換
             accommodation_categories_jp = []
@@ -3651,7 +6566,7 @@ def main():
             
             # 年度
             year_range_city = st.slider(
-                "期間", min_y, max_y, (2007, 2024), step=1, key="year_city"
+                "期間", min_y, max_y, (min_y, max_y), step=1, key="year_city"
             )
 
             if sel_cities:
@@ -3663,25 +6578,10 @@ def main():
                     
                     # 1. Total（全宿泊形態合計）のグラフ
                     st.write(f"**{element} (Total - 全宿泊形態合計)**")
-                    total_df = (
-                        df_accommodation.query(
-                            f"metric==@metric_en & cat1=='total' & city in @sel_cities & "
-                            f"year >= {year_range_city[0]} & year <= {year_range_city[1]}"
-                        )
-                        .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                        .reindex(columns=[city for city in all_municipalities if city in sel_cities])
-                        .sort_index()
-                    )
+                    total_df = build_city_pivot(df_accommodation, metric_en, "total", year_range_city, cities=sel_cities, dataset=dataset)
 
                     # 41市町村全体データを取得
-                    df_all_cities = (
-                        df_accommodation.query(
-                            f"metric==@metric_en & cat1=='total' & "
-                            f"year >= {year_range_city[0]} & year <= {year_range_city[1]}"
-                        )
-                        .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                        .sort_index()
-                    )
+                    df_all_cities = build_city_pivot(df_accommodation, metric_en, "total", year_range_city, dataset=dataset)
 
                     fig_total = create_line_chart(
                         total_df, [city for city in all_municipalities if city in sel_cities],
@@ -3695,8 +6595,8 @@ def main():
 
                     # Total のデータテーブル
                     sorted_cities = [city for city in all_municipalities if city in total_df.columns]
-                    st.dataframe(
-                        total_df[sorted_cities].transpose().style.format(thousands=","),
+                    show_table(
+                        total_df[sorted_cities].transpose(),
                         use_container_width=True
                     )
 
@@ -3707,26 +6607,10 @@ def main():
                             category_display = accommodation_type_mapping.get(category, category)
                             st.write(f"**{element} ({category_display})**")
                             
-                            df_category = (
-                                df_accommodation.query(
-                                    f"metric == @metric_en & cat1 == @category & "
-                                    "city in @sel_cities & "
-                                    f"year >= {year_range_city[0]} & year <= {year_range_city[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .reindex(columns=[city for city in all_municipalities if city in sel_cities])
-                                .sort_index()
-                            )
+                            df_category = build_city_pivot(df_accommodation, metric_en, category, year_range_city, cities=sel_cities, dataset=dataset)
 
                             # 詳細項目別の41市町村全体データを取得
-                            df_all_cities_cat = (
-                                df_accommodation.query(
-                                    f"metric == @metric_en & cat1 == @category & "
-                                    f"year >= {year_range_city[0]} & year <= {year_range_city[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .sort_index()
-                            )
+                            df_all_cities_cat = build_city_pivot(df_accommodation, metric_en, category, year_range_city, dataset=dataset)
 
                             fig_category = create_line_chart(
                                 df_category, [city for city in all_municipalities if city in sel_cities],
@@ -3740,8 +6624,8 @@ def main():
 
                             # データテーブル
                             sorted_cities = [city for city in all_municipalities if city in df_category.columns]
-                            st.dataframe(
-                                df_category[sorted_cities].transpose().style.format(thousands=","),
+                            show_table(
+                                df_category[sorted_cities].transpose(),
                                 use_container_width=True
                             )
                     
@@ -3751,10 +6635,129 @@ def main():
             else:
                 st.info("市町村を選択してください。")
 
+            # 市町村×年ヒートマップ（全41市町村を1本の heatmap トレースで表示。キューブの切り出しのみで描画）
+            with st.expander("🌡️ 市町村×年ヒートマップ（全41市町村）"):
+                table_labels = {"accommodation_type": "宿泊形態別", "scale_class": "規模別", "hotel_breakdown": "ホテル・旅館内訳"}
+                category_labels = {"total": "合計（total）", **accommodation_type_mapping, **scale_class_mapping}
+                hm_tables = [table for table in ANALYSIS_TABLE_PRIORITY if table in dataset["table_rows"]]
+                hm_col1, hm_col2, hm_col3 = st.columns(3)
+                with hm_col1:
+                    hm_table = st.selectbox("テーブル", hm_tables, format_func=lambda t: table_labels.get(t, t), key="city_heatmap_table")
+                    hm_metric_jp = st.selectbox("指標", list(elem_map.keys()), key="city_heatmap_metric")
+                hm_metric = elem_map[hm_metric_jp]
+                # 派生指標のカテゴリは分子の指標と同じ
+                hm_base_metric = DERIVED_METRICS[hm_metric]["numerator"] if hm_metric in DERIVED_METRICS else hm_metric
+                hm_categories = sorted(catalog["cat1"].get((hm_table, hm_base_metric), ()), key=lambda c: c != "total")
+                with hm_col2:
+                    hm_cat1 = st.selectbox("カテゴリ", hm_categories, format_func=lambda c: category_labels.get(c, c), key="city_heatmap_cat1")
+                    hm_value = st.radio("表示", CITY_HEATMAP_VALUES, horizontal=True, key="city_heatmap_value")
+                with hm_col3:
+                    hm_order = st.radio("並び順", CITY_HEATMAP_ORDERS, horizontal=True, key="city_heatmap_order")
+                hm_years = available_years(catalog, hm_table)
+                if hm_cat1 is None or len(hm_years) < 2:
+                    st.info("表示できるデータがありません。")
+                else:
+                    hm_range = st.slider("期間", hm_years[0], hm_years[-1], (hm_years[0], hm_years[-1]), step=1, key="city_heatmap_years")
+                    hm_matrix = city_year_matrix(dataset, hm_table, hm_metric, hm_cat1, hm_range, hm_value)
+                    hm_title = (f"市町村別{hm_metric_jp}{'' if hm_value == '値' else hm_value}"
+                                f"（{table_labels.get(hm_table, hm_table)}・{category_labels.get(hm_cat1, hm_cat1)}） ({hm_range[0]}-{hm_range[1]})")
+                    st.plotly_chart(
+                        create_city_year_heatmap(hm_matrix, hm_title, hm_metric_jp, hm_value, hm_order),
+                        use_container_width=True,
+                    )
+
+            # 市町村マップ（CITY_CODE で境界の GeoJSON と結合。年・指標は図の中で切り替える）
+            with st.expander("🗾 市町村マップ"):
+                map_col1, map_col2 = st.columns(2)
+                with map_col1:
+                    map_table = st.selectbox("テーブル", hm_tables, format_func=lambda t: table_labels.get(t, t), key="city_map_table")
+                    map_categories = sorted(catalog["cat1"].get((map_table, "facilities"), ()), key=lambda c: c != "total")
+                    map_cat1 = st.selectbox("カテゴリ", map_categories, format_func=lambda c: category_labels.get(c, c), key="city_map_cat1")
+                with map_col2:
+                    map_value = st.radio("表示", CITY_HEATMAP_VALUES, horizontal=True, key="city_map_value")
+                map_years = available_years(catalog, map_table)
+                map_layers = []
+                if map_cat1 is not None and map_years:
+                    for metric_jp, metric_en in elem_map.items():
+                        matrix = city_year_matrix(dataset, map_table, metric_en, map_cat1, (map_years[0], map_years[-1]), map_value)
+                        if matrix.notna().to_numpy().any():
+                            map_layers.append((metric_jp, matrix))
+                geometry = municipal_geometry()
+                if not map_layers:
+                    st.info("表示できるデータがありません。")
+                elif geometry is None:
+                    st.info(
+                        f"市町村境界の GeoJSON（{map_geojson_path()}）がないため、地図の代わりに表で表示します。"
+                        "国土数値情報（行政区域 N03）の沖縄県のファイルから `python -m tools.prepare_geojson` で作成して配置してください"
+                        "（環境変数 OKINAWA_GEOJSON で場所を指定することもできます）。"
+                    )
+                    latest_year = map_years[-1]
+                    map_table_frame = pd.DataFrame(
+                        {metric_jp: matrix.loc[latest_year] for metric_jp, matrix in map_layers}
+                    ).rename_axis("市町村")
+                    map_table_frame.insert(0, "市町村コード", [CITY_CODE[city] for city in map_table_frame.index])
+                    st.caption(f"{latest_year}年 {map_value}（市町村コード順）")
+                    show_table(map_table_frame, use_container_width=True)
+                else:
+                    missing = [city for city in all_municipalities if CITY_CODE[city] not in geometry["codes"]]
+                    if missing:
+                        st.caption(f"境界データにない市町村: {'・'.join(missing)}")
+                    map_title = f"{table_labels.get(map_table, map_table)}・{category_labels.get(map_cat1, map_cat1)}"
+                    if map_value != "値":
+                        map_title += f" {map_value}"
+                    st.plotly_chart(create_city_map(geometry, map_layers, map_title, map_value), use_container_width=True)
+
+            # 推移の類似検索（距離行列は版ごとに保持し、選び直しは行列の1行の並べ替えのみ）
+            with st.expander("🔍 推移が似ている市町村"):
+                sim_col1, sim_col2, sim_col3 = st.columns(3)
+                with sim_col1:
+                    sim_city = st.selectbox("基準の市町村", all_municipalities,
+                                            index=all_municipalities.index(sel_cities[0]) if sel_cities else 0, key="city_similar_city")
+                    sim_table = st.selectbox("テーブル", hm_tables, format_func=lambda t: table_labels.get(t, t), key="city_similar_table")
+                with sim_col2:
+                    sim_metric_jp = st.selectbox("指標", list(elem_map.keys()), key="city_similar_metric")
+                    sim_metric = elem_map[sim_metric_jp]
+                    sim_base_metric = DERIVED_METRICS[sim_metric]["numerator"] if sim_metric in DERIVED_METRICS else sim_metric
+                    sim_categories = sorted(catalog["cat1"].get((sim_table, sim_base_metric), ()), key=lambda c: c != "total")
+                    sim_cat1 = st.selectbox("カテゴリ", sim_categories, format_func=lambda c: category_labels.get(c, c), key="city_similar_cat1")
+                with sim_col3:
+                    sim_method = st.radio("比べ方", SIMILARITY_METHODS, horizontal=True, key="city_similar_method",
+                                          help="相関: 増減の形が似ているか / DTW: 数年のずれを許して形を比べる")
+                    sim_k = st.slider("表示する市町村数", 1, 10, 5, key="city_similar_k")
+                sim_years = available_years(catalog, sim_table)
+                if sim_cat1 is None or len(sim_years) < SIMILARITY_MIN_YEARS:
+                    st.info("表示できるデータがありません。")
+                else:
+                    sim_range = st.slider("期間", sim_years[0], sim_years[-1], (sim_years[0], sim_years[-1]), step=1, key="city_similar_years")
+                    sim_pivot, sim_normalized, sim_distances = similarity_matrix(
+                        dataset, table_frame(tables, sim_table, df_long), sim_table, sim_metric, sim_cat1, sim_range, sim_method
+                    )
+                    neighbours = nearest_cities(sim_distances, sim_city, sim_k)
+                    if neighbours.empty:
+                        st.info(f"{sim_city}は比較できるデータが{SIMILARITY_MIN_YEARS}年分以上ないか、値が一定のため比べられません。")
+                    else:
+                        sim_title = (f"{sim_city}と{sim_metric_jp}の推移が似ている市町村"
+                                     f"（{table_labels.get(sim_table, sim_table)}・{category_labels.get(sim_cat1, sim_cat1)}・{sim_method}） "
+                                     f"({sim_range[0]}-{sim_range[1]})")
+                        st.plotly_chart(
+                            create_trajectory_overlay(sim_pivot, sim_normalized, sim_city, neighbours, sim_title, sim_metric_jp),
+                            use_container_width=True,
+                        )
+                        sim_latest = sim_pivot.dropna(how="all").index.max()
+                        sim_frame = pd.DataFrame({
+                            "順位": range(1, len(neighbours) + 1),
+                            "市町村": neighbours.index,
+                            "距離": neighbours.round(3).to_numpy(),
+                        })
+                        if sim_method == "相関":
+                            sim_frame["相関係数"] = (1 - neighbours).round(3).to_numpy()
+                        sim_frame[f"{sim_latest}年の{sim_metric_jp}"] = sim_pivot.loc[sim_latest, neighbours.index].to_numpy()
+                        show_table(sim_frame.set_index("順位"), use_container_width=True)
+
     # =================================================
     # TAB 3: ホテル・旅館特化　規模別分析
     # =================================================
-    with tab3:
+    with tab3, timed_stage("tab3"):
         col_header1, col_header2 = st.columns([5, 1])
         with col_header1:
             st.header("🏨 ホテル・旅館特化　規模別分析の状況")
@@ -3780,15 +6783,15 @@ def main():
             """)
         
         # scale_class（規模別）データをフィルタ
-        df_scale = df_long.query("table == 'scale_class'")
+        df_scale = table_frame(tables, "scale_class", df_long)
         
         if df_scale.empty:
             st.warning("scale_classのデータが見つかりません")
-            possible_tables = df_long['table'].unique()
+            possible_tables = list(dataset["table_rows"])
             st.write(f"利用可能なテーブル: {possible_tables}")
         else:
             # 規模別カテゴリの取得
-            scale_categories = sorted([cat for cat in df_scale['cat1'].unique() if cat and cat != 'total'])
+            scale_categories = available_categories(catalog, "scale_class")
             
             # 英語キーを日本語表示に変換
             scale_categories_jp = []
@@ -3828,7 +6831,7 @@ def main():
             
             # 年度
             year_range_scale = st.slider(
-                "期間", min_y, max_y, (2007, 2024), step=1, key="year_scale"
+                "期間", min_y, max_y, (min_y, max_y), step=1, key="year_scale"
             )
 
             if sel_targets_scale:
@@ -3840,25 +6843,10 @@ def main():
                     
                     # 1. Total（全規模合計）のグラフ
                     st.write(f"**{element} (Total - 全規模合計)**")
-                    total_df = (
-                        df_scale.query(
-                            f"metric==@metric_en & cat1=='total' & city in @sel_targets_scale & "
-                            f"year >= {year_range_scale[0]} & year <= {year_range_scale[1]}"
-                        )
-                        .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                        .reindex(columns=[city for city in all_municipalities if city in sel_targets_scale])
-                        .sort_index()
-                    )
+                    total_df = build_city_pivot(df_scale, metric_en, "total", year_range_scale, cities=sel_targets_scale, dataset=dataset)
 
                     # 41市町村全体データを取得
-                    df_all_cities = (
-                        df_scale.query(
-                            f"metric==@metric_en & cat1=='total' & "
-                            f"year >= {year_range_scale[0]} & year <= {year_range_scale[1]}"
-                        )
-                        .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                        .sort_index()
-                    )
+                    df_all_cities = build_city_pivot(df_scale, metric_en, "total", year_range_scale, dataset=dataset)
 
                     fig_total = create_line_chart(
                         total_df, [city for city in all_municipalities if city in sel_targets_scale],
@@ -3871,8 +6859,8 @@ def main():
                     st.plotly_chart(fig_total, use_container_width=True)
 
                     sorted_cities = [city for city in all_municipalities if city in total_df.columns]
-                    st.dataframe(
-                        total_df[sorted_cities].transpose().style.format(thousands=","),
+                    show_table(
+                        total_df[sorted_cities].transpose(),
                         use_container_width=True
                     )
 
@@ -3883,26 +6871,10 @@ def main():
                             cat_display = scale_class_mapping.get(cat, cat)
                             st.write(f"**{element} ({cat_display})**")
                             
-                            df_category = (
-                                df_scale.query(
-                                    f"metric == @metric_en & cat1 == @cat & "
-                                    "city in @sel_targets_scale & "
-                                    f"year >= {year_range_scale[0]} & year <= {year_range_scale[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .reindex(columns=[city for city in all_municipalities if city in sel_targets_scale])
-                                .sort_index()
-                            )
+                            df_category = build_city_pivot(df_scale, metric_en, cat, year_range_scale, cities=sel_targets_scale, dataset=dataset)
 
                             # 規模分類別の41市町村全体データを取得
-                            df_all_cities_cat = (
-                                df_scale.query(
-                                    f"metric == @metric_en & cat1 == @cat & "
-                                    f"year >= {year_range_scale[0]} & year <= {year_range_scale[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .sort_index()
-                            )
+                            df_all_cities_cat = build_city_pivot(df_scale, metric_en, cat, year_range_scale, dataset=dataset)
 
                             fig_category = create_line_chart(
                                 df_category, [city for city in all_municipalities if city in sel_targets_scale],
@@ -3915,8 +6887,8 @@ def main():
                             st.plotly_chart(fig_category, use_container_width=True)
 
                             sorted_cities = [city for city in all_municipalities if city in df_category.columns]
-                            st.dataframe(
-                                df_category[sorted_cities].transpose().style.format(thousands=","),
+                            show_table(
+                                df_category[sorted_cities].transpose(),
                                 use_container_width=True
                             )
                     
@@ -3929,7 +6901,7 @@ def main():
     # =================================================
     # TAB 4: ホテル・旅館特化　宿泊形態別分析（hotel_breakdown H26-R6）
     # =================================================
-    with tab4:
+    with tab4, timed_stage("tab4"):
         col_header1, col_header2 = st.columns([5, 1])
         with col_header1:
             st.header("🏛️ ホテル・旅館特化　宿泊形態別分析の状況")
@@ -3958,7 +6930,7 @@ def main():
 
         # hotel_breakdown（ホテル・旅館特化）データをフィルタ
         try:
-            df_hotel_breakdown = df_long.query("table == 'hotel_breakdown'")
+            df_hotel_breakdown = table_frame(tables, "hotel_breakdown", df_long)
         except Exception as e:
             st.error(f"データクエリエラー: {e}")
             df_hotel_breakdown = pd.DataFrame()
@@ -3970,18 +6942,22 @@ def main():
             
             # データベースの状況を表示
             st.write("**現在のデータ状況:**")
-            available_tables = df_long['table'].unique() if not df_long.empty else []
+            available_tables = list(dataset["table_rows"])
             st.write(f"利用可能なテーブル: {list(available_tables)}")
             
         else:
             # hotel_breakdownのデータをH26-R6に限定
-            df_hotel_breakdown = df_hotel_breakdown.query("year >= 2014 & year <= 2024")
+            if any(year < 2014 or year > 2024 for year in catalog["table_years"].get("hotel_breakdown", ())):
+                df_hotel_breakdown = track_memory(
+                    "hotel_breakdown（2014〜2024年）", df_hotel_breakdown.query("year >= 2014 & year <= 2024"), base=df_long
+                )
             
             if df_hotel_breakdown.empty:
                 st.warning("H26～R6期間のhotel_breakdownデータが見つかりません。データの年度範囲を確認してください。")
             else:
                 hotel_min_year = 2014
                 hotel_max_year = 2024
+                available_years_hotel = available_years(catalog, "hotel_breakdown", start=hotel_min_year, end=hotel_max_year)
                 
                 # ===== 共通設定エリア =====
                 st.subheader("🎛️ 分析設定")
@@ -4029,25 +7005,10 @@ def main():
                             metric_en = elem_map[element]
                             
                             # Total データ
-                            df_total = (
-                                df_hotel_breakdown.query(
-                                    f"metric == @metric_en & cat1 == 'total' & city in @sel_targets_hotel & "
-                                    f"year >= {year_range_hotel[0]} & year <= {year_range_hotel[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .reindex(columns=[city for city in all_municipalities if city in sel_targets_hotel])
-                                .sort_index()
-                            )
+                            df_total = build_city_pivot(df_hotel_breakdown, metric_en, "total", year_range_hotel, cities=sel_targets_hotel, dataset=dataset)
 
                             # 全市町村データ（ランキング用）
-                            df_all_total = (
-                                df_hotel_breakdown.query(
-                                    f"metric == @metric_en & cat1 == 'total' & "
-                                    f"year >= {year_range_hotel[0]} & year <= {year_range_hotel[1]}"
-                                )
-                                .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                .sort_index()
-                            )
+                            df_all_total = build_city_pivot(df_hotel_breakdown, metric_en, "total", year_range_hotel, dataset=dataset)
 
                             fig = create_line_chart(
                                 df_total, sel_targets_hotel,
@@ -4055,7 +7016,7 @@ def main():
                                 element, show_legend=False, df_all=df_all_total, show_ranking=True
                             )
                             st.plotly_chart(fig, use_container_width=True)
-                            st.dataframe(df_total.transpose().style.format(thousands=","), use_container_width=True)
+                            show_table(df_total.transpose(), use_container_width=True)
                     
                     # ===== 規模別詳細表示 =====
                     elif view_mode == "規模別詳細":
@@ -4073,16 +7034,8 @@ def main():
                             
                             for scale_en, scale_jp in scale_mapping.items():
                                 # 規模別データ集計（全ホテル種別を合計）
-                                df_scale = (
-                                    df_hotel_breakdown.query(
-                                        f"metric == @metric_en & cat1.str.endswith('_{scale_en}') & "
-                                        f"city in @sel_targets_hotel & "
-                                        f"year >= {year_range_hotel[0]} & year <= {year_range_hotel[1]}"
-                                    )
-                                    .groupby(['year', 'city'])['value'].sum().reset_index()
-                                    .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                    .reindex(columns=[city for city in all_municipalities if city in sel_targets_hotel])
-                                    .sort_index()
+                                df_scale = build_hotel_group_pivot(
+                                    df_hotel_breakdown, metric_en, year_range_hotel, sel_targets_hotel, suffix=scale_en
                                 )
 
                                 if not df_scale.empty and df_scale.sum().sum() > 0:
@@ -4094,7 +7047,7 @@ def main():
                                     st.plotly_chart(fig, use_container_width=True)
                                     
                                     with st.expander(f"📋 {scale_jp} データテーブル"):
-                                        st.dataframe(df_scale.transpose().style.format(thousands=","), use_container_width=True)
+                                        show_table(df_scale.transpose(), use_container_width=True)
                     
                     # ===== ホテル種別詳細表示 =====
                     elif view_mode == "ホテル種別詳細":
@@ -4113,16 +7066,8 @@ def main():
                             
                             for hotel_type_en, hotel_type_jp in hotel_type_mapping.items():
                                 # ホテル種別データ集計（全規模を合計）
-                                df_type = (
-                                    df_hotel_breakdown.query(
-                                        f"metric == @metric_en & cat1.str.startswith('{hotel_type_en}_') & "
-                                        f"city in @sel_targets_hotel & "
-                                        f"year >= {year_range_hotel[0]} & year <= {year_range_hotel[1]}"
-                                    )
-                                    .groupby(['year', 'city'])['value'].sum().reset_index()
-                                    .pivot_table(index="year", columns="city", values="value", aggfunc="sum")
-                                    .reindex(columns=[city for city in all_municipalities if city in sel_targets_hotel])
-                                    .sort_index()
+                                df_type = build_hotel_group_pivot(
+                                    df_hotel_breakdown, metric_en, year_range_hotel, sel_targets_hotel, prefix=hotel_type_en
                                 )
 
                                 if not df_type.empty and df_type.sum().sum() > 0:
@@ -4134,7 +7079,7 @@ def main():
                                     st.plotly_chart(fig, use_container_width=True)
                                     
                                     with st.expander(f"📋 {hotel_type_jp} データテーブル"):
-                                        st.dataframe(df_type.transpose().style.format(thousands=","), use_container_width=True)
+                                        show_table(df_type.transpose(), use_container_width=True)
                     
                     # ===== マトリックス表示 =====
                     elif view_mode == "マトリックス表示":
@@ -4143,14 +7088,16 @@ def main():
                         # 指標と年度を選択
                         col1, col2 = st.columns(2)
                         with col1:
-                            selected_metric = st.selectbox("指標選択", sel_elems_hotel, key="matrix_metric")
+                            # 合計行・列を足し上げるため、派生指標（比率）は対象外
+                            selected_metric = st.selectbox("指標選択", [e for e in sel_elems_hotel if elem_map[e] in METRICS], key="matrix_metric")
                         with col2:
-                            available_years = sorted(df_hotel_breakdown['year'].unique(), reverse=True)
-                            selected_year = st.selectbox("年度選択", available_years, key="matrix_year")
+                            selected_year = st.selectbox("年度選択", available_years_hotel[::-1], key="matrix_year")
                         
-                        metric_en = elem_map[selected_metric]
+                        metric_en = elem_map.get(selected_metric)
+                        if metric_en is None:
+                            st.info("👆 マトリックス表示には軒数・客室数・収容人数のいずれかを選択してください。")
                         
-                        for city in sel_targets_hotel:
+                        for city in sel_targets_hotel if metric_en else []:
                             st.write(f"**🏙️ {city} - {selected_year}年 {selected_metric}**")
                             
                             # マトリックスデータ作成
@@ -4238,20 +7185,9 @@ def main():
                                         if len(non_zero_rows) > 0:
                                             matrix_display = matrix_display.loc[non_zero_rows.index[non_zero_rows].tolist() + ['合計']]
                                         
-                                        # スタイリング付きで表示
+                                        # 合計列以外に背景色のグラデーションを付けて表示
                                         if len(matrix_display) > 1:  # 合計行以外にデータがある場合
-                                            try:
-                                                # matplotlibが利用可能な場合はグラデーション表示
-                                                styled_matrix = matrix_display.style.format(thousands=",").background_gradient(
-                                                    cmap='Blues', subset=matrix_display.columns[:-1]
-                                                )
-                                                st.dataframe(styled_matrix, use_container_width=True)
-                                            except ImportError:
-                                                # matplotlibが無い場合は通常表示
-                                                st.dataframe(matrix_display.style.format(thousands=","), use_container_width=True)
-                                            except Exception:
-                                                # その他のエラーの場合も通常表示
-                                                st.dataframe(matrix_display.style.format(thousands=","), use_container_width=True)
+                                            show_table(matrix_display, gradient_columns=matrix_display.columns[:-1], use_container_width=True)
                                         else:
                                             st.info("データはありますが、すべて0のため表示をスキップしました。")
                                             
@@ -4265,10 +7201,12 @@ def main():
 
                 # ===== データ概要情報 =====
                 with st.expander("📈 データ概要情報"):
-                    years_list = sorted([int(year) for year in df_hotel_breakdown['year'].unique()])
-                    st.write("**利用可能な年度:**", years_list)
-                    st.write("**市町村数:**", len(df_hotel_breakdown['city'].unique()))
-                    st.write("**カテゴリ数:**", len(df_hotel_breakdown['cat1'].unique()))
+                    st.write("**利用可能な年度:**", available_years_hotel)
+                    missing_years = [y for y in year_options if y not in catalog["table_years"].get("hotel_breakdown", ())]
+                    if missing_years:
+                        st.write("**データのない年度:**", f"{missing_years[0]}〜{missing_years[-1]}年" if len(missing_years) > 1 else f"{missing_years[0]}年")
+                    st.write("**市町村数:**", catalog_count(catalog, "hotel_breakdown", "city", hotel_min_year, hotel_max_year))
+                    st.write("**カテゴリ数:**", catalog_count(catalog, "hotel_breakdown", "cat1", hotel_min_year, hotel_max_year))
                     
                     if sel_targets_hotel:
                         latest_year = df_hotel_breakdown['year'].max()
@@ -4288,12 +7226,12 @@ def main():
                             available_cols = [col for col in desired_order if col in summary_data.columns]
                             summary_data = summary_data[available_cols]
                             
-                            st.dataframe(summary_data.style.format(thousands=","), use_container_width=True)
+                            show_table(summary_data, use_container_width=True)
 
     # =================================================
     # TAB 5: エリア別分析（全シート対応）
     # =================================================
-    with tab5:
+    with tab5, timed_stage("tab5"):
         col_header1, col_header2 = st.columns([5, 1])
         with col_header1:
             st.header("🗺️ エリア別の状況")
@@ -4343,7 +7281,7 @@ def main():
         with col2:
             # 年度選択
             year_range_area = st.slider(
-                "期間", min_y, max_y, (2007, 2024), step=1, key="year_area"
+                "期間", min_y, max_y, (min_y, max_y), step=1, key="year_area"
             )
             
             # 分析タイプ選択
@@ -4356,13 +7294,10 @@ def main():
         if not sel_areas:
             st.info("👆 エリアを選択してください。")
         else:
-            # city → area の逆引き辞書
-            city_to_area = {c: r for r, lst in REGION_MAP.items() for c in lst}
-            
             # 分析タイプに応じてデータソースと表示方法を決定
             if analysis_type == "全宿泊施設":
                 # accommodation_type データを使用
-                df_analysis = df_long.query("table == 'accommodation_type'")
+                df_analysis = table_frame(tables, "accommodation_type", df_long)
                 
                 if df_analysis.empty:
                     st.warning("⚠️ 宿泊形態別データが見つかりません。")
@@ -4384,18 +7319,7 @@ def main():
                             metric_en = elem_map[element]
                             
                             # Total データ
-                            df_area_total = (
-                                df_analysis.query(
-                                    f"metric == @metric_en & cat1 == 'total' & "
-                                    "city in @city_to_area.keys() & "
-                                    f"year >= {year_range_area[0]} & year <= {year_range_area[1]}"
-                                )
-                                .assign(area=lambda d: d["city"].map(city_to_area))
-                                .groupby(["area", "year"])['value'].sum()
-                                .unstack("area")
-                                .reindex(columns=sel_areas)
-                                .sort_index()
-                            )
+                            df_area_total = build_area_pivot(df_analysis, metric_en, "total", year_range_area, sel_areas, dataset=dataset)
 
                             fig_area_total = create_line_chart(
                                 df_area_total, sel_areas, 
@@ -4403,14 +7327,14 @@ def main():
                                 element, show_legend=False, df_all=None, show_ranking=False
                             )
                             st.plotly_chart(fig_area_total, use_container_width=True)
-                            st.dataframe(df_area_total.transpose().style.format(thousands=","), use_container_width=True)
+                            show_table(df_area_total.transpose(), use_container_width=True)
                     
                     # ===== 宿泊形態別詳細 =====
                     elif view_mode_area == "宿泊形態別詳細":
                         st.subheader("📊 宿泊形態別詳細 - 全宿泊施設")
                         
                         # 宿泊形態別カテゴリの取得
-                        accommodation_categories = sorted([cat for cat in df_analysis['cat1'].unique() if cat and cat != 'total'])
+                        accommodation_categories = available_categories(catalog, "accommodation_type")
                         
                         # 英語キーを日本語表示に変換
                         accommodation_categories_jp = []
@@ -4446,18 +7370,7 @@ def main():
                                 category_display = accommodation_type_mapping.get(category, category)
                                 st.write(f"**{element} ({category_display})**")
                                 
-                                df_category_area = (
-                                    df_analysis.query(
-                                        f"metric == @metric_en & cat1 == @category & "
-                                        "city in @city_to_area.keys() & "
-                                        f"year >= {year_range_area[0]} & year <= {year_range_area[1]}"
-                                    )
-                                    .assign(area=lambda d: d["city"].map(city_to_area))
-                                    .groupby(["area", "year"])['value'].sum()
-                                    .unstack("area")
-                                    .reindex(columns=sel_areas)
-                                    .sort_index()
-                                )
+                                df_category_area = build_area_pivot(df_analysis, metric_en, category, year_range_area, sel_areas, dataset=dataset)
 
                                 fig_category_area = create_line_chart(
                                     df_category_area, sel_areas,
@@ -4465,7 +7378,7 @@ def main():
                                     element, show_legend=False, df_all=None, show_ranking=False
                                 )
                                 st.plotly_chart(fig_category_area, use_container_width=True)
-                                st.dataframe(df_category_area.transpose().style.format(thousands=","), use_container_width=True)
+                                show_table(df_category_area.transpose(), use_container_width=True)
                             
                             # 指標間の区切り
                             if element != sel_elems_area[-1]:
@@ -4473,8 +7386,8 @@ def main():
             
             else:  # ホテル・旅館特化
                 # scale_class または hotel_breakdown データを使用
-                df_scale_area = df_long.query("table == 'scale_class'")
-                df_hotel_area = df_long.query("table == 'hotel_breakdown'")
+                df_scale_area = table_frame(tables, "scale_class", df_long)
+                df_hotel_area = table_frame(tables, "hotel_breakdown", df_long)
                 
                 if not df_scale_area.empty:
                     df_analysis = df_scale_area
@@ -4511,18 +7424,7 @@ def main():
                             metric_en = elem_map[element]
                             
                             # Total データ
-                            df_hotel_total = (
-                                df_analysis.query(
-                                    f"metric == @metric_en & cat1 == 'total' & "
-                                    "city in @city_to_area.keys() & "
-                                    f"year >= {year_range_area[0]} & year <= {year_range_area[1]}"
-                                )
-                                .assign(area=lambda d: d["city"].map(city_to_area))
-                                .groupby(["area", "year"])['value'].sum()
-                                .unstack("area")
-                                .reindex(columns=sel_areas)
-                                .sort_index()
-                            )
+                            df_hotel_total = build_area_pivot(df_analysis, metric_en, "total", year_range_area, sel_areas, dataset=dataset)
 
                             fig_hotel_total = create_line_chart(
                                 df_hotel_total, sel_areas, 
@@ -4530,7 +7432,7 @@ def main():
                                 element, show_legend=False, df_all=None, show_ranking=False
                             )
                             st.plotly_chart(fig_hotel_total, use_container_width=True)
-                            st.dataframe(df_hotel_total.transpose().style.format(thousands=","), use_container_width=True)
+                            show_table(df_hotel_total.transpose(), use_container_width=True)
                     
                     # ===== 詳細表示 =====
                     else:
@@ -4538,7 +7440,7 @@ def main():
                             st.subheader("📊 規模別詳細 - ホテル・旅館")
                             
                             # 規模別カテゴリの取得
-                            scale_categories = sorted([cat for cat in df_analysis['cat1'].unique() if cat and cat != 'total'])
+                            scale_categories = available_categories(catalog, table_name)
                             
                             # 英語キーを日本語表示に変換
                             scale_categories_jp = []
@@ -4570,18 +7472,7 @@ def main():
                                     category_display = scale_class_mapping.get(category, category)
                                     st.write(f"**{element} ({category_display})**")
                                     
-                                    df_category_area = (
-                                        df_analysis.query(
-                                            f"metric == @metric_en & cat1 == @category & "
-                                            "city in @city_to_area.keys() & "
-                                            f"year >= {year_range_area[0]} & year <= {year_range_area[1]}"
-                                        )
-                                        .assign(area=lambda d: d["city"].map(city_to_area))
-                                        .groupby(["area", "year"])['value'].sum()
-                                        .unstack("area")
-                                        .reindex(columns=sel_areas)
-                                        .sort_index()
-                                    )
+                                    df_category_area = build_area_pivot(df_analysis, metric_en, category, year_range_area, sel_areas, dataset=dataset)
 
                                     fig_category_area = create_line_chart(
                                         df_category_area, sel_areas,
@@ -4589,7 +7480,7 @@ def main():
                                         element, show_legend=False, df_all=None, show_ranking=False
                                     )
                                     st.plotly_chart(fig_category_area, use_container_width=True)
-                                    st.dataframe(df_category_area.transpose().style.format(thousands=","), use_container_width=True)
+                                    show_table(df_category_area.transpose(), use_container_width=True)
                                 
                                 # 指標間の区切り
                                 if element != sel_elems_area[-1]:
@@ -4599,7 +7490,7 @@ def main():
                             st.subheader("📊 ホテル種別詳細")
                             
                             # hotel_breakdownの詳細カテゴリ取得
-                            hotel_categories = sorted([cat for cat in df_analysis['cat1'].unique() if cat and cat != 'total'])
+                            hotel_categories = available_categories(catalog, table_name)
                             
                             sel_hotel_categories_area = st.multiselect(
                                 "ホテル種別（複数選択可）",
@@ -4617,18 +7508,7 @@ def main():
                                 for category in sel_hotel_categories_area:
                                     st.write(f"**{element} ({category})**")
                                     
-                                    df_category_area = (
-                                        df_analysis.query(
-                                            f"metric == @metric_en & cat1 == @category & "
-                                            "city in @city_to_area.keys() & "
-                                            f"year >= {year_range_area[0]} & year <= {year_range_area[1]}"
-                                        )
-                                        .assign(area=lambda d: d["city"].map(city_to_area))
-                                        .groupby(["area", "year"])['value'].sum()
-                                        .unstack("area")
-                                        .reindex(columns=sel_areas)
-                                        .sort_index()
-                                    )
+                                    df_category_area = build_area_pivot(df_analysis, metric_en, category, year_range_area, sel_areas, dataset=dataset)
 
                                     fig_category_area = create_line_chart(
                                         df_category_area, sel_areas,
@@ -4636,14 +7516,20 @@ def main():
                                         element, show_legend=False, df_all=None, show_ranking=False
                                     )
                                     st.plotly_chart(fig_category_area, use_container_width=True)
-                                    st.dataframe(df_category_area.transpose().style.format(thousands=","), use_container_width=True)
+                                    show_table(df_category_area.transpose(), use_container_width=True)
                                 
                                 # 指標間の区切り
                                 if element != sel_elems_area[-1]:
                                     st.markdown("---")
 
     # =================================================
-    # TAB 6: ヘルプ・使い方
+    # TAB 6: SQL コンソール（読み取り専用）
+    # =================================================
+    with tab_sql, timed_stage("tab_sql"):
+        render_sql_console(dataset)
+
+    # =================================================
+    # TAB 7: ヘルプ・使い方
     # =================================================
     with tab_help:
         st.header("📖 アプリ使用方法・完全ガイド")
@@ -4680,4 +7566,4 @@ def main():
     )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_page()
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+# tools/batch_report.py
+# =============================================================
+# 全市町村プロファイル一括生成 CLI
+# -------------------------------------------------------------
+# ・データ読み込みとキューブ集計は1回だけ行い、各ワーカーに共有する
+# ・市町村ごとのレポートをプロセスプールで並列生成する
+# ・出力: Markdown / HTML / CSV と、レポート別の処理時間 (timings.csv)
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.batch_report --out reports
+#   python -m tools.batch_report --formats md,csv --year 2023 --cities 那覇市 石垣市
+# =============================================================
+
+import argparse
+import html
+import numbers
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+import app
+
+FORMATS = ("md", "html", "csv")
+
+# 期間比較のプリセット（ランキング分析タブの period_map と同じ）
+PERIOD_PRESETS = {"過去3年間": 2, "過去5年間": 4, "過去10年間": 9}
+
+HOTEL_TYPES = {
+    "resort_hotel": "リゾートホテル",
+    "business_hotel": "ビジネスホテル",
+    "city_hotel": "シティホテル",
+    "ryokan": "旅館",
+}
+
+# ワーカープロセスごとに保持する共有コンテキスト
+_CTX = None
+
+
+# ---------------- コンテキスト構築 ----------------
+def build_context(year=None):
+    """データを1回だけ読み込み、全レポートで共有する集計結果をまとめる"""
+    df_long = app.load_all_data()
+    if df_long.empty:
+        raise SystemExit("データファイルが見つかりません")
+    df_long = app.normalize_long_table(df_long)
+
+    cube = app.build_cube(df_long)
+    base_table = app.resolve_analysis_table(cube)
+    if base_table is None:
+        raise SystemExit("分析に使用できるテーブルが見つかりません")
+
+    years = sorted(cube.loc[base_table].index.get_level_values("year").unique())
+    ref_year = int(year) if year is not None else int(years[-1])
+    if ref_year not in years:
+        raise SystemExit(f"{ref_year}年のデータがありません（利用可能: {years[0]}〜{years[-1]}年）")
+
+    return {
+        "cube": cube,
+        "ranks": app.build_rank_cube(cube),
+        "base_table": base_table,
+        "years": [int(y) for y in years],
+        "ref_year": ref_year,
+    }
+
+
+def _init_worker(ctx):
+    global _CTX
+    _CTX = ctx
+
+
+# ---------------- レポート内容 ----------------
+def _annual_table(ctx, city):
+    """年次推移: 指標ごとの値・順位・対前年増減数・増減率"""
+    cube, ranks, table = ctx["cube"], ctx["ranks"], ctx["base_table"]
+    full_years = range(ctx["years"][0], ctx["years"][-1] + 1)
+    columns = {}
+    for metric in app.METRICS:
+        jp = app.METRIC_JP[metric]
+        values = app.cube_frame(cube, table, metric).reindex(full_years)
+        if city not in values.columns:
+            continue
+        series = values[city]
+        previous = series.shift(1)
+        columns[jp] = series
+        columns[f"{jp}順位"] = app.cube_frame(ranks, table, metric).reindex(full_years)[city].astype("Int64")
+        columns[f"{jp}対前年増減数"] = series - previous
+        columns[f"{jp}対前年増減率(%)"] = (series - previous) / previous.where(previous != 0) * 100
+    frame = pd.DataFrame(columns)
+    frame.index.name = "年"
+    return frame.dropna(how="all")
+
+
+def _period_table(ctx, city):
+    """期間比較: プリセット期間ごとの増減数・増減率と、増減数の全市町村中順位"""
+    cube, table, ref_year = ctx["cube"], ctx["base_table"], ctx["ref_year"]
+    periods = {name: ref_year - span for name, span in PERIOD_PRESETS.items()}
+    periods["全期間"] = ctx["years"][0]
+
+    rows = []
+    for metric in app.METRICS:
+        values = app.cube_frame(cube, table, metric)
+        municipalities = [c for c in values.columns if c in app.CITY_CODE]
+        for name, start_year in periods.items():
+            if start_year not in values.index or ref_year not in values.index or city not in values.columns:
+                continue
+            start, end = values.loc[start_year], values.loc[ref_year]
+            change = end - start
+            change_rank = change[municipalities].rank(method="min", ascending=False)
+            rate = change[city] / start[city] * 100 if start[city] else float("nan")
+            rows.append({
+                "指標": app.METRIC_JP[metric],
+                "期間": f"{name}（{start_year}〜{ref_year}年）",
+                "開始値": start[city],
+                "終了値": end[city],
+                "増減数": change[city],
+                "増減率(%)": rate,
+                "増減数順位": change_rank.get(city),
+            })
+    return pd.DataFrame(rows)
+
+
+def _accommodation_table(ctx, city):
+    """宿泊形態別の内訳（基準年）"""
+    cube, ref_year = ctx["cube"], ctx["ref_year"]
+    if "accommodation_type" not in cube.index.get_level_values("table"):
+        return pd.DataFrame()
+    sub = cube.loc["accommodation_type"]
+    rows = {}
+    for metric in app.METRICS:
+        try:
+            values = sub.loc[metric].xs(ref_year, level="year")[city]
+        except KeyError:
+            continue
+        rows[app.METRIC_JP[metric]] = values
+    frame = pd.DataFrame(rows)
+    if frame.empty:
+        return frame
+    total = frame.loc["total"] if "total" in frame.index else frame.sum()
+    frame = frame.drop(index="total", errors="ignore")
+    facilities = total.get("軒数")
+    if "軒数" in frame.columns and pd.notna(facilities) and facilities:
+        frame["軒数シェア(%)"] = frame["軒数"] / facilities * 100
+    else:
+        frame["軒数シェア(%)"] = float("nan")  # 軒数が無い・合計が0の場合は "-" と表示する
+    cat1_en2jp = {en: jp for jp, en in app.CAT1_JP2EN.items()}
+    frame.index = [cat1_en2jp.get(c, c) for c in frame.index]
+    frame.index.name = "宿泊形態"
+    return frame
+
+
+def _hotel_type_table(ctx, city):
+    """ホテル・旅館の種別内訳（hotel_breakdown、基準年以前の最新年）"""
+    cube, ref_year = ctx["cube"], ctx["ref_year"]
+    if "hotel_breakdown" not in cube.index.get_level_values("table"):
+        return pd.DataFrame(), None
+    sub = cube.loc["hotel_breakdown"]
+    years = [y for y in sub.index.get_level_values("year").unique() if y <= ref_year]
+    if not years or city not in sub.columns:
+        return pd.DataFrame(), None
+    year = max(years)
+
+    rows = {}
+    for metric in app.METRICS:
+        try:
+            values = sub.loc[metric].xs(year, level="year")[city]
+        except KeyError:
+            continue
+        # タブ4と同様に「種別_規模」の値を種別ごとに合計する
+        rows[app.METRIC_JP[metric]] = {
+            jp: values[values.index.str.startswith(f"{en}_")].sum() for en, jp in HOTEL_TYPES.items()
+        }
+    frame = pd.DataFrame(rows)
+    frame.index.name = "ホテル種別"
+    return frame, int(year)
+
+
+def build_city_report(ctx, city):
+    """1市町村分のレポート（タイトルと (見出し, DataFrame) のリスト）を生成する"""
+    ref_year = ctx["ref_year"]
+    annual = _annual_table(ctx, city)
+
+    summary_rows = []
+    if ref_year in annual.index:
+        latest = annual.loc[ref_year]
+        for metric in app.METRICS:
+            jp = app.METRIC_JP[metric]
+            if jp in latest.index:
+                summary_rows.append({
+                    "指標": jp,
+                    "値": latest[jp],
+                    "全市町村中順位": latest[f"{jp}順位"],
+                    "対前年増減数": latest[f"{jp}対前年増減数"],
+                    "対前年増減率(%)": latest[f"{jp}対前年増減率(%)"],
+                })
+
+    sections = [
+        (f"{ref_year}年 基本情報", pd.DataFrame(summary_rows)),
+        ("期間比較", _period_table(ctx, city)),
+        ("年次推移", annual.reset_index()),
+        (f"{ref_year}年 宿泊形態別内訳", _accommodation_table(ctx, city).reset_index()),
+    ]
+    hotel_frame, hotel_year = _hotel_type_table(ctx, city)
+    if hotel_year is not None:
+        sections.append((f"{hotel_year}年 ホテル・旅館種別内訳", hotel_frame.reset_index()))
+
+    title = f"{city}（市町村コード {app.CITY_CODE.get(city, '-')}）宿泊施設プロファイル"
+    return title, sections
+
+
+# ---------------- 出力 ----------------
+def _format_cell(value, column):
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return "-"
+    if isinstance(value, numbers.Number):
+        if "順位" in column or column == "年":
+            return str(int(value))
+        if "率" in column or "シェア" in column:
+            return f"{value:+.1f}" if "増減" in column else f"{value:.1f}"
+        if "増減" in column:
+            return f"{value:+,.0f}"
+        return f"{value:,.0f}"
+    return str(value)
+
+
+def frame_to_markdown(frame):
+    """tabulate に依存せず DataFrame を Markdown の表に変換する"""
+    if frame.empty:
+        return "データがありません。\n"
+    columns = [str(c) for c in frame.columns]
+    lines = [
+        "| " + " | ".join(columns) + " |",
+        "|" + "|".join("---" for _ in columns) + "|",
+    ]
+    for row in frame.itertuples(index=False):
+        lines.append("| " + " | ".join(_format_cell(v, c) for v, c in zip(row, columns)) + " |")
+    return "\n".join(lines) + "\n"
+
+
+def render_markdown(title, sections):
+    parts = [f"# {title}\n"]
+    for heading, frame in sections:
+        parts.append(f"## {heading}\n\n{frame_to_markdown(frame)}")
+    return "\n".join(parts)
+
+
+def render_html(title, sections):
+    body = [f"<h1>{html.escape(title)}</h1>"]
+    for heading, frame in sections:
+        body.append(f"<h2>{html.escape(heading)}</h2>")
+        if frame.empty:
+            body.append("<p>データがありません。</p>")
+            continue
+        formatted = pd.DataFrame({
+            c: [_format_cell(v, str(c)) for v in frame[c]] for c in frame.columns
+        })
+        body.append(formatted.to_html(index=False, border=0, classes="report"))
+    return (
+        "<!DOCTYPE html>\n<html lang=\"ja\"><head><meta charset=\"utf-8\">"
+        f"<title>{html.escape(title)}</title>"
+        "<style>body{font-family:sans-serif;margin:2em}table.report{border-collapse:collapse;margin-bottom:1.5em}"
+        "table.report th,table.report td{border:1px solid #ccc;padding:4px 8px;text-align:right}</style>"
+        "</head><body>\n" + "\n".join(body) + "\n</body></html>\n"
+    )
+
+
+def write_city_report(city, out_dir, formats):
+    """ワーカー側の処理: 1市町村のレポートを生成して書き出し、処理時間を返す"""
+    start = time.perf_counter()
+    title, sections = build_city_report(_CTX, city)
+    stem = Path(out_dir) / f"{app.CITY_CODE.get(city, 0)}_{city}"
+
+    written = []
+    if "md" in formats:
+        path = stem.with_suffix(".md")
+        path.write_text(render_markdown(title, sections), encoding="utf-8")
+        written.append(path.name)
+    if "html" in formats:
+        path = stem.with_suffix(".html")
+        path.write_text(render_html(title, sections), encoding="utf-8")
+        written.append(path.name)
+    if "csv" in formats:
+        # 年次推移を市町村ごとのCSVとして出力（Excelで開けるようBOM付き）
+        path = stem.with_suffix(".csv")
+        annual = next(frame for heading, frame in sections if heading == "年次推移")
+        annual.to_csv(path, index=False, encoding="utf-8-sig")
+        written.append(path.name)
+
+    return city, time.perf_counter() - start, written
+
+
+def write_index(out_dir, results, ctx, formats):
+    """市町村一覧（リンク付き）と処理時間の一覧を書き出す"""
+    timings = pd.DataFrame(
+        [(city, app.CITY_CODE.get(city), secs) for city, secs, _ in results],
+        columns=["city", "city_code", "seconds"],
+    ).sort_values("city_code")
+    timings.to_csv(Path(out_dir) / "timings.csv", index=False, encoding="utf-8-sig")
+
+    if "md" in formats:
+        lines = [f"# 市町村別宿泊施設プロファイル（{ctx['ref_year']}年）\n"]
+        lines += [f"- [{row.city}]({row.city_code}_{row.city}.md)" for row in timings.itertuples()]
+        (Path(out_dir) / "index.md").write_text("\n".join(lines) + "\n", encoding="utf-8")
+    if "html" in formats:
+        items = "".join(
+            f"<li><a href=\"{row.city_code}_{html.escape(row.city)}.html\">{html.escape(row.city)}</a></li>"
+            for row in timings.itertuples()
+        )
+        (Path(out_dir) / "index.html").write_text(
+            "<!DOCTYPE html>\n<html lang=\"ja\"><head><meta charset=\"utf-8\">"
+            f"<title>市町村別宿泊施設プロファイル</title></head><body>"
+            f"<h1>市町村別宿泊施設プロファイル（{ctx['ref_year']}年）</h1><ul>{items}</ul></body></html>\n",
+            encoding="utf-8",
+        )
+    return timings
+
+
+# ---------------- CLI ----------------
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="全市町村の宿泊施設プロファイルを一括生成します")
+    parser.add_argument("--out", default="reports", help="出力ディレクトリ（既定: reports）")
+    parser.add_argument("--formats", default="md,html,csv", help="出力形式（md,html,csv のカンマ区切り）")
+    parser.add_argument("--year", type=int, default=None, help="基準年（既定: 最新年）")
+    parser.add_argument("--cities", nargs="*", default=None, help="対象市町村（既定: 全41市町村）")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数（既定: CPU数）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    formats = {f.strip() for f in args.formats.split(",") if f.strip()}
+    unknown = formats - set(FORMATS)
+    if unknown:
+        raise SystemExit(f"未対応の出力形式です: {sorted(unknown)}")
+
+    cities = args.cities or sorted(app.CITY_CODE, key=app.CITY_CODE.get)
+    unknown_cities = [c for c in cities if c not in app.CITY_CODE]
+    if unknown_cities:
+        raise SystemExit(f"市町村名が不正です: {unknown_cities}")
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    t0 = time.perf_counter()
+    ctx = build_context(args.year)
+    t_load = time.perf_counter() - t0
+    print(f"データ読み込み・集計: {t_load:.2f}秒（基準年 {ctx['ref_year']}年, テーブル {ctx['base_table']}）")
+
+    workers = args.workers or os.cpu_count() or 1
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ctx,)) as pool:
+        futures = [pool.submit(write_city_report, city, str(out_dir), formats) for city in cities]
+        for future in as_completed(futures):
+            city, secs, written = future.result()
+            results.append((city, secs, written))
+            print(f"  {city}: {secs * 1000:.1f}ms ({', '.join(written)})")
+
+    timings = write_index(out_dir, results, ctx, formats)
+    total = time.perf_counter() - t0
+    print(
+        f"完了: {len(results)}件 / 合計 {total:.2f}秒 "
+        f"(レポート平均 {timings['seconds'].mean() * 1000:.1f}ms, 最大 {timings['seconds'].max() * 1000:.1f}ms) → {out_dir}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# tools/benchmark.py
+# =============================================================
+# データ読み込み・質問応答のホットパス ベンチマーク
+# -------------------------------------------------------------
+# 計測対象:
+# ・load_all_data（別プロセスでの初回=cold / 同一プロセスでの再実行=warm）
+#   CSV 解析エンジン別（[pandas] / [pyarrow]、app.CSV_ENGINES）の計測も行う
+# ・load_transition_total
+# ・process_structured_question の全質問タイプ × 場所タイプ × 選択数(1/10/41市町村・全エリア)
+# ・create_line_chart（41系列）と、同じデータの create_city_year_heatmap（1トレース）。図の JSON のバイト数も記録する
+# ・タブ2〜5のピボット作成（既定表示と、年度スライダーを動かした場合の再実行）
+#
+# 結果は JSON で保存し、--compare で過去の結果と比較できる。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.benchmark                         # 同梱データ
+#   python -m tools.benchmark --synthetic 5           # 市町村数を5倍（205市町村）にした合成データ
+#   python -m tools.benchmark --compare benchmarks/xxx.json
+#   python -m tools.benchmark --synthetic 100 --only load_all_data   # 100倍の合成データで CSV エンジンを比較
+# =============================================================
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import plotly
+
+import app
+from tools import synthetic_data
+
+RESULTS_DIR = Path("benchmarks")
+SELECTION_SIZES = (1, 10, 41)
+
+
+# ---------------- 計測ユーティリティ ----------------
+def measure(fn, repeat):
+    """fn を repeat 回実行し、ミリ秒単位の統計値を返す"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def summarize(samples):
+    return {
+        "repeat": len(samples),
+        "min_ms": min(samples),
+        "median_ms": statistics.median(samples),
+        "mean_ms": statistics.fmean(samples),
+        "max_ms": max(samples),
+        "stdev_ms": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def measure_cold_load(data_dir, repeat, engine=None):
+    """新しいPythonプロセスで load_all_data を1回だけ実行した時間（import時間は含めない）"""
+    code = (
+        "import time, app\n"
+        f"app.set_data_dir({str(data_dir)!r})\n"
+        "t = time.perf_counter()\n"
+        f"app.load_all_data(engine={engine!r})\n"
+        "print('ELAPSED', (time.perf_counter() - t) * 1000)\n"
+    )
+    samples = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parents[1],
+        ).stdout
+        samples.append(float(out.rsplit("ELAPSED", 1)[1]))
+    return summarize(samples)
+
+
+# ---------------- ベンチマークケース ----------------
+def question_cases(df_long):
+    """process_structured_question に渡すパラメータの組み合わせを列挙する"""
+    municipalities = sorted(app.CITY_CODE, key=app.CITY_CODE.get)
+    max_year = int(df_long["year"].max())
+    locations = [(f"市町村{n}", "市町村", municipalities[:n]) for n in SELECTION_SIZES]
+    locations += [("全エリア", "エリア", list(app.REGION_MAP.keys())), ("全体", "全体", ["全体"])]
+
+    cases = []
+    for label, location_type, locs in locations:
+        base = {"location_type": location_type, "locations": locs, "all_municipalities": municipalities}
+        cases.append((f"基本情報取得/{label}", dict(
+            base, question_type="基本情報取得", metrics=["軒数", "客室数", "収容人数"], target_year=max_year)))
+        cases.append((f"ランキング表示/{label}", dict(
+            base, question_type="ランキング表示", metric="客室数", ranking_count=10, ranking_year=max_year)))
+        for question_type, result_type in (("増減数ランキング", "増減数"), ("増減率ランキング", "増減率")):
+            cases.append((f"{question_type}/対前年/{label}", dict(
+                base, question_type=question_type, metric="客室数", ranking_count=10,
+                analysis_type="対前年比較", result_type=result_type, target_year=max_year)))
+            cases.append((f"{question_type}/期間/{label}", dict(
+                base, question_type=question_type, metric="客室数", ranking_count=10,
+                analysis_type="期間比較", result_type=result_type, start_year=max_year - 9, end_year=max_year)))
+        cases.append((f"増減・伸び率分析/対前年/{label}", dict(
+            base, question_type="増減・伸び率分析", metric="客室数", analysis_type="対前年比較",
+            result_type="増減数", target_year=max_year, show_ranking=True, ranking_count=10)))
+        cases.append((f"増減・伸び率分析/期間/{label}", dict(
+            base, question_type="増減・伸び率分析", metric="客室数", analysis_type="期間比較（開始年〜最新年）",
+            result_type="増減数", start_year=max_year - 9, end_year=max_year, show_ranking=True, ranking_count=10)))
+        cases.append((f"期間推移分析/{label}", dict(
+            base, question_type="期間推移分析", metric="客室数", start_year=max_year - 9, end_year=max_year)))
+        cases.append((f"比較分析/{label}", dict(
+            base, question_type="比較分析", metric="客室数", comparison_year=max_year)))
+    return cases
+
+
+def tab_cases(dataset):
+    """タブ2〜5の既定表示に相当するピボット作成処理と、年度スライダーを動かした場合の再実行"""
+    df_long, tables = dataset["long"], dataset["tables"]
+    municipalities = sorted(app.CITY_CODE, key=app.CITY_CODE.get)
+    full_range = (int(df_long["year"].min()), int(df_long["year"].max()))
+    areas = list(app.REGION_MAP.keys())
+    # スライダーのドラッグ中に届く範囲の列（終了年を1年ずつ動かす）
+    slider_ranges = itertools.cycle([(full_range[0], end) for end in range(full_range[0], full_range[1] + 1)])
+
+    def tab2(cities, year_range=full_range):
+        df_accommodation = app.table_frame(tables, "accommodation_type", df_long)
+        for cat1 in ["total", "hotel_ryokan", "minshuku", "pension_villa"]:
+            app.build_city_pivot(df_accommodation, "facilities", cat1, year_range, cities=cities, dataset=dataset)
+            app.build_city_pivot(df_accommodation, "facilities", cat1, year_range, dataset=dataset)
+
+    def tab3(cities, year_range=full_range):
+        df_scale = app.table_frame(tables, "scale_class", df_long)
+        for cat1 in ["total", "large", "medium", "small"]:
+            app.build_city_pivot(df_scale, "facilities", cat1, year_range, cities=cities, dataset=dataset)
+            app.build_city_pivot(df_scale, "facilities", cat1, year_range, dataset=dataset)
+
+    def tab4(cities):
+        df_hotel = app.table_frame(tables, "hotel_breakdown", df_long).query("year >= 2014 & year <= 2024")
+        hotel_range = (2014, 2024)
+        app.build_city_pivot(df_hotel, "facilities", "total", hotel_range, cities=cities, dataset=dataset)
+        app.build_city_pivot(df_hotel, "facilities", "total", hotel_range, dataset=dataset)
+        for scale in ["large", "medium", "small"]:
+            app.build_hotel_group_pivot(df_hotel, "facilities", hotel_range, cities, suffix=scale)
+        for hotel_type in ["resort_hotel", "business_hotel", "city_hotel", "ryokan"]:
+            app.build_hotel_group_pivot(df_hotel, "facilities", hotel_range, cities, prefix=hotel_type)
+
+    def tab5(year_range=full_range):
+        df_analysis = app.table_frame(tables, "accommodation_type", df_long)
+        for cat1 in ["total", "hotel_ryokan", "minshuku", "pension_villa"]:
+            app.build_area_pivot(df_analysis, "facilities", cat1, year_range, areas, dataset=dataset)
+
+    cases = []
+    for n in SELECTION_SIZES:
+        cities = municipalities[:n]
+        cases.append((f"tab2/市町村{n}", lambda c=cities: tab2(c)))
+        cases.append((f"tab3/市町村{n}", lambda c=cities: tab3(c)))
+        cases.append((f"tab4/市町村{n}", lambda c=cities: tab4(c)))
+    cases.append(("tab5/全エリア", tab5))
+    selected = municipalities[:10]
+    cases.append(("tab2/スライダー", lambda: tab2(selected, next(slider_ranges))))
+    cases.append(("tab3/スライダー", lambda: tab3(selected, next(slider_ranges))))
+    cases.append(("tab5/スライダー", lambda: tab5(next(slider_ranges))))
+    return cases
+
+
+def chart_case(dataset):
+    """41市町村ぶんの系列を持つ create_line_chart"""
+    df_long = dataset["long"]
+    municipalities = sorted(app.CITY_CODE, key=app.CITY_CODE.get)
+    year_range = (int(df_long["year"].min()), int(df_long["year"].max()))
+    df_accommodation = app.table_frame(dataset["tables"], "accommodation_type", df_long)
+    pivot = app.build_city_pivot(df_accommodation, "facilities", "total", year_range, cities=municipalities)
+    pivot_all = app.build_city_pivot(df_accommodation, "facilities", "total", year_range)
+    return lambda: app.create_line_chart(pivot, municipalities, "benchmark", "軒数", df_all=pivot_all, show_ranking=True)
+
+
+def heatmap_case(dataset):
+    """chart_case と同じ (table, metric, cat1)・期間の市町村×年ヒートマップ"""
+    df_long = dataset["long"]
+    year_range = (int(df_long["year"].min()), int(df_long["year"].max()))
+    matrix = app.city_year_matrix(dataset, "accommodation_type", "facilities", "total", year_range)
+    return lambda: app.create_city_year_heatmap(matrix, "benchmark", "軒数")
+
+
+# ---------------- 実行 ----------------
+def run_benchmarks(data_dir, repeat, cold_repeat, only=None):
+    app.set_data_dir(data_dir)
+    results = {}
+
+    def bench(group, name, fn, cold=False, engine=None):
+        key = f"{group}/{name}"
+        if only and only not in key:
+            return
+        stats = measure_cold_load(data_dir, cold_repeat, engine) if cold else measure(fn, repeat)
+        results[key] = dict(stats, group=group)
+        print(f"  {key:<48} median {stats['median_ms']:9.2f}ms  min {stats['min_ms']:9.2f}ms", flush=True)
+
+    bench("load", "load_all_data/cold", None, cold=True)
+    bench("load", "load_all_data/warm", app.load_all_data)
+    for engine in app.CSV_ENGINES:
+        if app.csv_engine(engine) != engine:
+            print(f"  （{engine} は利用できないため計測しません）")
+            continue
+        bench("load", f"load_all_data/cold[{engine}]", None, cold=True, engine=engine)
+        bench("load", f"load_all_data/warm[{engine}]", lambda e=engine: app.load_all_data(engine=e))
+    bench("load", "load_transition_total", lambda: app.load_transition_total(app.TRANSITION_XLSX))
+
+    if only and "load_all_data" in only:
+        # 読み込みだけを計測する場合はデータセットの構築を省く（大きな合成データでの CSV エンジン比較用）
+        return results, {"data_dir": str(data_dir)}
+    df_long = app.normalize_long_table(app.load_all_data())
+    bench("load", "build_dataset", lambda: app.build_dataset(df_long))
+    data = app.build_dataset(df_long)
+
+    for name, params in question_cases(df_long):
+        bench("question", name, lambda p=params: app.process_structured_question(df=df_long, dataset=data, **p))
+    charts = {"create_line_chart/41系列": chart_case(data), "create_city_year_heatmap/41市町村": heatmap_case(data)}
+    payload_bytes = {}
+    for name, fn in charts.items():
+        bench("chart", name, fn)
+        if f"chart/{name}" not in results:
+            continue
+        payload_bytes[name] = len(fn().to_json())
+        print(f"  {'chart/' + name + ' の JSON':<48} {payload_bytes[name]:>9,} bytes", flush=True)
+    for name, fn in tab_cases(data):
+        bench("pivot", name, fn)
+
+    dataset = {
+        "data_dir": str(data_dir),
+        "rows": int(len(df_long)),
+        "years": [int(df_long["year"].min()), int(df_long["year"].max())],
+        "cities": int(df_long["city"].nunique()),
+        "payload_bytes": payload_bytes,
+    }
+    return results, dataset
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "pyarrow": _version("pyarrow"),
+        "plotly": plotly.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _version(module):
+    try:
+        return __import__(module).__version__
+    except ImportError:
+        return None
+
+
+def compare(current, baseline_path):
+    """過去の結果ファイルと中央値を比較して表示する"""
+    baseline = json.loads(Path(baseline_path).read_text(encoding="utf-8"))
+    print(f"\n比較対象: {baseline_path} ({baseline.get('created_at')}, {baseline['environment'].get('git_commit')})")
+    print(f"  {'case':<48} {'base(ms)':>10} {'now(ms)':>10} {'ratio':>7}")
+    for key, stats in current["results"].items():
+        base = baseline["results"].get(key)
+        if not base:
+            continue
+        ratio = stats["median_ms"] / base["median_ms"] if base["median_ms"] else float("nan")
+        flag = "  ▲遅化" if ratio > 1.2 else ("  ▼高速化" if ratio < 0.8 else "")
+        print(f"  {key:<48} {base['median_ms']:10.2f} {stats['median_ms']:10.2f} {ratio:7.2f}{flag}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="データ読み込み・質問応答のベンチマークを実行します")
+    parser.add_argument("--data-dir", default=str(app.DATA_DIR), help="データディレクトリ（raw/ と processed/ を含む）")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N",
+                        help="市町村数を N 倍（41×N）にした合成データ（tools.synthetic_data）で計測する")
+    parser.add_argument("--synthetic-years", type=int, default=18, help="合成データの年数（既定: 18）")
+    parser.add_argument("--seed", type=int, default=0, help="合成データの乱数シード")
+    parser.add_argument("--repeat", type=int, default=5, help="各ケースの繰り返し回数（既定: 5）")
+    parser.add_argument("--cold-repeat", type=int, default=3, help="cold load の計測回数（既定: 3）")
+    parser.add_argument("--only", default=None, help="ケース名にこの文字列を含むものだけ実行する")
+    parser.add_argument("--output", default=None, help="結果JSONの保存先（既定: benchmarks/<日時>_<データ>.json）")
+    parser.add_argument("--compare", default=None, help="比較対象の結果JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    label = f"synthetic{args.synthetic}x" if args.synthetic else "bundled"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = Path(args.data_dir)
+        if args.synthetic:
+            print(f"合成データを作成中（{args.synthetic}倍）...")
+            data_dir = Path(tmp) / "data"
+            synthetic_data.write_tree(data_dir, n_cities=41 * args.synthetic,
+                                      n_years=args.synthetic_years, seed=args.seed)
+        print(f"ベンチマーク開始: {label} ({data_dir})")
+        results, dataset = run_benchmarks(data_dir, args.repeat, args.cold_repeat, args.only)
+
+    created_at = datetime.now()
+    report = {
+        "schema": 1,
+        "created_at": created_at.isoformat(timespec="seconds"),
+        "label": label,
+        "environment": environment(),
+        "dataset": dataset,
+        "results": results,
+    }
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{created_at:%Y%m%d-%H%M%S}_{label}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n結果を保存しました: {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
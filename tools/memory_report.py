@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# tools/memory_report.py
+# =============================================================
+# データフレームのメモリ使用量レポート
+# -------------------------------------------------------------
+# アプリの main() と同じ手順でデータを読み込み、保持するフレームごとの
+# 使用量（deep）と df_long とのバッファ共有を集計する。
+# 比較のため、テーブル別フレームを df.query でコピーした場合の使用量も表示する。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.memory_report
+#   python -m tools.memory_report --data-dir /tmp/synthetic --json memory.json
+#   python -m tools.memory_report --workers 4 --shared-dir /tmp/okinawa_shared
+#
+# --workers を指定すると、N 個のワーカープロセスがそれぞれデータを読み込んだ状態の
+# 比例配分メモリ（PSS、/proc/<pid>/smaps_rollup）を、各プロセスが個別に読み込む場合と
+# 共有ディレクトリ（OKINAWA_SHARED_DIR）の Arrow ファイルをメモリマップする場合とで比較する。
+# =============================================================
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+import app
+
+
+def collect(data_dir=None):
+    """main() と同じ手順でフレームを読み込んで登録し、(ビュー方式のレポート, コピー方式のレポート) を返す"""
+    if data_dir is not None:
+        app.set_data_dir(data_dir)
+
+    app.start_memory_run()
+    app.track_memory("県全体（Transition.xlsx）", app.load_transition_total(app.TRANSITION_XLSX))
+    df_long = app.load_all_data()
+    if df_long.empty:
+        raise SystemExit("データファイルが見つかりません")
+    # build_dataset は df_long を並べ替えた写しを作り、テーブル別フレームはその写しのビューになる（main() と同じく写しを基準にする）
+    dataset = app.build_dataset(app.normalize_long_table(df_long))
+    df_long = app.track_memory("df_long", dataset["long"])
+    tables = dataset["tables"]
+    for table, frame in tables.items():
+        app.track_memory(f"テーブル: {table}", frame, base=df_long)
+    views = app.memory_report()
+
+    # 以前の方式（タブごとに df.query でテーブルを抽出）
+    copies = [
+        (f"テーブル: {table}", "フレーム", df_long.query("table == @table"), df_long)
+        for table in tables
+    ]
+    return views, app.memory_report(copies)
+
+
+def _rollup_kb(pid):
+    """/proc/<pid>/smaps_rollup の Rss・Pss（KB）。取得できない環境では None"""
+    try:
+        lines = Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()
+    except OSError:
+        return None
+    values = {line.split(":")[0]: int(line.split()[1]) for line in lines if line.startswith(("Rss:", "Pss:"))}
+    return values.get("Rss"), values.get("Pss")
+
+
+def _worker(data_dir, shared_dir, ready, done):
+    """ワーカープロセス: アプリと同じ経路（_loaded_data）でデータを保持したまま計測を待つ"""
+    import app as worker_app
+
+    if data_dir is not None:
+        worker_app.set_data_dir(data_dir)
+    worker_app.SHARED_DIR = shared_dir
+    store = worker_app._loaded_data()
+    ready.release()
+    done.wait()
+    del store
+
+
+def measure_workers(count, data_dir=None, shared_dir=None):
+    """count 個のワーカーがデータを保持した状態の PSS 合計（MB）・RSS 合計（MB）を返す"""
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Semaphore(0), context.Event()
+    workers = [context.Process(target=_worker, args=(data_dir, shared_dir, ready, done)) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready.acquire()
+    rollups = [_rollup_kb(worker.pid) for worker in workers]
+    done.set()
+    for worker in workers:
+        worker.join()
+    if any(rollup is None for rollup in rollups):
+        return None
+    return {
+        "workers": count,
+        "rss_mb": sum(rss for rss, _ in rollups) / 1024,
+        "pss_mb": sum(pss for _, pss in rollups) / 1024,
+    }
+
+
+def compare_workers(max_workers, data_dir=None, shared_dir=None):
+    """ワーカー数 1〜max_workers について、個別読み込みと共有（メモリマップ）の PSS 合計を比較する"""
+    rows = []
+    for count in range(1, max_workers + 1):
+        for mode, directory in (("個別読み込み", None), ("共有（メモリマップ）", shared_dir)):
+            result = measure_workers(count, data_dir, directory)
+            if result is None:
+                return None
+            rows.append({"方式": mode, "ワーカー数": count,
+                         "PSS合計(MB)": round(result["pss_mb"], 1), "RSS合計(MB)": round(result["rss_mb"], 1)})
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="データフレームのメモリ使用量を集計します")
+    parser.add_argument("--data-dir", default=None, help="データディレクトリ（既定: app.DATA_DIR）")
+    parser.add_argument("--json", default=None, help="結果をJSONで保存するパス")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="ワーカープロセス数の上限（指定時は個別読み込みと共有の PSS を比較）")
+    parser.add_argument("--shared-dir", default=None,
+                        help="--workers で使う共有ディレクトリ（既定: OKINAWA_SHARED_DIR または一時ディレクトリ）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    views, copies = collect(args.data_dir)
+
+    print("■ 現在の方式（テーブル別フレームは df_long のビュー）")
+    print(views.to_string(index=False))
+    print(f"  実質合計: {views['実質(KB)'].sum() / 1024:,.2f} MB")
+    print()
+    print("■ 参考: テーブル別フレームを df.query でコピーした場合の追加分")
+    print(copies[copies["種類"] == "フレーム"].to_string(index=False))
+    print(f"  追加合計: {copies.loc[copies['種類'] == 'フレーム', '実質(KB)'].sum() / 1024:,.2f} MB")
+
+    peak = app.process_peak_rss_mb()
+    if peak is not None:
+        print(f"\nプロセス最大常駐メモリ: {peak:,.0f} MB")
+
+    workers = None
+    if args.workers:
+        import tempfile
+
+        shared_dir = args.shared_dir or os.environ.get("OKINAWA_SHARED_DIR") or tempfile.mkdtemp(prefix="okinawa_shared_")
+        workers = compare_workers(args.workers, args.data_dir, shared_dir)
+        print()
+        if workers is None:
+            print("■ ワーカー数別のメモリ: /proc/<pid>/smaps_rollup が使えない環境のため計測できません")
+        else:
+            print(f"■ ワーカー数別のメモリ（共有ディレクトリ: {shared_dir}）")
+            print(pd.DataFrame(workers).to_string(index=False))
+
+    if args.json:
+        path = Path(args.json)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({
+            "data_dir": str(app.DATA_DIR),
+            "views": views.astype(object).where(views.notna(), None).to_dict(orient="records"),
+            "copies": copies.astype(object).where(copies.notna(), None).to_dict(orient="records"),
+            "peak_rss_mb": peak,
+            "workers": workers,
+        }, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"結果を保存しました: {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# tools/prepare_geojson.py
+# =============================================================
+# 市町村境界 GeoJSON の作成（市町村別分析タブの「🗾 市町村マップ」用）
+# -------------------------------------------------------------
+# 国土数値情報「行政区域」（N03）の GeoJSON から沖縄県の市町村を取り出し、
+# 市町村コード（N03_007 の上5桁 = app.CITY_CODE）ごとに1つの MultiPolygon にまとめて簡略化し、
+# アプリが読み込むファイル（app.map_geojson_path()、既定は data/raw/okinawa_municipalities.geojson）を作る。
+# ・Douglas–Peucker 法で頂点を間引く（--tolerance 度）
+# ・面積が --min-area 平方度未満の小島は除く（各市町村で最大のポリゴンは必ず残す）
+# ・座標は app.MAP_COORD_DECIMALS 桁に丸める
+# 出力のプロパティは code（市町村コード）と name（市町村名）だけにする。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.prepare_geojson N03-20240101_47.geojson
+#   python -m tools.prepare_geojson N03-20240101_47.geojson --tolerance 0.0005 --output /tmp/okinawa.geojson
+# =============================================================
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+import app
+
+
+def simplify_ring(points, tolerance):
+    """Douglas–Peucker 法で折れ線 points（n × 2）の頂点を間引く（始点・終点は残す）"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end <= start + 1:
+            continue
+        inner = points[start + 1:end]
+        a, b = points[start], points[end]
+        dx, dy = b - a
+        norm = np.hypot(dx, dy)
+        if norm == 0:
+            distance = np.hypot(inner[:, 0] - a[0], inner[:, 1] - a[1])
+        else:
+            distance = np.abs(dx * (inner[:, 1] - a[1]) - dy * (inner[:, 0] - a[0])) / norm
+        i = int(distance.argmax())
+        if distance[i] > tolerance:
+            keep[start + 1 + i] = True
+            stack += [(start, start + 1 + i), (start + 1 + i, end)]
+    return points[keep]
+
+
+def ring_area(points):
+    """リングの面積（平方度。shoelace 公式の絶対値）"""
+    x, y = points[:, 0], points[:, 1]
+    return abs(float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))) / 2
+
+
+def prepare(source, tolerance, min_area):
+    """
+    N03 の FeatureCollection から市町村ごとの簡略化した FeatureCollection を作る。
+    戻り値: (FeatureCollection, 入力の頂点数, 出力の頂点数)
+    """
+    polygons = defaultdict(list)
+    vertices_in = 0
+    for feature in source.get("features", []):
+        geometry = feature.get("geometry") or {}
+        code = app._feature_code(feature.get("properties") or {})
+        if code is None or geometry.get("type") not in ("Polygon", "MultiPolygon"):
+            continue
+        parts = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+        for part in parts:
+            rings = [np.asarray(ring, dtype=float)[:, :2] for ring in part]
+            vertices_in += sum(len(ring) for ring in rings)
+            polygons[code].append(rings)
+
+    names = {code: name for name, code in app.CITY_CODE.items()}
+    features, vertices_out = [], 0
+    for code, parts in sorted(polygons.items()):
+        areas = [ring_area(rings[0]) for rings in parts]
+        largest = int(np.argmax(areas))
+        coordinates = []
+        for i, rings in enumerate(parts):
+            if i != largest and areas[i] < min_area:
+                continue
+            simplified = []
+            for ring in rings:
+                ring = np.round(simplify_ring(ring, tolerance), app.MAP_COORD_DECIMALS)
+                ring = ring[np.r_[True, (np.diff(ring, axis=0) != 0).any(axis=1)]]
+                if len(ring) >= 4:
+                    simplified.append(ring.tolist())
+            if not simplified and i == largest:
+                # 簡略化で潰れた場合も、市町村の最大のポリゴンは丸めただけの形で残す
+                simplified = [np.round(rings[0], app.MAP_COORD_DECIMALS).tolist()]
+            if simplified:
+                coordinates.append(simplified)
+                vertices_out += sum(len(ring) for ring in simplified)
+        features.append({
+            "type": "Feature",
+            "properties": {"code": str(code), "name": names[code]},
+            "geometry": {"type": "MultiPolygon", "coordinates": coordinates},
+        })
+    return {"type": "FeatureCollection", "features": features}, vertices_in, vertices_out
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="国土数値情報（行政区域 N03）から市町村マップ用の GeoJSON を作成します")
+    parser.add_argument("source", help="N03 の GeoJSON（沖縄県、または全国）")
+    parser.add_argument("--output", default=None, help="出力先（既定: app.map_geojson_path()）")
+    parser.add_argument("--data-dir", default=None, help="データディレクトリ（既定: app.DATA_DIR）")
+    parser.add_argument("--tolerance", type=float, default=0.001, help="頂点を間引く許容距離（度。既定 0.001 ≒ 100m）")
+    parser.add_argument("--min-area", type=float, default=1e-6, help="除く小島の面積（平方度。既定 1e-6 ≒ 0.01km²）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.data_dir is not None:
+        app.set_data_dir(args.data_dir)
+    source = json.loads(Path(args.source).read_text(encoding="utf-8"))
+    collection, vertices_in, vertices_out = prepare(source, args.tolerance, args.min_area)
+    if not collection["features"]:
+        print("沖縄県の市町村（app.CITY_CODE）に一致するフィーチャーがありません")
+        return 1
+
+    output = Path(args.output) if args.output else app.map_geojson_path()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(collection, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+
+    found = {int(feature["properties"]["code"]) for feature in collection["features"]}
+    missing = [name for name, code in sorted(app.CITY_CODE.items(), key=lambda item: item[1]) if code not in found]
+    print(f"市町村: {len(found)} / {len(app.CITY_CODE)}" + (f"（なし: {'・'.join(missing)}）" if missing else ""))
+    print(f"頂点数: {vertices_in:,} → {vertices_out:,}")
+    print(f"保存しました: {output}（{output.stat().st_size / 1024:,.1f} KB）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
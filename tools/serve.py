@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# tools/serve.py
+# =============================================================
+# ウォームアップしてからアプリを配信する起動スクリプト
+# -------------------------------------------------------------
+# streamlit run app.py ではブラウザが接続して最初のスクリプト実行が始まるまで何も読み込まれないため、
+# 最初の利用者が読み込み・集計・図の作成を待つことになり、準備状況ファイルを使うヘルスチェックも
+# アクセスがあるまで通らない。このスクリプトは
+#   1. app を読み込み、このプロセスでウォームアップをバックグラウンドで始めてから（app.start_warm_up）
+#   2. 同じプロセスで Streamlit サーバーを起動し、ページはこのファイル経由で app.run_page() を実行する
+# app モジュールを1つだけ使うため、ウォームアップで作ったキャッシュ（st.cache_resource）をそのまま使える。
+# 準備状況ファイル（OKINAWA_READY_FILE）はウォームアップが終わった時点でこのプロセスが書き出す。
+#
+# 使い方（リポジトリのルートで実行。-- の後ろは streamlit run のオプション）:
+#   OKINAWA_READY_FILE=/tmp/okinawa_ready.json python -m tools.serve -- --server.port 8501
+#   python -m tools.warmup --check /tmp/okinawa_ready.json   # ヘルスチェック
+# =============================================================
+
+import os
+import sys
+from pathlib import Path
+
+from streamlit import runtime
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv[:1] == ["--"]:
+        argv = argv[1:]
+    # スクリプト実行でもウォームアップの完了を待ち、データが差し替わっていれば作り直す（app.ensure_warm）
+    os.environ["OKINAWA_WARMUP"] = "1"
+    app.start_warm_up()
+
+    from streamlit.web import cli
+
+    sys.argv = ["streamlit", "run", str(Path(__file__).resolve()), *argv]
+    return cli.main()
+
+
+if runtime.exists():
+    # Streamlit サーバーからのスクリプト実行（読み込み済みの app モジュールでページを表示する）
+    app.run_page()
+elif __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# tools/synthetic_data.py
+# =============================================================
+# 規模拡大テスト用の合成データ生成ツール
+# -------------------------------------------------------------
+# 同梱データと同じ構成のデータツリーを出力する:
+#   raw/Transition.xlsx                        県全体推移（和暦の年列・「－」の欠損値を含む）
+#   raw/region_master.json                     CITY_CODE / REGION_MAP 相当（app.load_region_master で読み込み）
+#   processed/all/all_years_long.csv           year,city,area,table,cat1,cat2,metric,value（最終年を除く）
+#   processed/by_year/long_YYYY.csv            municipality 列・重複した 0/1 列・ヘッダ行の混入
+#   processed/by_year/long_YYYY_hotel_breakdown.csv  BOM付き・「種別_規模」カテゴリ
+#
+# 値は内訳の合計が一致するように生成する（宿泊形態の合計 = total、
+# ホテル・旅館 = 規模別 total = large+medium+small = hotel_breakdown total）。
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.synthetic_data --out /tmp/synthetic --cities 4100
+#   python -m tools.synthetic_data --out /tmp/synthetic --cities 410 --years 120 --extra-categories 5
+#   OKINAWA_DATA_DIR=/tmp/synthetic streamlit run app.py
+# =============================================================
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import app
+
+ACCOMMODATION_TYPES = [
+    "hotel_ryokan", "minshuku", "pension_villa", "dormitory_guesthouse",
+    "weekly_mansion", "group_facilities", "youth_hostel",
+]
+SCALES = ["large", "medium", "small"]
+HOTEL_TYPES = ["resort_hotel", "business_hotel", "city_hotel", "ryokan"]
+
+# 同梱データの long_YYYY.csv に混入しているヘッダ由来の行（metric 列に残った列名）
+JUNK_METRICS = [f"{s}{suffix}" for s in SCALES for suffix in ("", ".1", ".2")]
+JUNK_METRICS += [f"Unnamed: {i}_level_1" for i in (37, 38, 39)]
+
+
+# ---------------- 市町村構成 ----------------
+def build_region_master(n_cities, n_areas):
+    """
+    合成データ用の CITY_CODE / REGION_MAP を作る。
+    先頭41件は実在の市町村・エリアをそのまま使い、それ以降は合成市町村を各エリアに順番に割り当てる。
+    """
+    real_cities = sorted(app._DEFAULT_CITY_CODE, key=app._DEFAULT_CITY_CODE.get)
+    city_to_area = {c: a for a, lst in app._DEFAULT_REGION_MAP.items() for c in lst}
+
+    areas = list(app._DEFAULT_REGION_MAP)[:n_areas] + [f"合成エリア{i:02d}" for i in range(len(app._DEFAULT_REGION_MAP) + 1, n_areas + 1)]
+    region_map = {area: [] for area in areas}
+    city_code = {}
+    for i in range(n_cities):
+        if i < len(real_cities) and city_to_area[real_cities[i]] in region_map:
+            city = real_cities[i]
+            city_code[city] = app._DEFAULT_CITY_CODE[city]
+            region_map[city_to_area[city]].append(city)
+        else:
+            city = f"合成町{i + 1:05d}"
+            city_code[city] = 90000 + i + 1
+            region_map[areas[i % len(areas)]].append(city)
+    return city_code, region_map
+
+
+# ---------------- 値の生成 ----------------
+def _split(values, weights):
+    """整数配列 values を weights（最後の軸）の比率で分割し、合計が元の値と一致するようにする"""
+    parts = np.floor(values[..., None] * weights).astype(np.int64)
+    parts[..., -1] = values - parts[..., :-1].sum(axis=-1)
+    return parts
+
+
+def generate_values(n_cities, years, extra_categories, seed):
+    """
+    (city, year, 宿泊形態, metric) の配列と、それを分割した規模別・ホテル種別の配列を返す。
+    metric の軸は [facilities, rooms, capacity]。
+    """
+    rng = np.random.default_rng(seed)
+    n_years = len(years)
+    categories = ACCOMMODATION_TYPES + [f"extra_{i:02d}" for i in range(1, extra_categories + 1)]
+    n_cats = len(categories)
+
+    size = rng.lognormal(mean=3.0, sigma=1.2, size=n_cities)
+    share = rng.dirichlet(np.full(n_cats, 0.8), size=n_cities)
+    growth = np.exp(np.cumsum(rng.normal(0.03, 0.06, size=(n_cities, n_years)), axis=1))
+    facilities = np.round(size[:, None, None] * share[:, None, :] * growth[:, :, None]).astype(np.int64)
+
+    # 1施設あたり客室数（ホテル・旅館は大きめ）と1室あたり収容人数
+    rooms_per_facility = rng.lognormal(mean=1.5, sigma=0.4, size=(n_cities, 1, n_cats))
+    rooms_per_facility[..., 0] = rng.lognormal(mean=3.5, sigma=0.5, size=(n_cities, 1))
+    rooms = np.round(facilities * rooms_per_facility).astype(np.int64)
+    capacity = np.round(rooms * rng.uniform(1.8, 3.2, size=(n_cities, 1, n_cats))).astype(np.int64)
+    accommodation = np.stack([facilities, rooms, capacity], axis=-1)  # (city, year, cat, metric)
+
+    hotel = accommodation[:, :, 0, :]  # ホテル・旅館 (city, year, metric)
+    scale_weights = rng.dirichlet([2.0, 3.0, 5.0], size=(n_cities, 1, 1))
+    scale = _split(hotel, scale_weights)  # (city, year, metric, scale)
+    type_weights = rng.dirichlet([3.0, 3.0, 1.0, 1.5], size=(n_cities, 1, 1, 1))
+    hotel_types = _split(scale, type_weights)  # (city, year, metric, scale, type)
+    return categories, accommodation, scale, hotel_types
+
+
+# ---------------- long 形式への変換 ----------------
+def _frame(cities, years, cat_labels, table, values):
+    """(city, year, cat, metric) の配列を long 形式の DataFrame に変換する"""
+    n_c, n_y, n_k, n_m = values.shape
+    idx = np.indices((n_c, n_y, n_k, n_m)).reshape(4, -1)
+    return pd.DataFrame({
+        "year": np.asarray(years)[idx[1]],
+        "city": np.asarray(cities, dtype=object)[idx[0]],
+        "table": table,
+        "cat1": np.asarray(cat_labels, dtype=object)[idx[2]],
+        "metric": np.asarray(app.METRICS, dtype=object)[idx[3]],
+        "value": values.reshape(-1),
+    })
+
+
+def build_long_tables(cities, years, categories, accommodation, scale, hotel_types, hotel_from, region_map):
+    """all_years_long.csv 相当の行（エリア・県の集計行を含む）と、種別_規模の hotel_breakdown 行を作る"""
+    acc_total = accommodation.sum(axis=2, keepdims=True)
+    frames = [
+        _frame(cities, years, categories + ["total"], "accommodation_type",
+               np.concatenate([accommodation, acc_total], axis=2)),
+    ]
+    scale_total = scale.sum(axis=-1, keepdims=True)
+    frames.append(_frame(cities, years, SCALES + ["total"], "scale_class",
+                         np.concatenate([scale, scale_total], axis=-1).transpose(0, 1, 3, 2)))
+
+    hb_years = [y for y in years if y >= hotel_from]
+    hb_slice = slice(len(years) - len(hb_years), None)
+    by_type = hotel_types[:, hb_slice].sum(axis=3)  # (city, year, metric, type)
+    hb_total = by_type.sum(axis=-1, keepdims=True)
+    frames.append(_frame(cities, hb_years, HOTEL_TYPES + ["total"], "hotel_breakdown",
+                         np.concatenate([by_type, hb_total], axis=-1).transpose(0, 1, 3, 2)))
+    long = pd.concat(frames, ignore_index=True)
+
+    n_c, n_y = len(cities), len(hb_years)
+    detail = hotel_types[:, hb_slice].reshape(n_c, n_y, 3, -1)  # (city, year, metric, scale*type)
+    labels = [f"{t}_{s}" for s in SCALES for t in HOTEL_TYPES]
+    detail = np.concatenate([detail, hb_total], axis=-1).transpose(0, 1, 3, 2)
+    hotel_detail = _frame(cities, hb_years, labels + ["total"], "hotel_breakdown", detail)
+
+    city_to_area = {c: a for a, lst in region_map.items() for c in lst}
+    long["area"] = long["city"].map(city_to_area)
+    hotel_detail["area"] = hotel_detail["city"].map(city_to_area)
+
+    # 同梱データと同様に、標準6エリアと沖縄県の集計行を「未分類」として加える
+    keys = ["year", "table", "cat1", "metric"]
+    rollups = [
+        long[long["area"] == area].groupby(keys, as_index=False)["value"].sum().assign(city=area)
+        for area in app._DEFAULT_REGION_MAP if area in region_map
+    ]
+    rollups.append(long.groupby(keys, as_index=False)["value"].sum().assign(city="沖縄県"))
+    long = pd.concat([long] + [r.assign(area="未分類") for r in rollups], ignore_index=True)
+
+    residential_from = hotel_from + 4
+    residential = long[(long["table"] == "accommodation_type") & (long["cat1"] == "total")
+                       & (long["metric"] == "facilities") & (long["year"] >= residential_from)
+                       & (long["city"].isin(cities))]
+    residential = residential.assign(table="residential_act", cat1="notifications", metric="30",
+                                     value=(residential["value"] * 0.1).round().astype(np.int64))
+    long = pd.concat([long, residential], ignore_index=True)
+    long["cat2"] = ""
+    return long, hotel_detail
+
+
+def _junk_rows(year):
+    """long_YYYY.csv のヘッダ行混入（municipality 空・value に列名）を再現する"""
+    rows = [
+        {"municipality": None, "value": metric, "0": hotel_type, "1": junk, "cat1": hotel_type,
+         "metric": junk, "cat2": None, "table": "hotel_breakdown", "year": year}
+        for hotel_type in HOTEL_TYPES for junk in JUNK_METRICS for metric in ("facilities",)
+    ]
+    return pd.DataFrame(rows)
+
+
+# ---------------- 出力 ----------------
+def to_era(year):
+    """西暦を Transition.xlsx の和暦表記（s47, h1, r6 など）に変換する"""
+    if 1926 <= year <= 1988:
+        return f"s{year - 1925}"
+    if 1989 <= year <= 2018:
+        return f"h{year - 1988}"
+    if year >= 2019:
+        return f"r{year - 2018}"
+    return str(year)
+
+
+def write_transition(path, long):
+    pref = (
+        long[(long["city"] == "沖縄県") & (long["table"] == "accommodation_type") & (long["cat1"] == "total")]
+        .pivot_table(index="year", columns="metric", values="value", aggfunc="sum")
+        .reindex(columns=app.METRICS)
+        .sort_index()
+    )
+    sheet = pd.DataFrame([[None] * 4, ["total"] + app.METRICS], dtype=object)
+    body = pref.astype(object)
+    # 同梱ファイルと同様、欠損値は「－」で表す
+    body.iloc[::7, 1] = "－"
+    body = body.reset_index()
+    body["year"] = body["year"].map(to_era)
+    sheet = pd.concat([sheet, pd.DataFrame(body.values)], ignore_index=True)
+    with pd.ExcelWriter(path) as writer:
+        sheet.to_excel(writer, sheet_name="total", header=False, index=False)
+
+
+def write_tree(out, n_cities=41, n_areas=6, start_year=2007, n_years=18, extra_categories=0,
+               hotel_from=None, bom="last", seed=0, verbose=True):
+    """合成データツリーを out に書き出し、生成行数などの概要を返す"""
+    t0 = time.perf_counter()
+    out = Path(out)
+    years = list(range(start_year, start_year + n_years))
+    hotel_from = hotel_from if hotel_from is not None else start_year + min(7, n_years - 1)
+
+    city_code, region_map = build_region_master(n_cities, n_areas)
+    cities = list(city_code)
+    categories, accommodation, scale, hotel_types = generate_values(len(cities), years, extra_categories, seed)
+    long, hotel_detail = build_long_tables(cities, years, categories, accommodation, scale, hotel_types,
+                                           hotel_from, region_map)
+
+    raw_dir, all_dir, by_year_dir = out / "raw", out / "processed" / "all", out / "processed" / "by_year"
+    for d in (raw_dir, all_dir, by_year_dir):
+        d.mkdir(parents=True, exist_ok=True)
+
+    (raw_dir / "region_master.json").write_text(
+        json.dumps({"city_code": city_code, "region_map": region_map}, ensure_ascii=False, indent=1),
+        encoding="utf-8",
+    )
+    write_transition(raw_dir / "Transition.xlsx", long)
+
+    # all_years_long.csv は同梱データと同様に最終年を含めない
+    columns = ["year", "city", "area", "table", "cat1", "cat2", "metric", "value"]
+    long[long["year"] < years[-1]][columns].to_csv(all_dir / "all_years_long.csv", index=False)
+
+    by_year_columns = ["municipality", "value", "0", "1", "cat1", "metric", "cat2", "table", "year"]
+    hb_columns = ["year", "city", "metric", "cat1", "cat2", "table", "value"]
+    files = 0
+    for year, part in long.groupby("year", sort=True):
+        part = part.rename(columns={"city": "municipality"}).assign(**{"0": part["cat1"], "1": part["metric"]})
+        part = part[by_year_columns]
+        if year >= hotel_from:
+            part = pd.concat([part, _junk_rows(year)], ignore_index=True)
+        encoding = "utf-8-sig" if bom == "all" or (bom == "last" and year == years[-1]) else "utf-8"
+        part.to_csv(by_year_dir / f"long_{year}.csv", index=False, encoding=encoding)
+        files += 1
+
+        if year >= hotel_from:
+            detail = hotel_detail[hotel_detail["year"] == year].assign(cat2="")[hb_columns]
+            encoding = "utf-8" if bom == "none" else "utf-8-sig"
+            detail.to_csv(by_year_dir / f"long_{year}_hotel_breakdown.csv", index=False, encoding=encoding)
+            files += 1
+
+    summary = {
+        "out": str(out),
+        "cities": len(cities),
+        "areas": len(region_map),
+        "years": [years[0], years[-1]],
+        "categories": len(categories),
+        "long_rows": int(len(long)),
+        "hotel_breakdown_rows": int(len(hotel_detail)),
+        "by_year_files": files,
+        "seconds": round(time.perf_counter() - t0, 2),
+    }
+    if verbose:
+        print(json.dumps(summary, ensure_ascii=False))
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="同梱データと同じ形式の合成データツリーを生成します")
+    parser.add_argument("--out", required=True, help="出力先（raw/ と processed/ を作成）")
+    parser.add_argument("--cities", type=int, default=41, help="市町村数（既定: 41）")
+    parser.add_argument("--areas", type=int, default=6, help="エリア数（既定: 6、7以上は合成エリアを追加）")
+    parser.add_argument("--start-year", type=int, default=2007, help="開始年（既定: 2007）")
+    parser.add_argument("--years", type=int, default=18, help="年数（既定: 18）")
+    parser.add_argument("--extra-categories", type=int, default=0, help="宿泊形態に追加するカテゴリ数")
+    parser.add_argument("--hotel-from", type=int, default=None, help="hotel_breakdown の開始年（既定: 開始年+7）")
+    parser.add_argument("--bom", choices=["none", "last", "all"], default="last",
+                        help="long_YYYY.csv にBOMを付ける範囲（既定: 最終年のみ＝同梱データと同じ）")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    write_tree(args.out, n_cities=args.cities, n_areas=args.areas, start_year=args.start_year,
+               n_years=args.years, extra_categories=args.extra_categories, hotel_from=args.hotel_from,
+               bom=args.bom, seed=args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
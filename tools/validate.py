@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# tools/validate.py
+# =============================================================
+# データ検査 CLI（表間の整合性・ソース間の上書き）
+# -------------------------------------------------------------
+# ・アプリと同じ手順でデータを読み込み、app.check_consistency() の恒等式をすべて検査する
+# ・不一致があれば検査式ごとの件数と一覧を表示し、終了コード 1 を返す
+#   （データファイルを配置する前の確認・CI に使う）
+# ・--baseline に以前の報告 CSV を指定すると、既知の不一致（差も同じもの）は除いて判定する
+# ・ソース間の上書き（app.merge_sources）も表示し、別のソースの値を異なる値で上書きしている場合も
+#   終了コード 1 を返す（同じファイル内の重複行は表示のみ）。--conflicts で一覧を CSV に保存する
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.validate
+#   python -m tools.validate --data-dir /tmp/new_data --csv consistency.csv
+#   python -m tools.validate --baseline consistency.csv
+#   OKINAWA_MERGE_PRECEDENCE=by_year python -m tools.validate --conflicts conflicts.csv
+# =============================================================
+
+import argparse
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+import app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="テーブル間の整合性とソース間の上書きを検査します")
+    parser.add_argument("--data-dir", default=None, help="データディレクトリ（既定: app.DATA_DIR）")
+    parser.add_argument("--csv", default=None, help="不一致の一覧を保存するCSVのパス")
+    parser.add_argument("--baseline", default=None, help="既知の不一致として扱う報告CSV（--csv の出力）")
+    parser.add_argument("--conflicts", default=None, help="ソース間の上書きの一覧を保存するCSVのパス")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.data_dir is not None:
+        app.set_data_dir(args.data_dir)
+    df_long, conflicts = app.load_all_data(with_conflicts=True)
+    if df_long.empty:
+        print("データファイルが見つかりません")
+        return 1
+    dataset = app.build_dataset(app.normalize_long_table(df_long))
+    report = app.check_consistency(dataset["long"])
+
+    if args.csv:
+        path = Path(args.csv)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report.to_csv(path, index=False, encoding="utf-8-sig")
+        print(f"不一致の一覧を保存しました: {path}")
+
+    if args.conflicts:
+        app.write_merge_conflicts(args.conflicts, conflicts)
+        print(f"ソース間の上書きの一覧を保存しました: {args.conflicts}")
+
+    overrides = conflicts[conflicts["採用ソース"] != conflicts["上書きされたソース"]]
+    print(f"■ ソース間の上書き（優先: {app.MERGE_PRECEDENCE}）: 値が異なるもの {len(conflicts):,} 件"
+          f"（別ソースの上書き {len(overrides):,} 件）")
+    if len(conflicts):
+        summary = conflicts.groupby(["上書きされたソース", "採用ソース"], sort=False).size().rename("件数")
+        print(summary.to_string())
+    if len(overrides):
+        print()
+        print(overrides.to_string(index=False))
+    print()
+
+    baseline = pd.read_csv(args.baseline, encoding="utf-8-sig") if args.baseline else None
+    new = app.new_inconsistencies(report, baseline)
+    print(f"■ 表間の整合性: 検査式 {len(app.CONSISTENCY_RULES)} 件 / 行数 {len(dataset['long']):,} / 不一致 {len(report):,} 件"
+          + (f"（既知を除く {len(new):,} 件）" if baseline is not None else ""))
+    if new.empty:
+        print("すべての検査式が一致しています" if report.empty else "新しい不一致はありません")
+    else:
+        print(new.groupby("検査", sort=False).size().rename("件数").to_string())
+        print()
+        print(new.to_string(index=False))
+    return 1 if len(new) or len(overrides) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
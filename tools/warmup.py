@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# tools/warmup.py
+# =============================================================
+# ウォームアップ CLI / ヘルスチェック
+# -------------------------------------------------------------
+# ・app.warm_up() をこのプロセスで実行し、段階ごとの処理時間と準備状況を表示する
+#   （このプロセスは配信しないため、準備状況ファイルは書かない。OKINAWA_READY_FILE も使わない）
+# ・--check は準備状況ファイルを読み、配信中のサーバー（tools.serve）が書いたもので、準備完了かつ
+#   現在のデータファイルと一致する場合だけ終了コード 0 を返す（OKINAWA_READY_FILE=... で起動したサーバーのヘルスチェックに使う）
+#
+# 使い方（リポジトリのルートで実行）:
+#   python -m tools.warmup
+#   python -m tools.warmup --data-dir /tmp/synthetic
+#   python -m tools.warmup --check /tmp/okinawa_ready.json
+# =============================================================
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import app
+
+
+def _process_alive(pid):
+    """pid のプロセスが動いているか（別ユーザーのプロセスで確認できない場合は動いているものとする）"""
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def check(ready_file):
+    """準備状況ファイルを確認し、(準備完了か, 理由) を返す"""
+    path = Path(ready_file)
+    if not path.exists():
+        return False, "準備状況ファイルがありません（ウォームアップ未完了）"
+    status = json.loads(path.read_text(encoding="utf-8"))
+    if status.get("source") != "server":
+        return False, "配信中のサーバーが書き出した準備状況ファイルではありません"
+    if not _process_alive(status.get("pid")):
+        return False, f"準備状況ファイルを書き出したサーバー（pid {status.get('pid')}）が終了しています"
+    if not status.get("ready"):
+        return False, f"ウォームアップ未完了: {status.get('error') or '実行中'}"
+    app.set_data_dir(status["data_dir"])
+    signature = [list(entry) for entry in app.data_signature()]
+    if status.get("signature") != signature:
+        return False, "ウォームアップ後にデータファイルが変更されています"
+    return True, f"準備完了（版 {status['version']}、{status['total_ms']:,.0f} ms）"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="データ読み込みと既定表示の派生データ・図を事前に作成します")
+    parser.add_argument("--data-dir", default=None, help="データディレクトリ（既定: app.DATA_DIR）")
+    parser.add_argument("--check", default=None, metavar="READY_FILE", help="準備状況ファイルを確認して終了する（ヘルスチェック用）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.check:
+        ok, message = check(args.check)
+        print(message)
+        return 0 if ok else 1
+
+    if args.data_dir is not None:
+        app.set_data_dir(args.data_dir)
+    status = app.warm_up(source="cli")
+    for stage in status["stages"]:
+        print(f"  {stage['段階']:<20} {stage['時間(ms)']:10,.1f} ms")
+    print(f"  {'合計':<20} {status['total_ms']:10,.1f} ms")
+    if not status["ready"]:
+        print(f"ウォームアップに失敗しました: {status['error']}")
+        return 1
+    print(f"準備完了（データの版 {status['version']}）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())